@@ -0,0 +1,97 @@
+"""Compare the dev WER and beam search time of the approximate search
+options, windowed attention and the decoder output shortlist, against exact
+search.
+
+The command file is the same as for grid_search_for_beam.py, and the dev
+set is decoded in-process by a BeamGridSearch, so the model is restored and
+the encoder run once. The report is written alongside it as
+approx_search_report.txt.
+"""
+
+from __future__ import print_function
+
+from os import path
+
+import argparse
+import sys
+
+import main
+from grid_search_for_beam import read_command, get_main_argv, BeamGridSearch
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-cmd_file", type=str,
+                        help="Command file to run the model")
+    parser.add_argument("-beam_size", default=4, type=int, help="Beam size")
+    parser.add_argument("-lm_weight", default=0.0, type=float, help="LM weight")
+    parser.add_argument("-windows", default="50,100,200", type=str,
+                        help="Comma separated attention window sizes")
+    parser.add_argument("-fallback_probs", default="0.0,0.3", type=str,
+                        help="Comma separated fallback probabilities")
+    parser.add_argument("-shortlist_sizes", default="", type=str,
+                        help="Comma separated decoder output shortlist sizes")
+    parser.add_argument("-shortlist_full_every", default="10", type=str,
+                        help="Comma separated steps between full softmax passes")
+    args = parser.parse_args()
+    return args
+
+
+def run_dev(dev_search, beam_size, lm_weight, approx_params):
+    """Decode the dev set with the approximate search params set and return
+    the WER and the beam search time."""
+    base_params = dev_search.options.beam_search_params
+    search_params = dev_search.get_search_params(
+        beam_size, base_params.cov_penalty, lm_weight, base_params.word_ins_penalty)
+    search_params.update(approx_params)
+    asr_perf, _, _ = dev_search.decode(search_params)
+    return asr_perf, dev_search.evaluation.eval_model.beam_time
+
+
+def approx_search_report(args):
+    base_cmd = read_command(args.cmd_file)
+    report_file = path.join(path.dirname(args.cmd_file), "approx_search_report.txt")
+
+    dev_search = BeamGridSearch(main.parse_options(get_main_argv(base_cmd) + ["-dev"]))
+    # The approximations are disabled for exact search even if the command
+    # enables them
+    exact_params = dict(attn_window=0, shortlist_size=0)
+    configs = [("exact", exact_params)]
+    if args.windows:
+        for window in args.windows.split(","):
+            for prob in args.fallback_probs.split(","):
+                configs.append(("window %s fallback %s" %(window, prob),
+                                dict(exact_params, attn_window=int(window),
+                                     attn_fallback_prob=float(prob))))
+    if args.shortlist_sizes:
+        for size in args.shortlist_sizes.split(","):
+            for full_every in args.shortlist_full_every.split(","):
+                configs.append(("shortlist %s full every %s" %(size, full_every),
+                                dict(exact_params, shortlist_size=int(size),
+                                     shortlist_full_every=int(full_every))))
+
+    with open(report_file, "w") as report_f:
+        header = "%-32s %8s %9s %9s %8s" %("config", "WER", "WER diff", "time (s)", "speedup")
+        report_f.write(header + "\n")
+        print (header)
+        for config_name, approx_params in configs:
+            asr_perf, beam_time = run_dev(dev_search, args.beam_size, args.lm_weight,
+                                          approx_params)
+            if approx_params is exact_params:
+                exact_perf, exact_time = asr_perf, beam_time
+            line = ("%-32s %8.4f %+9.4f %9.2f %7.2fx"
+                    %(config_name, asr_perf, asr_perf - exact_perf, beam_time,
+                      exact_time / max(beam_time, 1e-6)))
+            report_f.write(line + "\n")
+            report_f.flush()
+            print (line)
+            sys.stdout.flush()
+    dev_search.close()
+
+    print ("Report at: %s" %report_file)
+
+
+if __name__=="__main__":
+    args = parse_options()
+    approx_search_report(args)
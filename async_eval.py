@@ -0,0 +1,144 @@
+"""Dev set evaluation of training checkpoints in a background process.
+
+The trainer saves a checkpoint and submits its path, then goes on training
+while the evaluator process restores the checkpoint into its own eval graph
+and evaluates it on the dev set. The dev results are sent back over a queue in
+the order of submission, and the trainer applies them to the learning rate
+decay, early stopping and best model logic whenever it next checks, so
+training throughput doesn't depend on the dev set size.
+
+The evaluator is forked before the trainer creates its TF session, and is
+a daemon that also exits once the trainer process is gone.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import multiprocessing
+import os
+import shutil
+import sys
+from os import path
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import tensorflow as tf
+from bunch import Bunch
+
+# Seconds between the checks of the evaluator for the trainer being alive
+POLL_SECONDS = 10
+
+
+def run_evaluator(trainer, ckpt_queue, result_queue, parent_pid):
+    """Evaluator process loop, which evaluates the (global step, checkpoint
+    path) requests of ckpt_queue until a None request. An exception is put
+    on result_queue in place of the dev error."""
+    try:
+        with tf.Graph().as_default():
+            dev_set = trainer.get_dev_set(logging=False)
+            trainer.create_eval_model(dev_set, standalone=True)
+            # The counters of the eval models needn't be in the checkpoint
+            saver = tf.train.Saver(tf.trainable_variables())
+            config = tf.ConfigProto()
+            config.gpu_options.allow_growth = True
+            # Best teacher forced dev loss and number of dev evaluations
+            dev_state = Bunch(best_loss=float('inf'), num_evals=0)
+            with tf.Session(config=config) as sess:
+                while True:
+                    try:
+                        request = ckpt_queue.get(timeout=POLL_SECONDS)
+                    except queue.Empty:
+                        if os.getppid() != parent_pid:
+                            return
+                        continue
+                    if request is None:
+                        return
+                    global_step, ckpt_path = request
+                    saver.restore(sess, ckpt_path)
+                    dev_result = trainer.run_dev_eval(sess, global_step, dev_state)
+                    dev_result.ckpt_path = ckpt_path
+                    sys.stdout.flush()
+                    result_queue.put(dev_result)
+    except Exception as eval_error:
+        result_queue.put(eval_error)
+
+
+def copy_checkpoint(ckpt_path, model_dir, max_to_keep=2):
+    """Copy the files of a checkpoint to model_dir and make it the latest
+    checkpoint there, deleting all but the max_to_keep latest ones."""
+    for ckpt_file in glob.glob(ckpt_path + ".*"):
+        shutil.copy(ckpt_file, model_dir)
+    new_path = path.join(model_dir, path.basename(ckpt_path))
+
+    ckpt_state = tf.train.get_checkpoint_state(model_dir)
+    all_paths = ([] if ckpt_state is None else
+                 [old_path for old_path in ckpt_state.all_model_checkpoint_paths
+                  if old_path != new_path])
+    all_paths.append(new_path)
+    for old_path in all_paths[:-max_to_keep]:
+        for old_file in glob.glob(old_path + ".*"):
+            os.remove(old_file)
+    tf.train.update_checkpoint_state(model_dir, new_path,
+                                     all_model_checkpoint_paths=all_paths[-max_to_keep:])
+    return new_path
+
+
+class AsyncEvaluator(object):
+    """Handle of the evaluator process of a trainer."""
+
+    def __init__(self, trainer):
+        self.ckpt_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        self.num_pending = 0
+        self.process = multiprocessing.Process(
+            target=run_evaluator,
+            args=(trainer, self.ckpt_queue, self.result_queue, os.getpid()))
+        self.process.daemon = True
+        self.process.start()
+
+    def submit(self, global_step, ckpt_path):
+        """Queue the checkpoint saved at global_step for evaluation."""
+        self.ckpt_queue.put((global_step, ckpt_path))
+        self.num_pending += 1
+
+    def get_result(self, block):
+        while True:
+            try:
+                result = self.result_queue.get(block=block, timeout=POLL_SECONDS)
+                break
+            except queue.Empty:
+                if not block:
+                    raise
+                if not self.process.is_alive():
+                    raise RuntimeError("Evaluator process exited with code %s"
+                                       %str(self.process.exitcode))
+        if isinstance(result, Exception):
+            # Reraise the exception of the evaluator
+            raise result
+        self.num_pending -= 1
+        return result
+
+    def get_results(self):
+        """Results of the evaluations done so far, each a Bunch as
+        returned by Train.run_dev_eval with the ckpt_path."""
+        results = []
+        while self.num_pending:
+            try:
+                results.append(self.get_result(block=False))
+            except queue.Empty:
+                break
+        return results
+
+    def close(self):
+        """Wait for the pending evaluations and stop the evaluator. Returns
+        the results not yet fetched."""
+        results = []
+        while self.num_pending:
+            results.append(self.get_result(block=True))
+        self.ckpt_queue.put(None)
+        self.process.join()
+        return results
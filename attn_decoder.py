@@ -11,6 +11,7 @@ from __future__ import print_function
 import tensorflow as tf
 
 from tensorflow.contrib.rnn.python.ops.core_rnn_cell import _linear
+import data_utils
 from decoder import Decoder
 from base_params import BaseParams
 
@@ -27,11 +28,13 @@ class AttnDecoder(Decoder, BaseParams):
         params['ind_softmax'] = False
         return params
 
-    def __init__(self, isTraining, params=None, scope=None):
-        """Initializer."""
+    def __init__(self, isTraining, params=None, scope=None, teacher_forcing=False):
+        """Initializer. With teacher_forcing, the eval decoder is fed the
+        ground truth instead of its own predictions, e.g. for the dev loss."""
         super(AttnDecoder, self).__init__(isTraining=isTraining, params=params)
         # No output projection required in attention decoder
         self.scope = scope
+        self.teacher_forcing = teacher_forcing
         self.cell = self.get_cell()
 
     def __call__(self, decoder_inp, seq_len,
@@ -44,6 +47,8 @@ class AttnDecoder(Decoder, BaseParams):
 
         with tf.variable_scope(scope):
             decoder_inputs, loop_function = self.prepare_decoder_input(decoder_inp)
+            if self.teacher_forcing:
+                loop_function = None
             lm_cell = self.get_cell(hidden_size=params.lm_hidden_size)
 
         # TensorArray is used to do dynamic looping over decoder input
@@ -125,8 +130,13 @@ class AttnDecoder(Decoder, BaseParams):
                             output = _linear([proj_output], self.params.vocab_size, True)
 
 
-                    if not self.isTraining:
+                    if not (self.isTraining or self.teacher_forcing):
                         lm_input = loop_function(output)
+                        # Greedy decoding of an element is done once it emits
+                        # EOS, and raw_rnn stops once all elements are done
+                        emitted_eos = tf.equal(tf.argmax(output, 1, output_type=tf.int32),
+                                               data_utils.EOS_ID)
+                        elements_finished = tf.logical_or(elements_finished, emitted_eos)
                     else:
                         if loop_function is not None:
                             random_prob = tf.random_uniform([])
@@ -5,19 +5,53 @@ import numpy as np
 from num_utils import sigmoid
 
 class BasicLSTM(object):
-    """Implementation of the basic LSTM cell from tensorflow."""
+    """Implementation of the basic LSTM cell from tensorflow.
 
-    def __init__(self, weight, bias):
+    Inputs and states can either be vectors or matrices with one row per
+    hypothesis, in which case all the rows are advanced with a single matmul.
+    """
+
+    def __init__(self, weight, bias, dtype=None):
         self.lstm_w = weight
         self.lstm_b = bias
+        # Dtype of the states, the weights are upcast to it in the matmuls
+        self.dtype = (weight.dtype if dtype is None else dtype)
+        self.input_gates = None
+        self.recurrent_w = None
 
     def __call__(self, x, lstm_state):
         c, h = lstm_state
-        x_h = np.concatenate((x, h), axis=0)
-        i, j, f, o = np.split(
-            np.matmul(x_h, self.lstm_w) + self.lstm_b, 4)
+        x_h = np.concatenate((x, h), axis=-1)
+        return self.apply_gates(np.matmul(x_h, self.lstm_w) + self.lstm_b, c)
+
+    def apply_gates(self, gates, c):
+        """Compute the next state given the gate pre-activations."""
+        i, j, f, o = np.split(gates, 4, axis=-1)
         f_gate = sigmoid(f + 1)   # 1 for forget bias
         new_c = (np.multiply(c, f_gate) +
                  np.multiply(sigmoid(i), np.tanh(j)))
         new_h = np.multiply(sigmoid(o), np.tanh(new_c))
         return (new_c, new_h)
+
+    def precompute_input_gates(self, embedding):
+        """Precompute the input's contribution to the gates for every row of
+        the embedding matrix, for cells whose input is always an embedding."""
+        input_size = embedding.shape[1]
+        input_gates = (np.matmul(embedding.astype(self.dtype),
+                                 self.lstm_w[:input_size].astype(self.dtype)) + self.lstm_b)
+        # The table is stored with the same precision as the weights
+        self.input_gates = input_gates.astype(self.lstm_w.dtype)
+        self.recurrent_w = self.lstm_w[input_size:]
+
+    def step_with_ids(self, input_ids, lstm_state):
+        """Same as __call__ with x = embedding[input_ids], but only the
+        recurrent part of the gates is computed via matmul."""
+        c, h = lstm_state
+        gates = self.input_gates[input_ids] + np.matmul(h, self.recurrent_w)
+        return self.apply_gates(gates, c)
+
+    def zero_state(self, batch_size):
+        """Zero state for a batch of batch_size rows."""
+        h_size = self.lstm_w.shape[1] // 4
+        return (np.zeros((batch_size, h_size), dtype=self.dtype),
+                np.zeros((batch_size, h_size), dtype=self.dtype))
@@ -0,0 +1,57 @@
+"""Opt-in timers for the phases of the numpy beam search."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from timeit import default_timer
+
+
+class PhaseProfiler(object):
+    """Accumulates the time spent in each phase of beam search.
+
+    The phases are timed as laps: start() marks the beginning of a phase and
+    each lap(phase) charges the time since the previous mark to phase. When
+    disabled, start() and lap() return without reading the clock."""
+
+    PHASES = ["setup", "lstm", "attention", "softmax", "lm", "top_k", "bookkeeping"]
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.last_time = None
+        self.reset()
+
+    def reset(self):
+        """Zero the accumulated times and lap counts."""
+        self.times = dict((phase, 0.0) for phase in self.PHASES)
+        self.counts = dict((phase, 0) for phase in self.PHASES)
+
+    def start(self):
+        if self.enabled:
+            self.last_time = default_timer()
+
+    def lap(self, phase):
+        if self.enabled:
+            cur_time = default_timer()
+            self.times[phase] += cur_time - self.last_time
+            self.counts[phase] += 1
+            self.last_time = cur_time
+
+    def merge(self, times, counts):
+        """Add the times and counts of another profiler, e.g. of a worker."""
+        for phase in self.PHASES:
+            self.times[phase] += times[phase]
+            self.counts[phase] += counts[phase]
+
+    def summary(self):
+        """Total, per lap and fraction of the time of each phase."""
+        total_time = sum(self.times.values())
+        phases = {}
+        for phase in self.PHASES:
+            phases[phase] = {
+                "seconds": self.times[phase],
+                "laps": self.counts[phase],
+                "ms_per_lap": (1e3 * self.times[phase] / self.counts[phase]
+                               if self.counts[phase] else 0.0),
+                "fraction": (self.times[phase] / total_time if total_time else 0.0)}
+        return {"total_seconds": total_time, "phases": phases}
@@ -3,18 +3,25 @@ from copy import deepcopy
 
 import numpy as np
 
-import tf_utils
 import data_utils
+import weight_bundle
 
-from beam_entry import BeamEntry
-from num_utils import softmax
+from num_utils import softmax, log_softmax
 from basic_lstm import BasicLSTM
+from beam_trie import BeamTrie
+from lm_cache import LMStateCache, FNV_OFFSET, extend_prefix_keys
+from beam_profiler import PhaseProfiler
+from shortlist import OutputShortlist
+from ngram_lm import NgramLM
 from base_params import BaseParams
 
+# Floor of the cumulative attention of a frame in the coverage score
+MIN_COVERAGE_ATTN = 1e-10
+
 
 class BeamSearch(BaseParams):
-    """Implementation of beam search for the attention decoder assuming a
-    batch size of 1."""
+    """Implementation of beam search for the attention decoder. Utterances can
+    either be decoded one at a time or as a batch via decode_batch."""
 
     @classmethod
     def class_params(cls):
@@ -23,34 +30,151 @@ class BeamSearch(BaseParams):
         params['beam_size'] = 4
         params['lm_weight'] = 0.0
         params['lm_path'] = ""
+        # The LM at lm_path is either an LSTM LM checkpoint ("lstm") or an
+        # ARPA or compiled n-gram LM ("ngram") over the tokens of lm_vocab_path
+        params['lm_type'] = "lstm"
+        params['lm_vocab_path'] = ""
         params['word_ins_penalty'] = 0#np.arange(-1.0, 1.05, 0.05)
         params['cov_penalty'] = 0.0
+        params['decode_batch_size'] = 1
+        params['decode_workers'] = 1
+        # Number of batches queued for beam search while the encoder runs,
+        # with 0 running the encoder over all the data first
+        params['pipeline_queue_size'] = 0
+        params['lm_cache_size'] = 10000
+        params['precision'] = "float64"
+        params['save_nbest'] = False
+        # Pruning of the live hypotheses, disabled with 0
+        params['prune_threshold'] = 0.0
+        params['max_active'] = 0
+        params['early_stop'] = False
+        # Maximum output length, further limited to max_len_ratio outputs per
+        # encoder frame of the utterance if max_len_ratio > 0
+        params['max_output_len'] = 120
+        params['max_len_ratio'] = 0.0
+        # Attention over a window of frames around the previous attention
+        # peak, disabled with 0
+        params['attn_window'] = 0
+        params['attn_fallback_prob'] = 0.3
+        # Time the phases of decoding
+        params['profile'] = False
+        # Compute the decoder output softmax over a shortlist of tokens
+        # except at every shortlist_full_every steps, disabled with 0
+        params['shortlist_size'] = 0
+        params['shortlist_full_every'] = 10
 
         return params
 
-    def __init__(self, ckpt_path, search_params=None):
-        """Initialize the model."""
-        self.dec_params = self.map_dec_variables(self.get_model_params(ckpt_path))
-
+    # Compute and storage dtypes of the numpy decoder for each precision. With
+    # float16 the weights and encoder outputs are stored in half precision and
+    # upcast to float32 in the matmuls.
+    PRECISION_DTYPES = {"float64": (np.float64, np.float64),
+                        "float32": (np.float32, np.float32),
+                        "float16": (np.float32, np.float16)}
+
+    def __init__(self, ckpt_path=None, search_params=None, dec_params=None,
+                 lm_params=None):
+        """Initialize the model. The decoder and LM params are loaded from the
+        checkpoints unless already loaded ones are passed. The LM is only
+        loaded once search params using it are set. The precision search param
+        is fixed at initialization."""
         if search_params is None:
-            self.search_params = self.class_params()
-        else:
-            self.search_params = search_params
+            search_params = self.class_params()
+        self.compute_dtype, self.storage_dtype =\
+            self.PRECISION_DTYPES[search_params.precision]
+
+        if dec_params is None:
+            dec_params = self.load_params(ckpt_path, self.map_dec_variables)
+        self.dec_params = self.cast_params(dec_params, self.storage_dtype)
+        self.create_lstm_cells()
+
+        self.lm_params = None
+        self.lm_lstm = None
+        self.ngram_lm = None
+        if lm_params is not None:
+            self.set_lm_params(lm_params)
+        self.beam_trie = BeamTrie()
+        self.lm_cache = LMStateCache(search_params.lm_cache_size)
+        self.profiler = PhaseProfiler()
+        self.dec_shortlist = None
+        self.shortlist_size = 0
+        self.set_search_params(search_params)
+        print ("Using a beam size of %d" %self.search_params.beam_size)
 
+    def set_search_params(self, search_params):
+        """Set the search params, which can be changed between decoding runs."""
+        self.search_params = search_params
+        self.profiler.enabled = search_params.profile
         if self.search_params.lm_path is None or (self.search_params.lm_weight == 0.0):
             self.use_lm = False
             print ("No separate LM used")
         else:
             self.use_lm = True
-        self.lm_params = self.map_lm_variables(
-            self.get_model_params(self.search_params.lm_path))
-        print ("Using a beam size of %d" %self.search_params.beam_size)
+            if self.search_params.lm_type == "ngram":
+                if self.ngram_lm is None:
+                    self.ngram_lm = NgramLM.load(self.search_params.lm_path,
+                                                 self.search_params.lm_vocab_path)
+            elif self.lm_params is None:
+                self.set_lm_params(self.load_params(self.search_params.lm_path,
+                                                    self.map_lm_variables))
+        if self.lm_cache.capacity != search_params.lm_cache_size:
+            self.lm_cache.resize(search_params.lm_cache_size)
+        self.update_shortlist()
+
+    def update_shortlist(self):
+        """Create the decoder output shortlist for the shortlist_size search
+        param. Its prior tokens are the ones with the largest output bias,
+        which acts as a unigram prior, and EOS."""
+        shortlist_size = self.search_params.shortlist_size
+        if shortlist_size <= 0:
+            self.dec_shortlist = None
+        elif self.dec_shortlist is None or self.shortlist_size != shortlist_size:
+            out_b = self.dec_params.out_b
+            num_tokens = min(shortlist_size, out_b.shape[0])
+            prior_tokens = np.argpartition(-out_b, num_tokens - 1)[:num_tokens]
+            self.dec_shortlist = OutputShortlist(
+                self.dec_params.out_w, out_b, np.union1d(prior_tokens, [data_utils.EOS_ID]))
+        self.shortlist_size = shortlist_size
+
+    def set_lm_params(self, lm_params):
+        """Set the LM params and create the LM cell."""
+        self.lm_params = self.cast_params(lm_params, self.storage_dtype)
+        self.lm_lstm = BasicLSTM(self.lm_params.lstm_w, self.lm_params.lstm_b,
+                                 dtype=self.compute_dtype)
+        # The LM input is always the embedding of the previous output, hence
+        # its contribution to the gates is a lookup
+        self.lm_lstm.precompute_input_gates(self.lm_params.embedding)
 
-    def get_model_params(self, ckpt_path):
+    @classmethod
+    def load_params(cls, ckpt_path, map_variables):
+        """Load params from the weight bundle of the checkpoint if it's current,
+        and otherwise from the TF checkpoint via map_variables."""
+        if weight_bundle.is_bundle_current(ckpt_path):
+            print ("Loading weight bundle of %s" %ckpt_path)
+            return weight_bundle.load_bundle(ckpt_path)
+        return map_variables(cls.get_model_params(ckpt_path))
+
+    @staticmethod
+    def cast_params(params, dtype):
+        """Cast the params to dtype, without copying the ones already in dtype.
+        Hence memory-mapped float32 bundle arrays are only kept mapped with
+        float32 storage."""
+        cast_params = Bunch()
+        for name, value in params.items():
+            if value is not None:
+                value = value.astype(dtype, copy=False)
+            cast_params[name] = value
+        return cast_params
+
+    @staticmethod
+    def get_model_params(ckpt_path):
         """Loads the decoder params"""
+        # TF is only needed for reading the checkpoints
+        import tf_utils
         return tf_utils.get_matching_variables("rnn_decoder_char", ckpt_path)
 
-    def map_dec_variables(self, var_dict):
+    @staticmethod
+    def map_dec_variables(var_dict):
         """Map loaded tensors from names to variables."""
         params = Bunch()
         params.lm_lstm_w = np.asarray(var_dict[
@@ -108,7 +232,8 @@ class BeamSearch(BaseParams):
         print ("Total parameters in decoder (in million): %.2f" %(total_elems/float(1e6)))
         return params
 
-    def map_lm_variables(self, var_dict):
+    @staticmethod
+    def map_lm_variables(var_dict):
         """Map loaded tensors from names to variables."""
         params = Bunch()
         params.lstm_w = np.asarray(var_dict[
@@ -134,208 +259,549 @@ class BeamSearch(BaseParams):
         return params
 
 
-    def calc_attention(self, encoder_hidden_states):
+    def create_lstm_cells(self):
+        """Create the numpy LSTM cells of the decoder."""
+        params = self.dec_params
+
+        self.dec_lstm = BasicLSTM(params.dec_lstm_w, params.dec_lstm_b,
+                                  dtype=self.compute_dtype)
+        self.dec_lm_lstm = BasicLSTM(params.lm_lstm_w, params.lm_lstm_b,
+                                     dtype=self.compute_dtype)
+
+        # The inputs of the decoder LM are always embeddings of the previous
+        # outputs, hence their contribution to the gates is a lookup
+        self.dec_lm_lstm.precompute_input_gates(params.embedding)
+
+    def calc_attention(self, encoder_hidden_states, seq_lens):
         """Context vector calculation function. Here the encoder's contribution
         to attention remains the same and can be computed earlier. We perform
-        currying to return a function that takes as input just the decoder state."""
+        currying to return a function that takes as input just the decoder state.
+
+        encoder_hidden_states is a B x T x H tensor padded to the longest
+        utterance and seq_lens holds the true length of each utterance."""
 
         params = self.dec_params
-        if len(encoder_hidden_states.shape) == 3:
-            # Squeeze the first dimension
-            encoder_hidden_states = np.squeeze(encoder_hidden_states, axis=0)
+        search_params = self.search_params
+        window_size = search_params.attn_window
+
+        # B x T x Attn_vec_size
+        attn_enc_term = np.matmul(encoder_hidden_states,
+                                  params.attn_enc_w.astype(self.compute_dtype, copy=False))
+        # B x T mask of valid encoder frames
+        attn_mask = (np.arange(encoder_hidden_states.shape[1])[np.newaxis, :] <
+                     seq_lens[:, np.newaxis])
+
+        def attend(attn_dec_term, utts, frames, valid_frames):
+            """Attention of N decoder states over the N x W encoder frames,
+            where the invalid frames are masked out."""
+            attn_sum = np.tanh(attn_enc_term[utts[:, np.newaxis], frames] +
+                               attn_dec_term[:, np.newaxis, :]) # N x W x A
+            attn_logits = np.matmul(attn_sum, params.attn_v)  # N x W
+            attn_logits[~valid_frames] = -np.inf
+            attn_probs = softmax(attn_logits)
 
-        # T x Attn_vec_size
-        attn_enc_term = np.matmul(encoder_hidden_states, params.attn_enc_w)
+            context_vec = np.matmul(attn_probs[:, np.newaxis, :],
+                                    encoder_hidden_states[utts[:, np.newaxis], frames])[:, 0, :]  # N x H
+            return (context_vec, attn_probs)
 
-        def attention(dec_state):
-            attn_dec_term = (np.matmul(dec_state, params.attn_dec_w) +
-                             params.attn_dec_b)  # T x A
-            attn_sum = np.tanh(attn_enc_term + attn_dec_term) # T x A
-            attn_logits = np.squeeze(np.matmul(attn_sum, params.attn_v))  # T
-            attn_probs = softmax(attn_logits)
+        def attention(dec_state, row_utts, attn_peaks=None):
+            """Attention for the N x H matrix of decoder states where row i
+            belongs to the utterance row_utts[i].
 
-            context_vec = np.matmul(attn_probs, encoder_hidden_states)
-            # The attention probabilities are necessary for coverage penalty calculation
+            With a positive attn_window, the rows with the frame of the
+            previous attention peak in attn_peaks (-1 if none) only score a
+            window of attn_window frames around it. The rows whose windowed
+            peak probability is below attn_fallback_prob use full attention."""
+            # Frames beyond the longest active utterance are all padding
+            max_len = np.max(seq_lens[row_utts])
+            attn_dec_term = (np.matmul(dec_state, params.attn_dec_w) +
+                             params.attn_dec_b)  # N x A
+
+            context_vec = np.empty((row_utts.shape[0], encoder_hidden_states.shape[2]),
+                                   dtype=attn_dec_term.dtype)
+            attn_probs = np.zeros((row_utts.shape[0], max_len), dtype=attn_dec_term.dtype)
+            full_rows = np.ones(row_utts.shape[0], dtype=bool)
+            if window_size > 0 and attn_peaks is not None and window_size < max_len:
+                win_rows = np.nonzero(attn_peaks >= 0)[0]
+                win_utts = row_utts[win_rows]
+                # Windows lie mostly ahead of the peak as attention moves
+                # monotonically, and are kept within the utterance
+                win_starts = np.clip(attn_peaks[win_rows] - window_size // 4, 0,
+                                     np.maximum(seq_lens[win_utts] - window_size, 0))
+                frames = win_starts[:, np.newaxis] + np.arange(window_size)[np.newaxis, :]
+                valid_frames = frames < seq_lens[win_utts][:, np.newaxis]
+                frames = np.minimum(frames, max_len - 1)
+                win_context_vec, win_attn_probs = attend(
+                    attn_dec_term[win_rows], win_utts, frames, valid_frames)
+
+                confident = (np.max(win_attn_probs, axis=1) >=
+                             search_params.attn_fallback_prob)
+                win_rows, frames = win_rows[confident], frames[confident]
+                context_vec[win_rows] = win_context_vec[confident]
+                attn_probs[win_rows[:, np.newaxis], frames] = np.where(
+                    valid_frames[confident], win_attn_probs[confident], 0)
+                full_rows[win_rows] = False
+
+            full_rows = np.nonzero(full_rows)[0]
+            if full_rows.shape[0] > 0:
+                full_utts = row_utts[full_rows]
+                frames = np.broadcast_to(np.arange(max_len), (full_rows.shape[0], max_len))
+                context_vec[full_rows], attn_probs[full_rows] = attend(
+                    attn_dec_term[full_rows], full_utts, frames,
+                    attn_mask[full_utts, :max_len])
+
+            # The attention probabilities are necessary for coverage penalty
+            # calculation and for placing the attention windows
             return (context_vec, attn_probs)
 
         return attention
 
-    def top_k_setup_with_lm(self, encoder_hidden_states):
+    def top_k_setup_with_lm(self, encoder_hidden_states, seq_lens):
         params = self.dec_params
-        lm_params = self.lm_params
         search_params = self.search_params
 
         # Set up decoder components
-        dec_lstm = BasicLSTM(params.dec_lstm_w, params.dec_lstm_b)
-        dec_lm_lstm = BasicLSTM(params.lm_lstm_w, params.lm_lstm_b)
-        attention_call = self.calc_attention(encoder_hidden_states)
-
-        # Set up LM components
-        lm_lstm = BasicLSTM(lm_params.lstm_w, lm_params.lstm_b)
-        # LM uses a zero attn vector
-        zero_attn = np.zeros(encoder_hidden_states.shape[1])
-
-        def get_top_k(x, x_lm, state_list, context_vec,
-                      beam_size=search_params.beam_size):
-            dec_state, dec_lm_state, lm_state = state_list
-
-            dec_lm_state = dec_lm_lstm(x, dec_lm_state)
+        dec_lstm = self.dec_lstm
+        dec_lm_lstm = self.dec_lm_lstm
+        attention_call = self.calc_attention(encoder_hidden_states, seq_lens)
+        profiler = self.profiler
+
+        def get_top_k(prev_outputs, prefix_keys, row_utts, state_list, context_vec,
+                      beam_size=search_params.beam_size, attn_peaks=None,
+                      full_softmax=True):
+            """Run one decoder step for all the N hypotheses of the batch.
+
+            prev_outputs is the N sized vector of the last output of each
+            hypothesis, prefix_keys are the hash keys of the hypotheses'
+            prefixes including prev_outputs, row_utts maps the hypotheses to
+            their utterances, and the states and context vectors are stacked
+            N x H matrices. attn_peaks are the frames of the previous
+            attention peak of the hypotheses for windowed attention. With a
+            decoder shortlist, the softmax is over the full vocab only if
+            full_softmax is set, and the last entry of state_list holds the
+            log ratio of the full to the shortlist normalizer. Returns
+            the N x beam_size matrices of top indices and their scores for
+            each hypothesis alongwith the next states and the decoder and LM
+            log probs and attention used for the scores."""
+            dec_state, dec_lm_state, lm_state, (log_norm_ratios,) = state_list
+
+            dec_lm_state = dec_lm_lstm.step_with_ids(prev_outputs, dec_lm_state)
             dec_lm_output = dec_lm_state[1]
 
             if params.simple_w is not None:
                 dec_lm_output = (np.matmul(dec_lm_output, params.simple_w) +
                                  params.simple_b)
-            context_lm_comb = np.concatenate((dec_lm_output, context_vec), axis=0)
+            context_lm_comb = np.concatenate((dec_lm_output, context_vec), axis=1)
             x_dec = np.matmul(context_lm_comb, params.inp_w) + params.inp_b
 
             dec_state = dec_lstm(x_dec, dec_state)
+            profiler.lap("lstm")
 
-            context_vec, _ = attention_call(dec_state[0])
-            context_dec_comb = np.concatenate((dec_state[0], context_vec), axis=0)
+            context_vec, attn_probs = attention_call(dec_state[0], row_utts, attn_peaks)
+            profiler.lap("attention")
+            context_dec_comb = np.concatenate((dec_state[0], context_vec), axis=1)
             proj_output = np.matmul(context_dec_comb, params.attn_proj_w) + params.attn_proj_b
-            output_dec_probs = softmax(np.matmul(proj_output, params.out_w) +
-                                       params.out_b)
-            log_dec_probs = np.log(output_dec_probs)
-
-            lm_state = lm_lstm(x_lm, lm_state)
-            lm_output = lm_state[1]
-            if lm_params.simple_w is not None:
-                lm_output = (np.matmul(lm_output, lm_params.simple_w) +
-                             lm_params.simple_b)
-            output_lm_probs = softmax(np.matmul(lm_output, lm_params.out_w) +
-                                      lm_params.out_b)
-            log_lm_probs = np.log(output_lm_probs)
-            combined_log_probs = log_dec_probs + search_params.lm_weight * log_lm_probs
-
-            length_loss = 0.0
-
-            combined_score = combined_log_probs + length_loss
-
-            top_k_indices = np.argpartition(combined_score, -beam_size)[-beam_size:]
+            dec_shortlist = self.dec_shortlist
+            if dec_shortlist is None:
+                log_dec_probs = log_softmax(np.matmul(proj_output, params.out_w) +
+                                            params.out_b)
+            elif full_softmax:
+                log_dec_probs = dec_shortlist.full_log_softmax(proj_output)
+            else:
+                log_dec_probs = dec_shortlist.log_softmax(proj_output, log_norm_ratios)
+            profiler.lap("softmax")
 
-            # Return indices, their score, and the lstm state
-            return (top_k_indices, combined_log_probs[top_k_indices],
-                    combined_score[top_k_indices], [dec_state,
-                    dec_lm_state, lm_state], context_vec)
+            if self.use_lm:
+                lm_state, log_lm_probs = self.run_cached_lm(prefix_keys, prev_outputs,
+                                                            lm_state)
+                combined_log_probs = log_dec_probs + search_params.lm_weight * log_lm_probs
+            else:
+                log_lm_probs = np.zeros_like(log_dec_probs)
+                combined_log_probs = log_dec_probs
+            profiler.lap("lm")
+
+            if dec_shortlist is not None and not full_softmax:
+                # Only the shortlist tokens have finite scores
+                shortlist_tokens = dec_shortlist.tokens
+                top_k_indices = shortlist_tokens[np.argpartition(
+                    combined_log_probs[:, shortlist_tokens], -beam_size, axis=1)[:, -beam_size:]]
+            else:
+                top_k_indices = np.argpartition(combined_log_probs, -beam_size,
+                                                axis=1)[:, -beam_size:]
+            top_k_scores = np.take_along_axis(combined_log_probs, top_k_indices, axis=1)
+            if dec_shortlist is not None and full_softmax:
+                # Until the next full pass, the shortlist also has the top
+                # tokens of this one
+                dec_shortlist.set_context_tokens(np.unique(top_k_indices))
+                log_norm_ratios = dec_shortlist.get_log_norm_ratios(log_dec_probs)
+            profiler.lap("top_k")
+
+            # Return indices, their score, the lstm states and the score parts
+            return (top_k_indices, top_k_scores,
+                    [dec_state, dec_lm_state, lm_state, (log_norm_ratios,)], context_vec,
+                    (log_dec_probs, log_lm_probs, attn_probs))
 
         return get_top_k
 
-
-    def __call__(self, encoder_hidden_states):
-        """Beam search for batch_size=1"""
-        params = self.dec_params
-        search_params = self.search_params
-
+    def run_lm(self, prev_outputs, lm_state):
+        """Run the LM for one step. Returns the next LM state and the log probs."""
+        if self.search_params.lm_type == "ngram":
+            lm_state, log_lm_probs = self.ngram_lm.step(prev_outputs, lm_state)
+            return lm_state, log_lm_probs.astype(self.compute_dtype, copy=False)
         lm_params = self.lm_params
-        get_top_k_fn = self.top_k_setup_with_lm(encoder_hidden_states)
-
-        x = params.embedding[data_utils.GO_ID]
-        x_lm = lm_params.embedding[data_utils.GO_ID]
-
-        # Initialize Decoder states
-        h_size = params.dec_lstm_w.shape[1]/4
-        zero_dec_state = (np.zeros(h_size), np.zeros(h_size))
 
-        dec_lm_h_size = params.lm_lstm_w.shape[1]/4
-        zero_dec_lm_state = (np.zeros(dec_lm_h_size), np.zeros(dec_lm_h_size))
-
-        # Initialize LM state
-        lm_h_size = lm_params.lstm_w.shape[1]/4
-        zero_lm_state = (np.zeros(lm_h_size), np.zeros(lm_h_size))
-
-        zero_attn = np.zeros(encoder_hidden_states.shape[1])
-
-        # Maintain a tuple of (output_indices, score, encountered EOS?)
-        output_list = []
-        final_output_list = []
-        k = search_params.beam_size  # Represents the current beam size
+        lm_state = self.lm_lstm.step_with_ids(prev_outputs, lm_state)
+        lm_output = lm_state[1]
+        if lm_params.simple_w is not None:
+            lm_output = (np.matmul(lm_output, lm_params.simple_w) +
+                         lm_params.simple_b)
+        log_lm_probs = log_softmax(np.matmul(lm_output, lm_params.out_w) +
+                                   lm_params.out_b)
+        return lm_state, log_lm_probs
+
+    def run_cached_lm(self, prefix_keys, prev_outputs, lm_state):
+        """Run the LM for one step while reusing the outputs of the prefixes
+        seen before, within and across utterances. The LM output depends only
+        on the prefix, so the LM is only run for one row of each new prefix."""
+        lm_cache = self.lm_cache
+        if lm_cache.capacity <= 0:
+            return self.run_lm(prev_outputs, lm_state)
+
+        prefix_key_list = prefix_keys.tolist()
+        entries = [lm_cache.get(key) for key in prefix_key_list]
+        miss_rows = np.array([idx for idx, entry in enumerate(entries) if entry is None],
+                             dtype=np.int64)
+        if miss_rows.shape[0] > 0:
+            miss_keys, unique_idx = np.unique(prefix_keys[miss_rows], return_index=True)
+            unique_rows = miss_rows[unique_idx]
+            miss_state, miss_log_probs = self.run_lm(
+                prev_outputs[unique_rows], tuple(state[unique_rows] for state in lm_state))
+
+            new_entries = {}
+            for idx, key in enumerate(miss_keys.tolist()):
+                new_entries[key] = (miss_state[0][idx], miss_state[1][idx], miss_log_probs[idx])
+                lm_cache.put(key, new_entries[key])
+            for row in miss_rows.tolist():
+                entries[row] = new_entries[prefix_key_list[row]]
+
+        lm_state = (np.stack([entry[0] for entry in entries]),
+                    np.stack([entry[1] for entry in entries]))
+        log_lm_probs = np.stack([entry[2] for entry in entries])
+        return lm_state, log_lm_probs
+
+    def lm_zero_state(self, batch_size):
+        """Zero LM state, which is empty when the LM isn't used."""
+        if self.use_lm and self.search_params.lm_type == "ngram":
+            return self.ngram_lm.zero_state(batch_size)
+        if self.use_lm:
+            return self.lm_lstm.zero_state(batch_size)
+        empty_state = np.zeros((batch_size, 0), dtype=self.compute_dtype)
+        return (empty_state, empty_state)
+
+    def pad_encoder_states(self, hidden_states_list):
+        """Pad the T x H encoder outputs of utterances to a B x T x H tensor."""
+        seq_lens = np.array([hidden_states.shape[0] for hidden_states in hidden_states_list])
+        hidden_size = hidden_states_list[0].shape[1]
+        padded_states = np.zeros((len(hidden_states_list), np.max(seq_lens), hidden_size),
+                                 dtype=self.storage_dtype)
+        for idx, hidden_states in enumerate(hidden_states_list):
+            padded_states[idx, :seq_lens[idx], :] = hidden_states
+        return padded_states, seq_lens
+
+    def __call__(self, encoder_hidden_states, return_nbest=False):
+        """Beam search for batch_size=1."""
+        if len(encoder_hidden_states.shape) == 3:
+            # Squeeze the first dimension
+            encoder_hidden_states = np.squeeze(encoder_hidden_states, axis=0)
+        if return_nbest:
+            output_seqs, nbest_lists = self.decode_batch([encoder_hidden_states],
+                                                         return_nbest=True)
+            return output_seqs[0], nbest_lists[0]
+        return self.decode_batch([encoder_hidden_states])[0]
+
+    @staticmethod
+    def coverage_score(cum_attn_probs, seq_lens):
+        """Coverage of the encoder frames by the cumulative attention,
+        sum_t log(min(cum_attn_t, 1)) over the valid frames. The attention of
+        a frame is floored at MIN_COVERAGE_ATTN so that the frames never
+        attended, e.g. outside the attention windows, keep it finite."""
+        valid_frames = (np.arange(cum_attn_probs.shape[1])[np.newaxis, :] <
+                        seq_lens[:, np.newaxis])
+        clipped_attn = np.clip(np.where(valid_frames, cum_attn_probs, 1.0),
+                               MIN_COVERAGE_ATTN, 1.0)
+        return np.sum(np.log(clipped_attn), axis=1)
+
+    @staticmethod
+    def init_decode_stats(num_utts):
+        """Zeroed decode stats of num_utts utterances."""
+        return Bunch(steps=np.zeros(num_utts, dtype=np.int64),
+                     expansions=np.zeros(num_utts, dtype=np.int64),
+                     dropped=np.zeros(num_utts, dtype=np.int64),
+                     early_stop_steps=np.full(num_utts, -1, dtype=np.int64),
+                     hit_max_len=np.zeros(num_utts, dtype=bool))
+
+    def get_pruned(self, next_utts, next_k_scores, finished):
+        """Mask of the live continuations pruned by the score threshold
+        relative to the best continuation of their utterance, or by the
+        maximum number of live hypotheses per utterance. The continuations
+        of an utterance are contiguous and in decreasing order of score."""
+        search_params = self.search_params
+        pruned = np.zeros(next_utts.shape[0], dtype=bool)
+        utt_starts = np.searchsorted(next_utts, next_utts)
+        if search_params.prune_threshold > 0:
+            best_scores = next_k_scores[utt_starts]
+            pruned |= (next_k_scores < best_scores - search_params.prune_threshold)
+        if search_params.max_active > 0:
+            is_live = (~finished).astype(np.int64)
+            live_count = np.cumsum(is_live)
+            live_rank = live_count - (live_count[utt_starts] - is_live[utt_starts]) - 1
+            pruned |= (live_rank >= search_params.max_active)
+        return pruned & (~finished)
+
+    def max_future_gain(self, step_count, max_lens):
+        """Upper bound, per utterance, on how much the score of a live
+        hypothesis can still increase after step step_count. The decoder and LM
+        log probs can only decrease the score, and so can a positive coverage
+        penalty as the coverage is at most 0, so only a positive word
+        insertion penalty counts. The penalty of each later step s < max_len
+        is word_ins_penalty * (s + 1)."""
+        search_params = self.search_params
+        if search_params.lm_weight < 0 or search_params.cov_penalty < 0:
+            return np.full(max_lens.shape[0], np.inf)
+        first_step = step_count + 1
+        last_step = np.maximum(max_lens, first_step)
+        # Sum of (s + 1) for first_step <= s < last_step
+        step_sums = (last_step * (last_step + 1) - first_step * (first_step + 1)) / 2.0
+        return max(search_params.word_ins_penalty, 0) * step_sums
+
+    def get_max_lens(self, seq_lens):
+        """Maximum output length of each utterance given its encoder length."""
+        search_params = self.search_params
+        max_lens = np.full(seq_lens.shape[0], search_params.max_output_len, dtype=np.int64)
+        if search_params.max_len_ratio > 0:
+            ratio_lens = np.ceil(search_params.max_len_ratio * seq_lens).astype(np.int64)
+            max_lens = np.minimum(max_lens, np.maximum(ratio_lens, 1))
+        return max_lens
+
+    def decode_batch(self, hidden_states_list, return_nbest=False):
+        """Beam search for a batch of utterances given their T x H encoder outputs.
+
+        The hypotheses of all the utterances are advanced together with their
+        states stacked as rows of N x H matrices, where the rows of an
+        utterance are contiguous and row_utts maps each row to its utterance.
+        An utterance stops contributing rows once all its hypotheses finish.
+
+        Finished hypotheses, including the ones cut off at the maximum
+        length, are ranked by their score plus cov_penalty times their
+        attention coverage.
+
+        Returns the best output sequence of each utterance. With return_nbest,
+        the N-best list of each utterance is also returned as a Bunch with the
+        index_seqs of the hypotheses, sorted by score, and their scores split
+        into the decoder and LM log probs, length and attention coverage.
+
+        Statistics of the decoding of each utterance are stored in
+        decode_stats: the number of decoding steps, the hypotheses expanded,
+        the live hypotheses dropped by pruning or early stopping before
+        being expanded further, the step of early stopping (-1 if none) and
+        whether the best output was cut off at the maximum output length. With
+        the profile search param, the time of each phase of decoding is
+        accumulated in profiler."""
+        search_params = self.search_params
+        profiler = self.profiler
+        profiler.start()
+
+        encoder_hidden_states, seq_lens = self.pad_encoder_states(hidden_states_list)
+        batch_size = len(hidden_states_list)
+        get_top_k_fn = self.top_k_setup_with_lm(encoder_hidden_states, seq_lens)
+        max_lens = self.get_max_lens(seq_lens)
+        full_softmax_every = max(search_params.shortlist_full_every, 1)
+
+        # Start with a single hypothesis per utterance with zero decoder,
+        # decoder LM and LM states
+        state_list = [self.dec_lstm.zero_state(batch_size),
+                      self.dec_lm_lstm.zero_state(batch_size),
+                      self.lm_zero_state(batch_size),
+                      (np.zeros(batch_size),)]
+        context_vec = np.zeros((batch_size, encoder_hidden_states.shape[2]),
+                               dtype=self.compute_dtype)
+        prev_outputs = np.full(batch_size, data_utils.GO_ID, dtype=np.int64)
+        cand_scores = np.zeros(batch_size)
+        row_utts = np.arange(batch_size)
+        # Hash keys of the prefixes of the hypotheses, used for LM caching
+        row_keys = np.full(batch_size, FNV_OFFSET, dtype=np.uint64)
+        # Trie node of the last output of each hypothesis, -1 before any output
+        row_nodes = np.full(batch_size, -1, dtype=np.int64)
+        beam_trie = self.beam_trie
+        beam_trie.reset(capacity=batch_size * search_params.beam_size * np.max(max_lens))
+        # Parts of the score of each hypothesis
+        row_dec_scores = np.zeros(batch_size)
+        row_lm_scores = np.zeros(batch_size)
+        cum_attn_probs = np.zeros((batch_size, encoder_hidden_states.shape[1]),
+                                  dtype=self.compute_dtype)
+        # Frame of the last attention peak of each hypothesis, -1 before any
+        row_peaks = np.full(batch_size, -1, dtype=np.int64)
+
+        # Maintain the utterance, trie node, score and score parts of
+        # finished hypotheses, and whether they were cut off without EOS
+        final_outputs = Bunch(utts=[], nodes=[], scores=[], dec_scores=[],
+                              lm_scores=[], lengths=[], coverages=[], cut_offs=[])
+
+        def add_final_outputs(utts, nodes, scores, dec_scores, lm_scores,
+                              length, final_cum_attn_probs, cut_off=False):
+            """Add the finished hypotheses, whose final score includes the
+            coverage penalty, and return their final scores."""
+            coverages = self.coverage_score(final_cum_attn_probs, seq_lens[utts])
+            scores = scores + search_params.cov_penalty * coverages
+            final_outputs.utts.append(utts)
+            final_outputs.nodes.append(nodes)
+            final_outputs.scores.append(scores)
+            final_outputs.dec_scores.append(dec_scores)
+            final_outputs.lm_scores.append(lm_scores)
+            final_outputs.lengths.append(np.full(utts.shape[0], length, dtype=np.int64))
+            final_outputs.coverages.append(coverages)
+            final_outputs.cut_offs.append(np.full(utts.shape[0], cut_off, dtype=bool))
+            return scores
+
+        # Represents the current beam size of each utterance
+        beam_sizes = np.full(batch_size, search_params.beam_size, dtype=np.int64)
+        best_final_scores = np.full(batch_size, -np.inf)
+        decode_stats = self.init_decode_stats(batch_size)
         step_count = 0
+        profiler.lap("setup")
+
+        while row_utts.shape[0] > 0:
+            k = np.max(beam_sizes)
+            prefix_keys = extend_prefix_keys(row_keys, prev_outputs)
+            top_k_indices, top_k_scores, state_list, context_vec, score_parts =\
+                get_top_k_fn(prev_outputs, prefix_keys, row_utts, state_list,
+                             context_vec, beam_size=k, attn_peaks=row_peaks,
+                             full_softmax=(step_count % full_softmax_every == 0))
+
+            # Scatter the scores of all continuations into a B x (k * k)
+            # matrix where row b has the continuations of utterance b
+            num_rows = np.bincount(row_utts, minlength=batch_size)
+            first_row = np.cumsum(num_rows) - num_rows
+            decode_stats.steps += (num_rows > 0)
+            decode_stats.expansions += num_rows
+            row_pos = np.arange(row_utts.shape[0]) - first_row[row_utts]
+            all_scores = np.full((batch_size, k, k), -np.inf)
+            all_scores[row_utts, row_pos] = cand_scores[:, np.newaxis] + top_k_scores
+            all_scores = np.reshape(all_scores, (batch_size, k * k))
+
+            # Find the top k entries of each utterance in the decreasing order
+            # of score and keep the first beam_sizes[b] of them for utterance b
+            top_k_flat = np.argsort(-all_scores, axis=1, kind="mergesort")[:, :k]
+            selected = np.arange(k)[np.newaxis, :] < beam_sizes[:, np.newaxis]
+            next_utts = np.nonzero(selected)[0]
+            top_k_flat = top_k_flat[selected]
+            # The flat indices are of the form - i * k + j, where i represents
+            # the ith hypothesis of the utterance and j its jth top index
+            orig_cand_indices = first_row[next_utts] + top_k_flat // k
+            next_k_indices = top_k_indices[orig_cand_indices, top_k_flat % k]
+            next_k_scores = all_scores[next_utts, top_k_flat]
+            if step_count > 0:
+                # The word insertion penalty isn't applied at the first step
+                next_k_scores = next_k_scores + search_params.word_ins_penalty * (step_count + 1)
+            profiler.lap("top_k")
+
+            next_nodes = beam_trie.add(next_k_indices, row_nodes[orig_cand_indices])
+
+            log_dec_probs, log_lm_probs, attn_probs = score_parts
+            next_dec_scores = (row_dec_scores[orig_cand_indices] +
+                               log_dec_probs[orig_cand_indices, next_k_indices])
+            next_lm_scores = (row_lm_scores[orig_cand_indices] +
+                              log_lm_probs[orig_cand_indices, next_k_indices])
+            cum_attn_probs[:, :attn_probs.shape[1]] += attn_probs
+            next_cum_attn_probs = cum_attn_probs[orig_cand_indices]
+            row_peaks = np.argmax(attn_probs, axis=1)
+
+            # Sequences ending with EOS are finished. Put them on the final list
+            # and reduce the beam size of their utterances
+            finished = (next_k_indices == data_utils.EOS_ID)
+            finished_scores = add_final_outputs(
+                next_utts[finished], next_nodes[finished], next_k_scores[finished],
+                next_dec_scores[finished], next_lm_scores[finished], step_count + 1,
+                next_cum_attn_probs[finished])
+            beam_sizes -= np.bincount(next_utts[finished], minlength=batch_size)
+
+            # Pruned hypotheses are dropped and reduce the beam size as well
+            dropped = self.get_pruned(next_utts, next_k_scores, finished)
+
+            if search_params.early_stop:
+                # Stop the utterances whose best finished hypothesis can't be
+                # beaten by any of their live hypotheses
+                np.maximum.at(best_final_scores, next_utts[finished], finished_scores)
+                best_live_scores = np.full(batch_size, -np.inf)
+                live = ~(finished | dropped)
+                np.maximum.at(best_live_scores, next_utts[live], next_k_scores[live])
+                stopped = (best_final_scores >=
+                           best_live_scores + self.max_future_gain(step_count, max_lens))
+                stopped &= (best_live_scores > -np.inf)
+                decode_stats.early_stop_steps[stopped] = step_count
+                dropped |= (live & stopped[next_utts])
+
+            beam_sizes -= np.bincount(next_utts[dropped], minlength=batch_size)
+            decode_stats.dropped += np.bincount(next_utts[dropped], minlength=batch_size)
+
+            # Live hypotheses reaching the maximum length of their utterance
+            # are cut off and put on the final list as is
+            cut_off = ~(finished | dropped) & (step_count + 1 >= max_lens[next_utts])
+            add_final_outputs(next_utts[cut_off], next_nodes[cut_off],
+                              next_k_scores[cut_off], next_dec_scores[cut_off],
+                              next_lm_scores[cut_off], step_count + 1,
+                              next_cum_attn_probs[cut_off], cut_off=True)
+            beam_sizes -= np.bincount(next_utts[cut_off], minlength=batch_size)
+
+            # Reindex the beam by the surviving hypotheses
+            live_idx = np.nonzero(~(finished | dropped | cut_off))[0]
+            parent_indices = orig_cand_indices[live_idx]
+            row_nodes = next_nodes[live_idx]
+            row_keys = prefix_keys[parent_indices]
+            row_utts = next_utts[live_idx]
+            prev_outputs = next_k_indices[live_idx]
+            cand_scores = next_k_scores[live_idx]
+            row_dec_scores = next_dec_scores[live_idx]
+            row_lm_scores = next_lm_scores[live_idx]
+            cum_attn_probs = next_cum_attn_probs[live_idx]
+            state_list = [tuple(state[parent_indices] for state in lstm_state)
+                          for lstm_state in state_list]
+            context_vec = context_vec[parent_indices]
+            row_peaks = row_peaks[parent_indices]
 
-        # Run step 0 separately
-        top_k_indices, top_k_model_scores, top_k_scores, state_list, context_vec =\
-            get_top_k_fn(x, x_lm, [zero_dec_state, zero_dec_lm_state, zero_lm_state],
-                         zero_attn, beam_size=k)
-        for idx in xrange(top_k_indices.shape[0]):
-            output_tuple = (BeamEntry([top_k_indices[idx]], state_list, context_vec),
-                            top_k_model_scores[idx])
-            if top_k_indices[idx] == data_utils.EOS_ID:
-                final_output_list.append(output_tuple)
-                # Decrease the beam size once EOS is encountered
-                k -= 1
-            else:
-                output_list.append(output_tuple)
-
-        step_count += 1
-        while step_count < 120 and k > 0:
-            # These lists store the states obtained by running the decoder
-            # for 1 more step with the previous outputs of the beam
-            next_dec_states = []
-            next_context_vecs = []
-
-            score_list = []
-            model_score_list = []
-            index_list = []
-            for candidate, cand_score in output_list:
-                x = params.embedding[candidate.get_last_output()]
-                x_lm = lm_params.embedding[candidate.get_last_output()]
-
-                top_k_indices, top_k_model_scores, top_k_scores, state_list, context_vec =\
-                    get_top_k_fn(x, x_lm, candidate.get_dec_state(),
-                                 candidate.get_context_vec(), beam_size=k)
-
-                next_dec_states.append(state_list)
-                next_context_vecs.append(context_vec)
-
-                index_list.append(top_k_indices)
-                score_list.append(top_k_scores + cand_score)
-                model_score_list.append(top_k_model_scores + cand_score)
-
-            # Score of all k**2 continuations
-            all_scores = np.concatenate(score_list, axis=0)
-            all_model_scores = np.concatenate(model_score_list, axis=0)
-            # All k**2 continuations
-            all_indices = np.concatenate(index_list, axis=0)
-
-            # Find the top indices among the k^^2 entries
-            top_k_indices = np.argpartition(all_scores, -k)[-k:]
-            next_k_indices = all_indices[top_k_indices]
-            top_k_scores = all_model_scores[top_k_indices]
-            # The original candidate indices can be found by dividing by k.
-            # Because the indices are of the form - i * k + j, where i
-            # represents the ith output and j represents the jth top index for i
-            orig_cand_indices = np.divide(top_k_indices, k, dtype=np.int32)
-
-            new_output_list = []
-
-            for idx in xrange(k):
-                orig_cand_idx = int(orig_cand_indices[idx])
-                # BeamEntry of the original candidate
-                orig_cand = output_list[orig_cand_idx][0]
-                next_elem = next_k_indices[idx]
-                # Add the next index to the original sequence
-                new_index_seq = orig_cand.get_index_seq() + [next_elem]
-                dec_state = next_dec_states[orig_cand_idx]
-                context_vec = next_context_vecs[orig_cand_idx]
-
-                output_tuple = (BeamEntry(new_index_seq, dec_state, context_vec),
-                                top_k_scores[idx] +
-                                search_params.word_ins_penalty*len(new_index_seq))
-                if next_elem == data_utils.EOS_ID:
-                    # This sequence is finished. Put the output on the final list
-                    # and reduce beam size
-                    final_output_list.append(output_tuple)
-                    k -= 1
-                else:
-                    new_output_list.append(output_tuple)
-
-            output_list = new_output_list
             step_count += 1
-
-        final_output_list += output_list
-
-        best_output = max(final_output_list, key=lambda output_tuple: output_tuple[1])
-        output_seq = best_output[0].get_index_seq()
-        return np.stack(output_seq, axis=0)
+            profiler.lap("bookkeeping")
+
+        self.decode_stats = decode_stats
+        for key in final_outputs:
+            final_outputs[key] = np.concatenate(final_outputs[key])
+
+        # Sort the hypotheses of each utterance by score, preferring the
+        # earlier finished one among equal scores
+        final_order = np.lexsort((np.arange(final_outputs.utts.shape[0]),
+                                  -final_outputs.scores, final_outputs.utts))
+        for key in final_outputs:
+            final_outputs[key] = final_outputs[key][final_order]
+        utt_starts = np.searchsorted(final_outputs.utts, np.arange(batch_size + 1))
+        decode_stats.hit_max_len = final_outputs.cut_offs[utt_starts[:-1]]
+
+        output_seqs = [np.array(beam_trie.get_index_seq(node))
+                       for node in final_outputs.nodes[utt_starts[:-1]]]
+        if not return_nbest:
+            profiler.lap("bookkeeping")
+            return output_seqs
+
+        nbest_lists = []
+        for utt_idx in xrange(batch_size):
+            nbest = Bunch()
+            for key in ["scores", "dec_scores", "lm_scores", "lengths", "coverages"]:
+                nbest[key] = final_outputs[key][utt_starts[utt_idx]:utt_starts[utt_idx + 1]]
+            nbest.index_seqs = [
+                np.array(beam_trie.get_index_seq(node)) for node in
+                final_outputs.nodes[utt_starts[utt_idx]:utt_starts[utt_idx + 1]]]
+            nbest_lists.append(nbest)
+        profiler.lap("bookkeeping")
+        return output_seqs, nbest_lists
 
     @classmethod
     def add_parse_options(cls, parser):
@@ -345,6 +811,48 @@ class BeamSearch(BaseParams):
         parser.add_argument("-lm_weight", default=0.0, type=float, help="LM weight in decoding")
         parser.add_argument("-lm_path", default="/share/data/speech/shtoshni/research/asr_multi/"
                             "code/lm/models/best_models/run_id_301/lm.ckpt-250000", type=str,
-                            help="LM ckpt path")
+                            help="LM ckpt path, or ARPA/compiled LM path with -lm_type ngram")
+        parser.add_argument("-lm_type", default="lstm", type=str, choices=["lstm", "ngram"],
+                            help="Type of the LM at lm_path")
+        parser.add_argument("-lm_vocab_path", default="", type=str,
+                            help="Vocab file of an ARPA n-gram LM, by default the char "
+                            "vocab of vocab_dir")
         parser.add_argument("-cov_penalty", default=0.0, type=float,
                             help="Coverage penalty")
+        parser.add_argument("-decode_batch_size", default=1, type=int,
+                            help="Number of utterances decoded together in beam search")
+        parser.add_argument("-decode_workers", default=1, type=int,
+                            help="Number of worker processes for beam search")
+        parser.add_argument("-pipeline_queue_size", default=0, type=int,
+                            help="Overlap the encoder and beam search with this many batches "
+                            "queued for decoding; 0 runs the encoder over all the data first")
+        parser.add_argument("-lm_cache_size", default=10000, type=int,
+                            help="Number of LM prefix states cached in beam search")
+        parser.add_argument("-precision", default="float64", type=str,
+                            choices=["float64", "float32", "float16"],
+                            help="Precision of the numpy decoder; float16 stores the "
+                            "weights and encoder outputs in half precision. Only float32 "
+                            "keeps the weight bundle arrays memory-mapped")
+        parser.add_argument("-save_nbest", default=False, action="store_true",
+                            help="Save the N-best lists with their score parts for rescoring")
+        parser.add_argument("-prune_threshold", default=0.0, type=float,
+                            help="Prune hypotheses scoring this much below the best "
+                            "hypothesis of the utterance; 0 disables")
+        parser.add_argument("-attn_window", default=0, type=int,
+                            help="Number of frames around the previous attention peak "
+                            "scored by attention; 0 uses all frames")
+        parser.add_argument("-attn_fallback_prob", default=0.3, type=float,
+                            help="Use full attention when the windowed attention peak "
+                            "probability is below this")
+        parser.add_argument("-shortlist_size", default=0, type=int,
+                            help="Number of prior tokens in the decoder output shortlist; "
+                            "0 disables the shortlist")
+        parser.add_argument("-shortlist_full_every", default=10, type=int,
+                            help="Steps between full vocab softmax passes with a shortlist")
+        parser.add_argument("-profile", default=False, action="store_true",
+                            help="Time the phases of beam search and dump a profile")
+        parser.add_argument("-max_active", default=0, type=int,
+                            help="Maximum live hypotheses per utterance; 0 disables")
+        parser.add_argument("-early_stop", default=False, action="store_true",
+                            help="Stop decoding an utterance once no live hypothesis "
+                            "can beat its best finished hypothesis")
@@ -0,0 +1,257 @@
+"""Benchmark of the numpy beam search with synthetic weights and encoder outputs.
+
+Random decoder and LM params are created under the checkpoint variable names
+read by BeamSearch.map_dec_variables and BeamSearch.map_lm_variables, so no
+checkpoint or TensorFlow is needed. Decoding is timed over the grid of beam
+sizes, LM on/off, decoder hidden sizes and vocab sizes.
+
+With -save_baseline the results are stored in the baseline file, otherwise
+they are checked against it and the script exits with status 1 if any config
+is slower than its baseline by more than the tolerance.
+
+Usage:
+    python beam_search_benchmark.py -beam_sizes 1,4,8 -hidden_sizes 256,512
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import time
+from os import path
+
+import numpy as np
+
+from beam_search import BeamSearch
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 only has the peak RSS of the process
+    import resource
+    tracemalloc = None
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-beam_sizes", default="1,4,8", type=str,
+                        help="Comma separated beam sizes")
+    parser.add_argument("-lm_options", default="0,1", type=str,
+                        help="Comma separated LM options, 0 for no LM and 1 for LM")
+    parser.add_argument("-hidden_sizes", default="256", type=str,
+                        help="Comma separated decoder hidden sizes")
+    parser.add_argument("-vocab_sizes", default="1000", type=str,
+                        help="Comma separated vocab sizes")
+    parser.add_argument("-utt_lens", default="100,200,400", type=str,
+                        help="Comma separated encoder lengths of the utterances")
+    parser.add_argument("-num_utts", default=12, type=int,
+                        help="Number of utterances, cycling over the lengths")
+    parser.add_argument("-enc_size", default=512, type=int, help="Encoder output size")
+    parser.add_argument("-emb_size", default=256, type=int, help="Embedding size")
+    parser.add_argument("-lm_hidden_size", default=256, type=int, help="LM hidden size")
+    parser.add_argument("-attention_vec_size", default=128, type=int,
+                        help="Attention vector size")
+    parser.add_argument("-max_output_len", default=60, type=int,
+                        help="Maximum output length")
+    parser.add_argument("-decode_batch_size", default=4, type=int,
+                        help="Number of utterances decoded together")
+    parser.add_argument("-precision", default="float64", type=str,
+                        choices=["float64", "float32", "float16"])
+    parser.add_argument("-shortlist_sizes", default="", type=str,
+                        help="Comma separated decoder output shortlist sizes, each also "
+                        "timed with its agreement with the full vocab outputs")
+    parser.add_argument("-seed", default=0, type=int, help="Random seed")
+    parser.add_argument("-baseline_file", default="beam_search_baseline.json", type=str,
+                        help="JSON file of the baseline results")
+    parser.add_argument("-save_baseline", default=False, action="store_true",
+                        help="Store the results as the baseline")
+    parser.add_argument("-tolerance", default=0.2, type=float,
+                        help="Allowed fractional slowdown relative to the baseline")
+    args = parser.parse_args()
+    return args
+
+
+def parse_list(list_str, elem_type):
+    return [elem_type(elem) for elem in list_str.split(",") if elem]
+
+
+def random_var_dict(var_shapes, rng, scale=0.1):
+    return dict((var_name, rng.uniform(-scale, scale, size=shape).astype(np.float32))
+                for var_name, shape in var_shapes.items())
+
+
+def synthetic_dec_params(vocab_size, hidden_size, emb_size, lm_hidden_size,
+                         enc_size, attention_vec_size, rng, scale=0.1):
+    """Random decoder params as mapped by BeamSearch.map_dec_variables."""
+    prefix = "model/rnn_decoder_char/"
+    var_shapes = {
+        prefix + "rnn/basic_lstm_cell/kernel": (emb_size + lm_hidden_size, 4 * lm_hidden_size),
+        prefix + "rnn/basic_lstm_cell/bias": (4 * lm_hidden_size,),
+        prefix + "rnn/basic_lstm_cell_1/kernel": (emb_size + hidden_size, 4 * hidden_size),
+        prefix + "rnn/basic_lstm_cell_1/bias": (4 * hidden_size,),
+        prefix + "rnn/Attention/kernel": (hidden_size, attention_vec_size),
+        prefix + "rnn/Attention/bias": (attention_vec_size,),
+        prefix + "rnn/InputProjection/kernel": (hidden_size + enc_size, emb_size),
+        prefix + "rnn/InputProjection/bias": (emb_size,),
+        prefix + "rnn/AttnProjection/kernel": (hidden_size + enc_size, hidden_size),
+        prefix + "rnn/AttnProjection/bias": (hidden_size,),
+        prefix + "rnn/OutputProjection/kernel": (hidden_size, vocab_size),
+        prefix + "rnn/OutputProjection/bias": (vocab_size,),
+        prefix + "rnn/SimpleProjection/kernel": (lm_hidden_size, hidden_size),
+        prefix + "rnn/SimpleProjection/bias": (hidden_size,),
+        prefix + "AttnW": (1, 1, enc_size, attention_vec_size),
+        prefix + "AttnV": (attention_vec_size,),
+        prefix + "decoder/embedding": (vocab_size, emb_size),
+    }
+    return BeamSearch.map_dec_variables(random_var_dict(var_shapes, rng, scale))
+
+
+def synthetic_lm_params(vocab_size, hidden_size, emb_size, lm_hidden_size, rng,
+                        scale=0.1):
+    """Random LM params as mapped by BeamSearch.map_lm_variables."""
+    prefix = "model/rnn_decoder_char/"
+    var_shapes = {
+        prefix + "rnn/basic_lstm_cell/kernel": (emb_size + lm_hidden_size, 4 * lm_hidden_size),
+        prefix + "rnn/basic_lstm_cell/bias": (4 * lm_hidden_size,),
+        prefix + "rnn/SimpleProjection/kernel": (lm_hidden_size, hidden_size),
+        prefix + "rnn/SimpleProjection/bias": (hidden_size,),
+        prefix + "rnn/OutputProjection/kernel": (hidden_size, vocab_size),
+        prefix + "rnn/OutputProjection/bias": (vocab_size,),
+        prefix + "decoder/embedding": (vocab_size, emb_size),
+    }
+    return BeamSearch.map_lm_variables(random_var_dict(var_shapes, rng, scale))
+
+
+def synthetic_encoder_outputs(utt_lens, num_utts, enc_size, rng):
+    return [rng.randn(utt_lens[utt_idx % len(utt_lens)], enc_size).astype(np.float32)
+            for utt_idx in xrange(num_utts)]
+
+
+def get_config_key(beam_size, use_lm, hidden_size, vocab_size):
+    return ("beam_%d_lm_%d_hidden_%d_vocab_%d"
+            %(beam_size, int(use_lm), hidden_size, vocab_size))
+
+
+def decode_all(beam_search, hidden_states_list, decode_batch_size):
+    """Decode all the utterances and return the outputs and the number of
+    batch decoding steps."""
+    outputs = []
+    total_steps = 0
+    for batch_start in xrange(0, len(hidden_states_list), decode_batch_size):
+        outputs.extend(beam_search.decode_batch(
+            hidden_states_list[batch_start:batch_start + decode_batch_size]))
+        total_steps += int(np.max(beam_search.decode_stats.steps))
+    return outputs, total_steps
+
+
+def time_decoding(beam_search, hidden_states_list, decode_batch_size):
+    """Decode all the utterances and return the outputs, the decoding time,
+    the number of batch decoding steps and the peak memory in MB. Tracing
+    the allocations slows down decoding, so the peak memory is measured in a
+    second, untimed pass, starting from an empty LM cache as well."""
+    start_time = time.time()
+    outputs, total_steps = decode_all(beam_search, hidden_states_list, decode_batch_size)
+    decode_time = time.time() - start_time
+    if tracemalloc is not None:
+        beam_search.lm_cache.clear()
+        tracemalloc.start()
+        decode_all(beam_search, hidden_states_list, decode_batch_size)
+        _, peak_mem = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak_mem_mb = peak_mem / float(2 ** 20)
+    else:
+        peak_mem_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return outputs, decode_time, total_steps, peak_mem_mb
+
+
+def add_result(results, config_key, num_utts, decode_time, total_steps, peak_mem_mb):
+    results[config_key] = {
+        "utts_per_sec": num_utts / decode_time,
+        "ms_per_step": 1e3 * decode_time / max(total_steps, 1),
+        "peak_mem_mb": peak_mem_mb}
+    print ("%s: %.2f utts/sec, %.2f ms/step, %.1f MB peak"
+           %(config_key, results[config_key]["utts_per_sec"],
+             results[config_key]["ms_per_step"], peak_mem_mb))
+
+
+def benchmark(args):
+    rng = np.random.RandomState(args.seed)
+    hidden_states_list = synthetic_encoder_outputs(
+        parse_list(args.utt_lens, int), args.num_utts, args.enc_size, rng)
+
+    results = {}
+    for vocab_size in parse_list(args.vocab_sizes, int):
+        for hidden_size in parse_list(args.hidden_sizes, int):
+            dec_params = synthetic_dec_params(
+                vocab_size, hidden_size, args.emb_size, args.lm_hidden_size,
+                args.enc_size, args.attention_vec_size, rng)
+            lm_params = synthetic_lm_params(vocab_size, hidden_size, args.emb_size,
+                                            args.lm_hidden_size, rng)
+            for use_lm in [bool(int(lm_option)) for lm_option in args.lm_options.split(",")]:
+                for beam_size in parse_list(args.beam_sizes, int):
+                    search_params = BeamSearch.class_params()
+                    search_params.beam_size = beam_size
+                    search_params.lm_weight = (0.1 if use_lm else 0.0)
+                    search_params.max_output_len = args.max_output_len
+                    search_params.precision = args.precision
+                    beam_search = BeamSearch(search_params=search_params,
+                                             dec_params=dec_params,
+                                             lm_params=(lm_params if use_lm else None))
+
+                    full_outputs, decode_time, total_steps, peak_mem_mb = time_decoding(
+                        beam_search, hidden_states_list, args.decode_batch_size)
+                    config_key = get_config_key(beam_size, use_lm, hidden_size, vocab_size)
+                    add_result(results, config_key, len(hidden_states_list),
+                               decode_time, total_steps, peak_mem_mb)
+
+                    for shortlist_size in parse_list(args.shortlist_sizes, int):
+                        search_params.shortlist_size = shortlist_size
+                        beam_search.set_search_params(search_params)
+                        # Start cold like the full vocab run, not from its LM cache
+                        beam_search.lm_cache.clear()
+                        outputs, decode_time, total_steps, peak_mem_mb = time_decoding(
+                            beam_search, hidden_states_list, args.decode_batch_size)
+                        shortlist_key = config_key + "_shortlist_%d" %shortlist_size
+                        add_result(results, shortlist_key, len(hidden_states_list),
+                                   decode_time, total_steps, peak_mem_mb)
+                        agreement = np.mean([list(output) == list(full_output) for
+                                             output, full_output in zip(outputs, full_outputs)])
+                        results[shortlist_key]["agreement"] = agreement
+                        print ("%s: %.2f of the outputs same as with the full vocab"
+                               %(shortlist_key, agreement))
+                    sys.stdout.flush()
+    return results
+
+
+def check_regressions(results, baseline, tolerance):
+    """Return the configs slower than their baseline by more than tolerance."""
+    regressions = []
+    for config_key in sorted(results):
+        if config_key not in baseline:
+            continue
+        base_speed = baseline[config_key]["utts_per_sec"]
+        speed = results[config_key]["utts_per_sec"]
+        if speed < (1 - tolerance) * base_speed:
+            regressions.append(config_key)
+            print ("Regression in %s: %.2f utts/sec vs baseline %.2f"
+                   %(config_key, speed, base_speed))
+    return regressions
+
+
+if __name__=="__main__":
+    args = parse_options()
+    results = benchmark(args)
+    if args.save_baseline:
+        with open(args.baseline_file, "w") as baseline_f:
+            json.dump(results, baseline_f, indent=2, sort_keys=True)
+        print ("Baseline at: %s" %args.baseline_file)
+    elif path.isfile(args.baseline_file):
+        with open(args.baseline_file) as baseline_f:
+            baseline = json.load(baseline_f)
+        if check_regressions(results, baseline, args.tolerance):
+            sys.exit(1)
+        print ("No regressions against %s" %args.baseline_file)
@@ -1,29 +1,95 @@
-from beam_search import BeamSearch
+"""Tests of the numpy beam search on the synthetic model of the benchmark."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import unittest
 
+import numpy as np
+
+import beam_search_benchmark
 import data_utils
+from beam_search import BeamSearch
+
 
-class BeamSearchTest(object):
+def synthetic_beam_search(use_lm=False, seed=0, **search_args):
+    """Beam search over a small synthetic decoder, and LM if use_lm, and
+    random encoder outputs of utterances of different lengths."""
+    rng = np.random.RandomState(seed)
+    vocab_size, hidden_size, emb_size, lm_hidden_size = 40, 32, 16, 24
+    enc_size, attention_vec_size = 20, 8
+    dec_params = beam_search_benchmark.synthetic_dec_params(
+        vocab_size, hidden_size, emb_size, lm_hidden_size, enc_size, attention_vec_size,
+        rng, scale=1.0)
+    lm_params = beam_search_benchmark.synthetic_lm_params(
+        vocab_size, hidden_size, emb_size, lm_hidden_size, rng, scale=1.0)
 
-    ckpt_file = ("/share/data/speech/shtoshni/research/asr_multi/models/"
-                  "skip_2_lstm_lm_prob_0.75_run_id_205/asr.ckpt-39000")
-    vocab_file = ("/share/data/speech/shtoshni/research/datasets/"
-                  "asr_swbd/lang/vocab/char.vocab")
+    search_params = BeamSearch.class_params()
+    search_params.beam_size = 4
+    search_params.lm_weight = (0.3 if use_lm else 0.0)
+    search_params.max_output_len = 15
+    search_params.update(search_args)
+    beam_search = BeamSearch(search_params=search_params, dec_params=dec_params,
+                             lm_params=(lm_params if use_lm else None))
+    hidden_states_list = beam_search_benchmark.synthetic_encoder_outputs(
+        [7, 12, 5, 20, 9], 6, enc_size, rng)
+    return beam_search, hidden_states_list
 
-    def __init__(self):
-        self.rev_vocab = self.load_char_vocab()
-        self.beam_search = BeamSearch(self.ckpt_file, self.rev_vocab)
 
-    def load_char_vocab(self):
-        _, rev_char_vocab = data_utils.initialize_vocabulary(self.vocab_file)
-        return rev_char_vocab
+class BeamSearchTest(unittest.TestCase):
 
     def test_param_load(self):
-        """Test file loading."""
-        for param_name in self.beam_search.params:
-            param_shape = self.beam_search.params[param_name].shape
-            print (param_name + ": " + str(param_shape))
+        """The mapped decoder params are all loaded in the storage dtype."""
+        beam_search, _ = synthetic_beam_search()
+        for param_name, value in beam_search.dec_params.items():
+            self.assertIsNotNone(value, param_name)
+            self.assertEqual(value.dtype, beam_search.storage_dtype, param_name)
+
+    def check_batched_vs_sequential(self, beam_search, hidden_states_list):
+        batch_outputs, batch_nbest = beam_search.decode_batch(hidden_states_list,
+                                                               return_nbest=True)
+        for utt_idx, hidden_states in enumerate(hidden_states_list):
+            output, nbest = beam_search(hidden_states, return_nbest=True)
+            self.assertEqual(list(output), list(batch_outputs[utt_idx]))
+            self.assertEqual([list(seq) for seq in nbest.index_seqs],
+                             [list(seq) for seq in batch_nbest[utt_idx].index_seqs])
+            np.testing.assert_allclose(nbest.scores, batch_nbest[utt_idx].scores,
+                                       rtol=1e-9, atol=1e-9)
+
+    def test_batched_vs_sequential(self):
+        """Decoding utterances together gives their outputs and N-best lists
+        when decoded one at a time."""
+        beam_search, hidden_states_list = synthetic_beam_search()
+        self.check_batched_vs_sequential(beam_search, hidden_states_list)
+
+    def test_batched_vs_sequential_with_lm(self):
+        beam_search, hidden_states_list = synthetic_beam_search(
+            use_lm=True, word_ins_penalty=0.1, cov_penalty=0.2)
+        self.check_batched_vs_sequential(beam_search, hidden_states_list)
+
+    def test_set_search_params(self):
+        """A decoder reused with new search params decodes as a new one."""
+        beam_search, hidden_states_list = synthetic_beam_search(use_lm=True)
+        search_params = copy.deepcopy(beam_search.search_params)
+        search_params.beam_size = 2
+        search_params.lm_weight = 0.5
+        beam_search.set_search_params(search_params)
+        new_beam_search, _ = synthetic_beam_search(use_lm=True, beam_size=2, lm_weight=0.5)
+        for output, new_output in zip(beam_search.decode_batch(hidden_states_list),
+                                      new_beam_search.decode_batch(hidden_states_list)):
+            self.assertEqual(list(output), list(new_output))
+
+    def test_hit_max_len(self):
+        """An utterance is at the maximum length iff its output has no EOS."""
+        for max_output_len in [3, 15]:
+            beam_search, hidden_states_list = synthetic_beam_search(
+                max_output_len=max_output_len)
+            outputs = beam_search.decode_batch(hidden_states_list)
+            self.assertEqual(list(beam_search.decode_stats.hit_max_len),
+                             [data_utils.EOS_ID not in list(output) for output in outputs])
 
 
 if __name__=="__main__":
-    beam_search_tester = BeamSearchTest()
-    beam_search_tester.test_param_load()
+    unittest.main()
@@ -0,0 +1,51 @@
+"""Array-backed prefix tree of beam search hypotheses."""
+
+import numpy as np
+
+
+class BeamTrie(object):
+    """Prefix tree in which each node is an output token of a hypothesis.
+
+    Nodes are stored in preallocated numpy buffers holding the token and the
+    index of the parent node (-1 for the first output). Extending a hypothesis
+    only adds a node, and the output sequence is rebuilt by following the
+    parent pointers."""
+
+    def __init__(self, capacity=1024):
+        self.tokens = np.empty(capacity, dtype=np.int32)
+        self.parents = np.empty(capacity, dtype=np.int32)
+        self.num_nodes = 0
+
+    def reset(self, capacity=None):
+        """Remove all nodes while keeping the buffers, which are grown to the
+        given capacity if required."""
+        self.num_nodes = 0
+        if capacity is not None:
+            self.reserve(capacity)
+
+    def reserve(self, capacity):
+        """Grow the buffers to hold at least capacity nodes."""
+        if capacity > self.tokens.shape[0]:
+            new_capacity = max(capacity, 2 * self.tokens.shape[0])
+            self.tokens = np.resize(self.tokens, new_capacity)
+            self.parents = np.resize(self.parents, new_capacity)
+
+    def add(self, tokens, parents):
+        """Add a node for each of the (token, parent) pairs and return the node
+        indices."""
+        start = self.num_nodes
+        end = start + tokens.shape[0]
+        self.reserve(end)
+        self.tokens[start:end] = tokens
+        self.parents[start:end] = parents
+        self.num_nodes = end
+        return np.arange(start, end)
+
+    def get_index_seq(self, node):
+        """Output sequence of the hypothesis ending at node."""
+        index_seq = []
+        while node >= 0:
+            index_seq.append(self.tokens[node])
+            node = self.parents[node]
+        index_seq.reverse()
+        return index_seq
@@ -2,8 +2,6 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import tensorflow as tf
-
 # Special vocabulary symbols - we always put them at the start.
 _PAD = b"<pad>"
 _GO = b"<go>"
@@ -14,21 +12,15 @@ PAD_ID = 0
 GO_ID = 1
 EOS_ID = 2
 
-IGNORED_WORDS = ["[noise]", "[laughter]", "[vocalized-noise]", "uh", "um", "eh", "mm", "hm", \
-        "ah", "huh", "ha", "er", "oof", "hee", "ach", "eee", "ew"]
+IGNORED_WORDS = frozenset(["[noise]", "[laughter]", "[vocalized-noise]", "uh", "um", "eh", "mm", "hm", \
+        "ah", "huh", "ha", "er", "oof", "hee", "ach", "eee", "ew"])
 
 def get_relevant_words(char_str):
     char_str = char_str.replace("<sp>", " ")
     words = char_str.split()
-    rel_words = []
-    for word in words:
-        if word in IGNORED_WORDS:
-            continue
-        elif len(word) > 0 and word[-1] == "-":
-            ## Partial word
-            continue
-        else:
-            rel_words.append(word)
+    # Partial words end with "-"
+    rel_words = [word for word in words
+                 if word not in IGNORED_WORDS and not word.endswith("-")]
 
     return words, rel_words
 
@@ -51,6 +43,8 @@ def initialize_vocabulary(vocabulary_path):
     Raises:
     ValueError: if the provided vocabulary_path does not exist.
     """
+    # Imported here so that the decoding modules don't depend on TF
+    import tensorflow as tf
     if tf.gfile.Exists(vocabulary_path):
         rev_vocab = []
         with tf.gfile.GFile(vocabulary_path, mode="rb") as f:
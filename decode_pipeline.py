@@ -0,0 +1,171 @@
+"""Beam search decoding overlapped with the encoder producing its inputs.
+
+A producer thread iterates over the utterances, e.g. running the TF encoder
+over the dataset, and queues them in batches of similar length. The batches
+are beam searched as they arrive, either by the calling thread or by a pool
+of worker processes, and the results of each utterance are handed to a
+callback once its batch is decoded. At most queue_size batches are queued,
+up to queue_size more are being decoded by the workers and the producer
+holds up to decode_batch_size * SORT_WINDOW utterances being sorted, so
+memory doesn't grow with the dataset size, and the wall time approaches the
+larger of the encoder and decoder times.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from bunch import Bunch
+
+import parallel_decode
+from beam_profiler import PhaseProfiler
+
+# Utterances are sorted by length for batching within windows of this many
+# batches
+SORT_WINDOW = 4
+
+
+class PipelinedBeamSearch(object):
+    """Beam search of utterances as they are produced.
+
+    The worker pool, if any, is created once and can be reused across
+    decoding runs with different search params."""
+
+    def __init__(self, beam_search, num_workers, queue_size):
+        self.beam_search = beam_search
+        self.num_workers = num_workers
+        self.queue_size = max(queue_size, 1)
+        self.pool = None
+        if num_workers > 1:
+            self.pool = parallel_decode.create_pool(
+                num_workers, parallel_decode.share_params(beam_search.dec_params),
+                parallel_decode.share_params(beam_search.lm_params),
+                None, None, beam_search.search_params)
+
+    def produce_batches(self, utterances, decode_batch_size, batch_queue, stop):
+        """Put the batches of the utterances, each a list of (utterance index,
+        encoder outputs, utterance info) triples, on the queue followed by
+        None. An exception of the producer is put on the queue instead.
+        Nothing more is put once the consumer sets the stop event."""
+        try:
+            window = []
+            window_size = decode_batch_size * SORT_WINDOW
+            for utt_idx, (hidden_states, utt_info) in enumerate(utterances):
+                if stop.is_set():
+                    return
+                window.append((utt_idx, hidden_states, utt_info))
+                if len(window) == window_size:
+                    self.put_window(window, decode_batch_size, batch_queue, stop)
+                    window = []
+            self.put_window(window, decode_batch_size, batch_queue, stop)
+            self.put_batch(None, batch_queue, stop)
+        except Exception as producer_error:
+            self.put_batch(producer_error, batch_queue, stop)
+
+    @staticmethod
+    def put_batch(batch, batch_queue, stop):
+        if not stop.is_set():
+            batch_queue.put(batch)
+
+    @classmethod
+    def put_window(cls, window, decode_batch_size, batch_queue, stop):
+        window.sort(key=lambda utt: utt[1].shape[0])
+        for batch_start in xrange(0, len(window), decode_batch_size):
+            cls.put_batch(window[batch_start:batch_start + decode_batch_size],
+                          batch_queue, stop)
+
+    def __call__(self, utterances, search_params, on_output):
+        """Decode the (T x H encoder outputs, utterance info) pairs of the
+        utterances iterable, which is consumed by a producer thread. For each
+        utterance, in the order of completion, on_output is called with its
+        info, number of encoder frames, output, N-best list (None unless the
+        save_nbest search param is set) and Bunch of decode stats. The phase
+        times are accumulated in profiler. If decoding or on_output fails, the
+        producer is stopped and joined before the error is raised."""
+        decode_batch_size = max(search_params.decode_batch_size, 1)
+        self.profiler = PhaseProfiler(enabled=search_params.profile)
+        batch_queue = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        producer = threading.Thread(target=self.produce_batches,
+                                    args=(utterances, decode_batch_size, batch_queue, stop))
+        producer.daemon = True
+        producer.start()
+
+        def output_batch(batch, beam_outputs, nbest_lists, decode_stats):
+            for batch_idx, (_, hidden_states, utt_info) in enumerate(batch):
+                utt_stats = Bunch((key, values[batch_idx])
+                                  for key, values in decode_stats.items())
+                on_output(utt_info, hidden_states.shape[0], beam_outputs[batch_idx],
+                          (None if nbest_lists is None else nbest_lists[batch_idx]),
+                          utt_stats)
+
+        # Batches being decoded by the workers, in the order of submission
+        in_flight = collections.deque()
+
+        def output_oldest():
+            batch, async_result = in_flight.popleft()
+            beam_outputs, nbest_lists, decode_stats, profile = async_result.get()[1:]
+            self.profiler.merge(*profile)
+            output_batch(batch, beam_outputs, nbest_lists, decode_stats)
+
+        try:
+            while True:
+                batch = batch_queue.get()
+                if isinstance(batch, Exception):
+                    # Reraise the exception of the producer
+                    raise batch
+                if batch is None:
+                    break
+                hidden_states_list = [hidden_states for _, hidden_states, _ in batch]
+                if self.pool is None:
+                    beam_search = self.beam_search
+                    if search_params != beam_search.search_params:
+                        beam_search.set_search_params(search_params)
+                    if search_params.save_nbest:
+                        beam_outputs, nbest_lists = beam_search.decode_batch(
+                            hidden_states_list, return_nbest=True)
+                    else:
+                        beam_outputs = beam_search.decode_batch(hidden_states_list)
+                        nbest_lists = None
+                    self.profiler.merge(beam_search.profiler.times,
+                                        beam_search.profiler.counts)
+                    beam_search.profiler.reset()
+                    output_batch(batch, beam_outputs, nbest_lists, beam_search.decode_stats)
+                else:
+                    utt_indices = [utt_idx for utt_idx, _, _ in batch]
+                    in_flight.append((batch, self.pool.apply_async(
+                        parallel_decode.decode_hidden_states_task,
+                        ((utt_indices, hidden_states_list, search_params),))))
+                    # Output the batches decoded so far, waiting if queue_size
+                    # batches are being decoded
+                    while in_flight and (in_flight[0][1].ready() or
+                                         len(in_flight) >= self.queue_size):
+                        output_oldest()
+
+            while in_flight:
+                output_oldest()
+        finally:
+            # After an error the producer may be blocked on the full queue, so
+            # it's stopped and the queue emptied. At most one batch whose put
+            # was already under way can be added after emptying, and it fits.
+            stop.set()
+            while True:
+                try:
+                    batch_queue.get_nowait()
+                except queue.Empty:
+                    break
+            producer.join()
+
+    def close(self):
+        """Shut down the worker processes, if any."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
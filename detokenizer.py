@@ -0,0 +1,58 @@
+# coding: utf-8
+"""Conversion of word piece ID sequences to normalized sentences.
+
+The text of each piece is prepared once per vocabulary: decoded to str, with
+the word boundary marker replaced by a space and passed through the
+normalizer. The normalizer must map the text character by character, as the
+SWBD normalizer does, so that normalizing the pieces is the same as
+normalizing their concatenation. Sentences are then joins of table lookups,
+with the sequences of an ID matrix cut at EOS all at once.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+import data_utils
+
+
+def as_str(piece):
+    """Vocabulary entry, read as bytes, as str."""
+    if isinstance(piece, str):
+        return piece
+    return piece.decode("utf-8")
+
+
+class Detokenizer(object):
+    """Maps word piece IDs to sentences with a table of piece texts."""
+
+    def __init__(self, rev_vocab, normalizer=None):
+        piece_texts = []
+        for piece in rev_vocab:
+            piece_text = as_str(piece).replace('▁', ' ')
+            if normalizer is not None:
+                piece_text = normalizer(piece_text)
+            piece_texts.append(piece_text)
+        self.piece_texts = np.array(piece_texts, dtype=object)
+
+    def decode(self, id_seq):
+        """Sentence of a word piece ID sequence, up to the first EOS."""
+        id_seq = np.asarray(id_seq, dtype=np.int64)
+        eos_indices = np.flatnonzero(id_seq == data_utils.EOS_ID)
+        if eos_indices.shape[0]:
+            id_seq = id_seq[:eos_indices[0]]
+        return ''.join(self.piece_texts[id_seq]).strip()
+
+    def decode_batch(self, id_matrix):
+        """Sentences of the rows of a B x T word piece ID matrix."""
+        id_matrix = np.asarray(id_matrix, dtype=np.int64)
+        if id_matrix.shape[1] == 0:
+            return [''] * id_matrix.shape[0]
+        is_eos = (id_matrix == data_utils.EOS_ID)
+        seq_lens = np.where(np.any(is_eos, axis=1), np.argmax(is_eos, axis=1),
+                            id_matrix.shape[1])
+        piece_texts = self.piece_texts[id_matrix]
+        return [''.join(piece_texts[idx, :seq_len]).strip()
+                for idx, seq_len in enumerate(seq_lens)]
@@ -0,0 +1,194 @@
+"""Memory-mapped cache of the encoder outputs used for beam search decoding.
+
+A cache is a directory under <ckpt dir>/enc_cache named by the data split,
+the global step of the checkpoint and a key hashing the checkpoint index
+file, the data files and the storage dtype, so a new checkpoint or changed
+data never reuse a stale cache. The encoder outputs of the utterances are
+concatenated along time into .npy chunks, with index.npz recording the
+chunk, frame offset and length of each utterance alongwith the utterance IDs
+and gold token IDs. The cache is written to a temporary directory and renamed
+into place once complete, so readers never see a partial cache and
+concurrent writers don't clash.
+
+Reading maps the chunks lazily, hence single utterances are only read when
+decoded, and processes reading the same cache share its pages.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import re
+import shutil
+from os import path
+
+import numpy as np
+
+CACHE_VERSION = 1
+CACHE_SUBDIR = "enc_cache"
+MANIFEST_FILE = "manifest.json"
+INDEX_FILE = "index.npz"
+# Approximate size of a chunk of encoder outputs
+CHUNK_BYTES = 2 ** 28
+
+
+def get_file_hash(file_path):
+    """SHA1 of the contents of a file."""
+    file_hash = hashlib.sha1()
+    with open(file_path, "rb") as file_f:
+        for block in iter(lambda: file_f.read(2 ** 20), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_cache_dir(ckpt_path, data_files, split, dtype):
+    """Cache directory of the encoder outputs of the checkpoint for the
+    data files, or None if the checkpoint files don't exist."""
+    ckpt_files = [ckpt_file for ckpt_file in [ckpt_path + ".index", ckpt_path]
+                  if path.isfile(ckpt_file)]
+    if not ckpt_files:
+        return None
+    step_match = re.search(r"-(\d+)$", ckpt_path)
+    global_step = (step_match.group(1) if step_match else "none")
+
+    # The TF index file has the checksums of all the variables
+    key_parts = [str(CACHE_VERSION), get_file_hash(ckpt_files[0]), np.dtype(dtype).name]
+    for data_file in sorted(data_files):
+        key_parts.append("%s:%d:%d" %(path.abspath(data_file), path.getsize(data_file),
+                                      int(path.getmtime(data_file))))
+    cache_key = hashlib.sha1("\n".join(key_parts).encode("utf-8")).hexdigest()[:16]
+    return path.join(path.dirname(ckpt_path), CACHE_SUBDIR,
+                     "%s_step_%s_%s" %(split, global_step, cache_key))
+
+
+def is_cache_complete(cache_dir):
+    if cache_dir is None:
+        return False
+    return path.isfile(path.join(cache_dir, MANIFEST_FILE))
+
+
+class EncoderCacheWriter(object):
+    """Writes the encoder outputs of utterances, added one at a time, as a
+    cache. Utterances are flushed to a new chunk once the pending ones
+    exceed CHUNK_BYTES."""
+
+    def __init__(self, cache_dir, dtype):
+        self.cache_dir = cache_dir
+        self.dtype = np.dtype(dtype)
+        self.tmp_dir = "%s.tmp.%d" %(cache_dir, os.getpid())
+        if path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.makedirs(self.tmp_dir)
+
+        self.pending = []
+        self.pending_frames = 0
+        self.num_chunks = 0
+        self.utt_ids, self.chunk_ids, self.offsets, self.lengths = [], [], [], []
+        self.gold_ids = []
+
+    def add(self, hidden_states, utt_id, gold_ids):
+        """Add the T x H encoder outputs and the gold IDs of an utterance."""
+        self.utt_ids.append(utt_id)
+        self.chunk_ids.append(self.num_chunks)
+        self.offsets.append(self.pending_frames)
+        self.lengths.append(hidden_states.shape[0])
+        self.gold_ids.append(np.asarray(gold_ids, dtype=np.int32))
+
+        self.pending.append(hidden_states.astype(self.dtype, copy=False))
+        self.pending_frames += hidden_states.shape[0]
+        if self.pending_frames * hidden_states.shape[1] * self.dtype.itemsize >= CHUNK_BYTES:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        np.save(path.join(self.tmp_dir, "chunk_%d.npy" %self.num_chunks),
+                np.concatenate(self.pending, axis=0))
+        self.num_chunks += 1
+        self.pending = []
+        self.pending_frames = 0
+
+    def close(self):
+        """Write the index and manifest and move the cache into place. If
+        another process completed the same cache first, its cache is kept."""
+        self.flush()
+        gold_lens = [gold_ids.shape[0] for gold_ids in self.gold_ids]
+        np.savez(path.join(self.tmp_dir, INDEX_FILE),
+                 utt_ids=np.array(self.utt_ids),
+                 chunk_ids=np.array(self.chunk_ids, dtype=np.int64),
+                 offsets=np.array(self.offsets, dtype=np.int64),
+                 lengths=np.array(self.lengths, dtype=np.int64),
+                 gold_ids=(np.concatenate(self.gold_ids) if self.gold_ids
+                           else np.zeros(0, dtype=np.int32)),
+                 gold_offsets=np.concatenate([[0], np.cumsum(gold_lens)]).astype(np.int64))
+        manifest = {"version": CACHE_VERSION, "dtype": self.dtype.name,
+                    "num_utts": len(self.utt_ids), "num_chunks": self.num_chunks}
+        with open(path.join(self.tmp_dir, MANIFEST_FILE), "w") as manifest_f:
+            json.dump(manifest, manifest_f, indent=2, sort_keys=True)
+
+        parent_dir = path.dirname(self.cache_dir)
+        if not path.exists(parent_dir):
+            try:
+                os.makedirs(parent_dir)
+            except OSError:
+                # Created by another process in the meantime
+                pass
+        try:
+            os.rename(self.tmp_dir, self.cache_dir)
+        except OSError:
+            shutil.rmtree(self.tmp_dir)
+        print ("Stored encoder outputs at %s" %self.cache_dir)
+
+    def abort(self):
+        """Remove the partial cache, e.g. when the encoder is stopped early."""
+        if path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+
+
+class EncoderCache(object):
+    """Reader of a complete cache, with the encoder outputs of each
+    utterance as a lazily read view of its memory-mapped chunk."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(path.join(cache_dir, MANIFEST_FILE)) as manifest_f:
+            self.manifest = json.load(manifest_f)
+        if self.manifest["version"] != CACHE_VERSION:
+            raise ValueError("Encoder cache version %d at %s, expected %d"
+                             %(self.manifest["version"], cache_dir, CACHE_VERSION))
+
+        index = np.load(path.join(cache_dir, INDEX_FILE))
+        self.utt_ids = index["utt_ids"].tolist()
+        self.chunk_ids = index["chunk_ids"]
+        self.offsets = index["offsets"]
+        self.lengths = index["lengths"]
+        self.gold_id_array = index["gold_ids"]
+        self.gold_offsets = index["gold_offsets"]
+        self.utt_index = dict((utt_id, idx) for idx, utt_id in enumerate(self.utt_ids))
+        self.chunks = [np.load(path.join(cache_dir, "chunk_%d.npy" %chunk_id), mmap_mode="r")
+                       for chunk_id in xrange(self.manifest["num_chunks"])]
+
+    def __len__(self):
+        return len(self.utt_ids)
+
+    def __getitem__(self, utt_idx):
+        """T x H encoder outputs of the utterance at utt_idx."""
+        offset = self.offsets[utt_idx]
+        return self.chunks[self.chunk_ids[utt_idx]][offset:offset + self.lengths[utt_idx]]
+
+    def lookup(self, utt_id):
+        """Encoder outputs of the utterance with the given ID."""
+        return self[self.utt_index[utt_id]]
+
+    def get_gold_ids(self, utt_idx):
+        return self.gold_id_array[self.gold_offsets[utt_idx]:self.gold_offsets[utt_idx + 1]]
+
+    def get_lists(self):
+        """Encoder outputs, utterance IDs and gold IDs of all the utterances,
+        as previously returned by Eval.exec_tf_code."""
+        hidden_states_list = [self[utt_idx] for utt_idx in xrange(len(self))]
+        gold_id_list = [self.get_gold_ids(utt_idx) for utt_idx in xrange(len(self))]
+        return hidden_states_list, list(self.utt_ids), gold_id_list
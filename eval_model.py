@@ -3,6 +3,7 @@
 from __future__ import absolute_import
 from __future__ import division
 
+import json
 import math
 import os
 import sys
@@ -10,7 +11,6 @@ import sys
 import time
 import random
 
-import cPickle as pickle
 import argparse
 
 import numpy as np
@@ -20,13 +20,18 @@ import tensorflow as tf
 from os import path
 from datetime import timedelta
 from bunch import Bunch
-from edit_distance import SequenceMatcher as ed
 
 import data_utils
+import encoder_cache
+import nbest
 import swbd_utils
+import wer_scorer
 
 from base_params import BaseParams
+from detokenizer import Detokenizer
 from beam_search import BeamSearch
+from parallel_decode import ParallelBeamSearch
+from decode_pipeline import PipelinedBeamSearch
 
 
 class Eval(BaseParams):
@@ -39,14 +44,29 @@ class Eval(BaseParams):
         return params
 
 
-    def __init__(self, model, params=None):
+    def __init__(self, model, params=None, loss_model=None):
         if params is None:
             self.params = params
         else:
             self.params = params
 
         self.model = model
+        # Teacher forced model of the same data for the dev loss, if any
+        self.loss_model = loss_model
         self.rev_char_vocab = self.load_char_vocab()
+        self.detokenizer = Detokenizer(self.rev_char_vocab,
+                                       swbd_utils.reverse_swbd_normalizer())
+        # Beam search worker pool reused across decoding runs
+        self.parallel_beam_search = None
+        self.parallel_pool_key = None
+        # Beam search decoder and encoder cache reused across decoding runs
+        self.beam_search = None
+        self.beam_search_key = None
+        self.encoder_cache = None
+        self.decode_stats = None
+        # Beam search seconds of the last beam_search_decode
+        self.beam_time = None
+        self.beam_profiler = None
 
     def load_char_vocab(self):
         char_vocab_path = path.join(self.params.vocab_dir, "char.vocab")
@@ -56,14 +76,15 @@ class Eval(BaseParams):
     def greedy_decode(self, sess):
         params = self.params
 
-        rev_normalizer = swbd_utils.reverse_swbd_normalizer()
-
         gold_asr_file = path.join(params.best_model_dir, 'gold_asr.txt')
         decoded_asr_file = path.join(params.best_model_dir, 'decoded_asr.txt')
         raw_asr_file = path.join(params.best_model_dir, 'raw_asr.txt')
 
+        scorer = wer_scorer.WordErrorScorer()
         total_errors, total_words = 0, 0
         sent_counter = 0
+        # Number of utterances whose decoding reached the maximum length
+        max_len_counter = 0
         # Initialize the dev iterator
         sess.run(self.model.data_iter.initializer)
 
@@ -73,9 +94,10 @@ class Eval(BaseParams):
                 try:
                     output_feed = [self.model.decoder_inputs["utt_id"],
                                    self.model.decoder_inputs["char"],
-                                   self.model.outputs["char"]]
+                                   self.model.outputs["char"],
+                                   self.model.seq_len_target["char"]]
 
-                    utt_ids, gold_ids, output_logits \
+                    utt_ids, gold_ids, output_logits, max_lens \
                         = sess.run(output_feed)
 
                     gold_ids = np.array(gold_ids[1:, :]).T
@@ -85,17 +107,19 @@ class Eval(BaseParams):
                     outputs = np.reshape(outputs, (-1, batch_size))  # T*B
 
                     to_decode = outputs.T  # B*T
-
                     for sent_id in xrange(batch_size):
-                        gold_asr = self.wp_array_to_sent(
-                            gold_ids[sent_id, :], self.rev_char_vocab, rev_normalizer)
-                        decoded_asr = self.wp_array_to_sent(
-                            to_decode[sent_id, :], self.rev_char_vocab, rev_normalizer)
-                        raw_asr_words, decoded_words = data_utils.get_relevant_words(decoded_asr)
-                        _, gold_words = data_utils.get_relevant_words(gold_asr)
+                        if data_utils.EOS_ID not in to_decode[sent_id, :max_lens[sent_id]]:
+                            max_len_counter += 1
 
-                        total_errors += ed(gold_words, decoded_words).distance()
-                        total_words += len(gold_words)
+                    gold_sents = self.detokenizer.decode_batch(gold_ids)
+                    decoded_sents = self.detokenizer.decode_batch(to_decode)
+                    decoded_word_lists, gold_word_lists = [], []
+                    for sent_id in xrange(batch_size):
+                        raw_asr_words, decoded_words = data_utils.get_relevant_words(
+                            decoded_sents[sent_id])
+                        _, gold_words = data_utils.get_relevant_words(gold_sents[sent_id])
+                        decoded_word_lists.append(decoded_words)
+                        gold_word_lists.append(gold_words)
 
                         gold_f.write(utt_ids[sent_id] + '\t' +
                                      '{}\n'.format(' '.join(gold_words)))
@@ -105,6 +129,11 @@ class Eval(BaseParams):
                                          '{}\n'.format(' '.join(decoded_words)))
                         sent_counter += 1
 
+                    batch_errors = scorer.score(decoded_word_lists, gold_word_lists,
+                                                breakdown=False)
+                    total_errors += np.sum(batch_errors.errors)
+                    total_words += np.sum(batch_errors.ref_words)
+
                 except tf.errors.OutOfRangeError:
                     break
         try:
@@ -113,146 +142,426 @@ class Eval(BaseParams):
             score = 0.0
 
         print ("Total sentences: %d" %sent_counter)
+        print ("Sentences at max decode length: %d" %max_len_counter)
         print ("Output at: %s" %str(raw_asr_file))
         print ("Score: %f" %score)
         return score
 
-    def exec_tf_code(self, sess):
-        """Executes the TF side for encoder and returns the relevant info
-        from TFRecords."""
-        enc_start_time = time.time()
-
-        hidden_states_list, utt_id_list, gold_id_list = [], [], []
-        total_exec = False
-        sess.run(self.model.data_iter.initializer)
-        counter = 0
+    def teacher_forced_loss(self, sess):
+        """Cross entropy loss of the loss model, i.e. with the decoder fed
+        the ground truth, averaged over all the utterances."""
+        loss_model = self.loss_model
+        sess.run(loss_model.data_iter.initializer)
+        output_feed = [loss_model.losses["char"], loss_model.seq_len_target["char"]]
+        total_loss, num_utts = 0.0, 0
         while True:
             try:
-                char_enc_layer = self.model.params.num_layers["char"]
-                output_feed = [self.model.encoder_hidden_states[char_enc_layer],
-                               self.model.seq_len_encs[char_enc_layer],
-                               self.model.decoder_inputs["utt_id"],
-                               self.model.decoder_inputs["char"]]
+                batch_loss, seq_lens = sess.run(output_feed)
+            except tf.errors.OutOfRangeError:
+                break
+            # The batch loss is averaged over the utterances of the batch
+            total_loss += batch_loss * len(seq_lens)
+            num_utts += len(seq_lens)
+        return total_loss / max(num_utts, 1)
+
+    def iter_encoder_outputs(self, sess, cache_writer=None):
+        """Generator executing the TF side for encoder, which yields the
+        encoder outputs, utterance ID and gold IDs of each utterance of the
+        TFRecords. The outputs are also added to the encoder cache writer, if
+        any, which is closed once all the data has been processed, or aborted
+        if the generator fails or is closed early."""
+        enc_start_time = time.time()
 
-                encoder_hidden_states, seq_lens, utt_ids, gold_ids = sess.run(output_feed)
+        sess.run(self.model.data_iter.initializer)
+        char_enc_layer = self.model.params.num_layers["char"]
+        output_feed = [self.model.encoder_hidden_states[char_enc_layer],
+                       self.model.seq_len_encs[char_enc_layer],
+                       self.model.decoder_inputs["utt_id"],
+                       self.model.decoder_inputs["char"]]
+        try:
+            while True:
+                try:
+                    encoder_hidden_states, seq_lens, utt_ids, gold_ids = sess.run(output_feed)
+                except tf.errors.OutOfRangeError:
+                    break
                 encoder_hidden_states = np.asarray(encoder_hidden_states)
                 batch_size = encoder_hidden_states.shape[0]
                 for idx in xrange(batch_size):
-                    hidden_states_list.append(encoder_hidden_states[idx, :seq_lens[idx], :])
-                    utt_id_list.append(utt_ids[idx])
-                    gold_id_list.append(np.array(gold_ids[1:, idx]))  # Ignore the GO_ID
-                    counter += 1
-                #if counter > 500:
-                #    break
-            except tf.errors.OutOfRangeError:
-                total_exec = True
-                break
-
+                    hidden_states = encoder_hidden_states[idx, :seq_lens[idx], :]
+                    utt_gold_ids = np.array(gold_ids[1:, idx])  # Ignore the GO_ID
+                    if cache_writer is not None:
+                        cache_writer.add(hidden_states, utt_ids[idx], utt_gold_ids)
+                    yield hidden_states, utt_ids[idx], utt_gold_ids
+        except BaseException:
+            # Including GeneratorExit when closed before the end
+            if cache_writer is not None:
+                cache_writer.abort()
+            raise
+
+        if cache_writer is not None:
+            cache_writer.close()
         enc_time = time.time() - enc_start_time
         print ("TF side done, time taken: %s" %timedelta(seconds=enc_time))
-        return total_exec, hidden_states_list, utt_id_list, gold_id_list
+
+    def exec_tf_code(self, sess, cache_writer=None):
+        """Executes the TF side for encoder and returns the relevant info
+        from TFRecords. The outputs of each utterance are also added to the
+        encoder cache writer, if any."""
+        hidden_states_list, utt_id_list, gold_id_list = [], [], []
+        for hidden_states, utt_id, gold_ids in self.iter_encoder_outputs(
+                sess, cache_writer=cache_writer):
+            hidden_states_list.append(hidden_states)
+            utt_id_list.append(utt_id)
+            gold_id_list.append(gold_ids)
+        return True, hidden_states_list, utt_id_list, gold_id_list
+
+    def get_cache_dir(self, ckpt_path, beam_search_params, dev=False, data_files=()):
+        """Encoder cache directory, or None without a checkpoint, and dtype
+        for the checkpoint, search params and data."""
+        # With float16 precision beam search stores the encoder outputs in
+        # half precision anyway
+        cache_dtype = (np.float16 if beam_search_params.precision == "float16"
+                       else np.float32)
+        cache_dir = (None if ckpt_path is None else encoder_cache.get_cache_dir(
+            ckpt_path, data_files, ("dev" if dev else "test"), cache_dtype))
+        return cache_dir, cache_dtype
+
+    def get_encoder_outputs(self, sess, cache_dir, cache_writer=None):
+        """Encoder outputs, utterance IDs and gold IDs of all the utterances,
+        from the cache if it's complete and otherwise by executing the TF side,
+        with the outputs added to the cache writer, if any."""
+        if encoder_cache.is_cache_complete(cache_dir):
+            if self.encoder_cache is None or self.encoder_cache.cache_dir != cache_dir:
+                self.encoder_cache = encoder_cache.EncoderCache(cache_dir)
+            print ("Loaded encoder outputs from %s" %cache_dir)
+            return self.encoder_cache.get_lists()
+        # Execute the tensorflow part first to get the encoder_hidden_states etc
+        _, hidden_states_list, utt_id_list, gold_id_list =\
+            self.exec_tf_code(sess, cache_writer=cache_writer)
+        return hidden_states_list, utt_id_list, gold_id_list
+
+    def get_gold_words(self, gold_id_list):
+        """Relevant words of the gold ID sequences."""
+        return [data_utils.get_relevant_words(self.detokenizer.decode(gold_ids))[1]
+                for gold_ids in gold_id_list]
+
+    def decode_errors(self, ckpt_path, hidden_states_list, gold_word_lists,
+                      beam_search_params, data_key, cache_utts=None):
+        """Beam search the encoder outputs and return the word errors of each
+        utterance against its gold words, as returned by WordErrorScorer.score
+        without the breakdown. The data_key and cache_utts identify the
+        utterances as in run_beam_search."""
+        beam_output_list, _ = self.run_beam_search(ckpt_path, hidden_states_list,
+                                                   beam_search_params, data_key, cache_utts)
+        decoded_word_lists = [
+            data_utils.get_relevant_words(self.detokenizer.decode(beam_output))[1]
+            for beam_output in beam_output_list]
+        return wer_scorer.WordErrorScorer().score(decoded_word_lists, gold_word_lists,
+                                                  breakdown=False)
 
     def beam_search_decode(self, sess, ckpt_path, beam_search_params=None,
-                           dev=False, get_out_file=False):
-        """Beam search decoding done via numpy implementation of attention decoder."""
+                           dev=False, get_out_file=False, data_files=()):
+        """Beam search decoding done via numpy implementation of attention decoder.
+        The encoder outputs are cached for the checkpoint and data_files.
+        Without a cache and with the pipeline_queue_size search param, the
+        encoder and beam search run overlapped and the outputs are written
+        as they are decoded."""
         params = self.params
 
-        def get_tf_exec_file():
-            out_dir = path.dirname(ckpt_path)
-            suffix = ("dev" if dev else "test")
-            tf_out_file = path.join(out_dir, "tf_out_" + suffix + ".pkl")
-            return tf_out_file
-
-        tf_out_file = get_tf_exec_file()
-        load_success = True
-        try:
-            hidden_states_list, utt_id_list, gold_id_list = pickle.load(open(tf_out_file, "r"))
-            print ("Loaded output of previous execution of TF from %s" %tf_out_file)
-        except EOFError:
-            load_success = False
-        except IOError:
-            load_success = False
-        #load_success = False
-
-        if not load_success:
-            # Execute the tensorflow part first to get the encoder_hidden_states etc
-            total_exec, hidden_states_list, utt_id_list, gold_id_list = self.exec_tf_code(sess)
-            if total_exec:
-                # All the data has been processed
-                with open(tf_out_file, "w") as pkl_f:
-                    pickle.dump([hidden_states_list, utt_id_list, gold_id_list], pkl_f)
-                    print (("Stored TF output for " + ("dev" if dev else "test")
-                            + " at %s") %(tf_out_file))
-
-        print ("Total instances: %d" %len(hidden_states_list))
-        rev_normalizer = swbd_utils.reverse_swbd_normalizer()
-
-
-        beam_search = BeamSearch(ckpt_path, search_params=beam_search_params)
-
-        beam_output_list = []
-        for idx, hidden_states in enumerate(hidden_states_list):
-            beam_output_list.append(beam_search(hidden_states))
-            if (idx + 1) % 100 == 0:
-                print ("Counter: %d" %(idx + 1))
-
-        print ("Beam search done!")
-
+        cache_dir, cache_dtype = self.get_cache_dir(ckpt_path, beam_search_params, dev,
+                                                    data_files)
+        cache_complete = encoder_cache.is_cache_complete(cache_dir)
+        cache_writer = (None if cache_dir is None or cache_complete else
+                        encoder_cache.EncoderCacheWriter(cache_dir, cache_dtype))
 
         beam_size = beam_search_params.beam_size
         gold_asr_file = path.join(params.best_model_dir, 'gold.txt')
         raw_asr_file = path.join(params.best_model_dir, 'raw_' + str(beam_size) + '.txt')
 
-        total_errors, total_words = 0, 0
-        ins_errs, del_errs, sub_errs = 0, 0, 0
+        utt_id_list, utt_frames, output_lens = [], [], []
+        decoded_word_lists, gold_word_lists = [], []
+        # N-best lists and the words of their hypotheses for rescoring
+        nbest_lists, nbest_word_lists = [], []
         with open(gold_asr_file, 'w') as gold_f, open(raw_asr_file, 'w') as raw_dec_f:
-            for utt_id, gold_ids, beam_output in zip(utt_id_list, gold_id_list, beam_output_list):
-                decoded_asr = self.wp_array_to_sent(
-                    beam_output, self.rev_char_vocab, rev_normalizer)
-                gold_asr = self.wp_array_to_sent(
-                    gold_ids, self.rev_char_vocab, rev_normalizer)
-
-                raw_asr_words, decoded_words = data_utils.get_relevant_words(decoded_asr)
-
-                _, gold_words = data_utils.get_relevant_words(gold_asr)
-                distance_calc = ed(decoded_words, gold_words) # Turn decoded_words into gold_words
-                for (code, i1, i2, j1, j2) in distance_calc.get_opcodes():
-                    if code == "insert":
-                        ins_errs += j2 - j1
-                    elif code == "delete":
-                        del_errs += i2 - i1
-                    elif code == "replace":
-                        sub_errs += j2 - j1
-                        #assert(j2 -j1 == i2 - i1)
-
-                total_errors += distance_calc.distance()
-                total_words += len(gold_words)
 
+            def score_output(utt_id, gold_ids, num_frames, beam_output, utt_nbest):
+                """Collect the words of the output of an utterance for scoring
+                and write it out."""
+                raw_asr_words, decoded_words = data_utils.get_relevant_words(
+                    self.detokenizer.decode(beam_output))
+                _, gold_words = data_utils.get_relevant_words(
+                    self.detokenizer.decode(gold_ids))
+                decoded_word_lists.append(decoded_words)
+                gold_word_lists.append(gold_words)
+
+                if utt_nbest is not None:
+                    nbest_lists.append(utt_nbest)
+                    nbest_word_lists.append([
+                        data_utils.get_relevant_words(self.detokenizer.decode(index_seq))[1]
+                        for index_seq in utt_nbest.index_seqs])
+
+                utt_id_list.append(utt_id)
+                utt_frames.append(num_frames)
+                output_lens.append(len(beam_output))
                 gold_f.write(utt_id + '\t' + '{}\n'.format(' '.join(gold_words)))
                 raw_dec_f.write(utt_id + '\t' + '{}\n'.format(' '.join(raw_asr_words)))
 
+            # The decoder and its workers, if any, are set up before the beam
+            # search timing starts
+            if cache_writer is not None and beam_search_params.pipeline_queue_size > 0:
+                pipeline = PipelinedBeamSearch(
+                    self.get_beam_search(ckpt_path, beam_search_params),
+                    beam_search_params.decode_workers, beam_search_params.pipeline_queue_size)
+                encoder_outputs = self.iter_encoder_outputs(sess, cache_writer=cache_writer)
+                try:
+                    beam_start_time = time.time()
+                    self.run_pipelined_beam_search(pipeline, encoder_outputs,
+                                                   beam_search_params, score_output)
+                    beam_time = time.time() - beam_start_time
+                finally:
+                    # If decoding failed, this removes the partial encoder cache
+                    encoder_outputs.close()
+                    pipeline.close()
+                print ("Total instances: %d" %len(utt_id_list))
+            else:
+                hidden_states_list, cached_utt_ids, gold_id_list =\
+                    self.get_encoder_outputs(sess, cache_dir, cache_writer)
+                print ("Total instances: %d" %len(hidden_states_list))
+
+                # The outputs are in the cache once it's complete, also if
+                # they were just computed
+                cache_utts = ((cache_dir, range(len(hidden_states_list)))
+                              if encoder_cache.is_cache_complete(cache_dir) else None)
+                self.prepare_beam_search(ckpt_path, hidden_states_list, beam_search_params,
+                                         cache_dir, cache_utts)
+                beam_start_time = time.time()
+                beam_output_list, utt_nbest_lists = self.run_beam_search(
+                    ckpt_path, hidden_states_list, beam_search_params, cache_dir, cache_utts)
+                beam_time = time.time() - beam_start_time
+                for utt_idx, beam_output in enumerate(beam_output_list):
+                    score_output(cached_utt_ids[utt_idx], gold_id_list[utt_idx],
+                                 hidden_states_list[utt_idx].shape[0], beam_output,
+                                 (None if utt_nbest_lists is None else utt_nbest_lists[utt_idx]))
+
+        print ("Beam search done, time taken: %s" %timedelta(seconds=beam_time))
+        print ("Beam search seconds: %.2f" %beam_time)
+        self.beam_time = beam_time
+        decode_stats = self.decode_stats
+        print ("Hypotheses expanded: %d, dropped: %d, early stopped utterances: %d"
+               %(np.sum(decode_stats.expansions), np.sum(decode_stats.dropped),
+                 np.sum(decode_stats.early_stop_steps >= 0)))
+        print ("Utterances at max decode length: %d" %np.sum(decode_stats.hit_max_len))
+        if beam_search_params.profile:
+            profile_file = path.join(
+                params.best_model_dir, "beam_profile_" + ("dev" if dev else "test")
+                + "_" + str(beam_search_params.beam_size) + ".json")
+            self.dump_beam_profile(profile_file, beam_time, utt_id_list,
+                                   utt_frames, output_lens, beam_search_params)
+
+        scorer = wer_scorer.WordErrorScorer()
+        errors = scorer.score(decoded_word_lists, gold_word_lists)
         try:
-            score = float(total_errors)/float(total_words)
+            score = float(np.sum(errors.errors))/float(np.sum(errors.ref_words))
         except ZeroDivisionError:
             score = 0.0
 
         print ("Output at: %s" %str(raw_asr_file))
         print ("Score: %f" %score)
-        print ("Insertion: %d, Deletion: %d, Substitution: %d" %(ins_errs, del_errs, sub_errs))
-        #assert(total_errors == ins_errs + del_errs + sub_errs)
-        #print (total_errors)
+        print ("Insertion: %d, Deletion: %d, Substitution: %d"
+               %(np.sum(errors.ins), np.sum(errors.dels), np.sum(errors.subs)))
+        if beam_search_params.save_nbest:
+            # Score the hypotheses of all the N-best lists in one go
+            num_hyps = [len(hyp_word_lists) for hyp_word_lists in nbest_word_lists]
+            hyp_errors = scorer.score(
+                [hyp_words for hyp_word_lists in nbest_word_lists for hyp_words in hyp_word_lists],
+                [gold_words for gold_words, utt_num_hyps in zip(gold_word_lists, num_hyps)
+                 for _ in xrange(utt_num_hyps)], breakdown=False).errors
+            nbest_errors = np.split(hyp_errors, np.cumsum(num_hyps)[:-1])
+            nbest_file = self.get_nbest_file(dev, beam_size)
+            nbest.save_nbest(nbest_file, utt_id_list, nbest_lists, nbest_errors,
+                             errors.ref_words, beam_search_params)
+            print ("N-best at: %s" %nbest_file)
         if get_out_file:
             return score, raw_asr_file
         else:
             return score
 
-    @staticmethod
-    def wp_array_to_sent(wp_array, reverse_char_vocab, normalizer):
-        """Convert word piece ID list to sentence."""
-        wp_id_list = list(wp_array)
-        if data_utils.EOS_ID in wp_id_list:
-            wp_id_list = wp_id_list[:wp_id_list.index(data_utils.EOS_ID)]
-        wp_list = [tf.compat.as_str(reverse_char_vocab[int(piece_id)])
-                   for piece_id in wp_id_list]
-        sent = (''.join(wp_list).replace('▁', ' ')).strip()
-        return normalizer(sent)
+    def get_beam_search(self, ckpt_path, beam_search_params):
+        """Beam search decoder of the checkpoint with the search params set.
+        The decoder is reused across decoding runs with the same checkpoint,
+        LM and precision, e.g. by a grid search."""
+        beam_search_key = (ckpt_path, beam_search_params.precision,
+                           beam_search_params.lm_path, beam_search_params.lm_type)
+        if self.beam_search is None or self.beam_search_key != beam_search_key:
+            self.beam_search = BeamSearch(ckpt_path, search_params=beam_search_params)
+            self.beam_search_key = beam_search_key
+        else:
+            self.beam_search.set_search_params(beam_search_params)
+        return self.beam_search
+
+    def get_nbest_file(self, dev, beam_size):
+        """File of the N-best lists saved by beam_search_decode."""
+        return path.join(self.params.best_model_dir, "nbest_" + ("dev" if dev else "test")
+                         + "_" + str(beam_size) + ".npz")
+
+    def get_parallel_beam_search(self, ckpt_path, hidden_states_list, beam_search_params,
+                                 data_key, cache_utts=None):
+        """Worker pool decoding the utterances, reused if it was created for
+        the same checkpoint, precision, LM and data as in run_beam_search."""
+        decode_workers = beam_search_params.decode_workers
+        pool_key = (ckpt_path, beam_search_params.precision, beam_search_params.lm_path,
+                    beam_search_params.lm_type, data_key, decode_workers)
+        # A pool created without the LSTM LM is recreated once it's used,
+        # so that the LM is loaded once and shared instead of per worker
+        needs_lm = (beam_search_params.lm_weight != 0.0 and
+                    beam_search_params.lm_type == "lstm")
+        if (self.parallel_beam_search is None or self.parallel_pool_key != pool_key or
+                (needs_lm and not self.parallel_beam_search.shares_lm)):
+            self.close_parallel_beam_search()
+            beam_search = self.get_beam_search(ckpt_path, beam_search_params)
+            self.parallel_beam_search = ParallelBeamSearch(
+                beam_search, hidden_states_list, decode_workers, cache_utts)
+            self.parallel_pool_key = pool_key
+        return self.parallel_beam_search
+
+    def prepare_beam_search(self, ckpt_path, hidden_states_list, beam_search_params,
+                            data_key, cache_utts=None):
+        """Set up the decoder, or the worker pool with multiple decode
+        workers, used by run_beam_search with the same arguments, so that
+        the decoding can be timed without loading the weights or starting
+        the workers."""
+        if beam_search_params.decode_workers > 1:
+            self.get_parallel_beam_search(ckpt_path, hidden_states_list, beam_search_params,
+                                          data_key, cache_utts)
+        else:
+            self.get_beam_search(ckpt_path, beam_search_params)
+
+    def run_beam_search(self, ckpt_path, hidden_states_list, beam_search_params,
+                        data_key, cache_utts=None):
+        """Run beam search over the encoder outputs of all utterances. Returns
+        the outputs and, if the save_nbest search param is set, the N-best
+        lists of the utterances.
+
+        With multiple decode workers the worker pool is kept alive across calls
+        for the same checkpoint, precision, LM and data (identified by
+        data_key), so that different search params, e.g. of a grid search,
+        reuse the workers. If the encoder outputs are in the encoder cache,
+        cache_utts is their (cache_dir, cache_indices) there, from which the
+        workers read them.
+        The per utterance decode stats are stored in self.decode_stats and the
+        phase times in self.beam_profiler."""
+        if beam_search_params.decode_workers > 1:
+            parallel_beam_search = self.get_parallel_beam_search(
+                ckpt_path, hidden_states_list, beam_search_params, data_key, cache_utts)
+            outputs = parallel_beam_search(beam_search_params)
+            self.decode_stats = parallel_beam_search.decode_stats
+            self.beam_profiler = parallel_beam_search.profiler
+            return outputs
+
+        beam_search = self.get_beam_search(ckpt_path, beam_search_params)
+        beam_search.profiler.reset()
+        self.beam_profiler = beam_search.profiler
+
+        save_nbest = beam_search_params.save_nbest
+        decode_batch_size = max(beam_search_params.decode_batch_size, 1)
+        # Batch utterances of similar length together to minimize padding
+        sorted_indices = sorted(range(len(hidden_states_list)),
+                                key=lambda idx: hidden_states_list[idx].shape[0])
+        beam_output_list = [None] * len(hidden_states_list)
+        nbest_lists = ([None] * len(hidden_states_list) if save_nbest else None)
+        self.decode_stats = BeamSearch.init_decode_stats(len(hidden_states_list))
+        for batch_start in xrange(0, len(sorted_indices), decode_batch_size):
+            batch_indices = sorted_indices[batch_start:batch_start + decode_batch_size]
+            batch_outputs = beam_search.decode_batch(
+                [hidden_states_list[idx] for idx in batch_indices], return_nbest=save_nbest)
+            if save_nbest:
+                batch_outputs, batch_nbest_lists = batch_outputs
+                for idx, utt_nbest in zip(batch_indices, batch_nbest_lists):
+                    nbest_lists[idx] = utt_nbest
+            for idx, beam_output in zip(batch_indices, batch_outputs):
+                beam_output_list[idx] = beam_output
+            for key, values in beam_search.decode_stats.items():
+                self.decode_stats[key][batch_indices] = values
+
+            counter = batch_start + len(batch_indices)
+            if counter // 100 != batch_start // 100:
+                print ("Counter: %d" %counter)
+
+        if beam_search.use_lm:
+            print ("LM cache hits: %d, misses: %d" %(beam_search.lm_cache.hits,
+                                                      beam_search.lm_cache.misses))
+        if beam_search.dec_shortlist is not None:
+            print ("Shortlist softmax rows: %d, full softmax rows: %d"
+                   %(beam_search.dec_shortlist.short_rows, beam_search.dec_shortlist.full_rows))
+        return beam_output_list, nbest_lists
+
+    def run_pipelined_beam_search(self, pipeline, utterances, beam_search_params,
+                                  on_output):
+        """Run beam search with the PipelinedBeamSearch pipeline over the
+        (encoder outputs, utterance ID, gold IDs) of the utterances while they
+        are being produced, calling on_output with the utterance ID, gold IDs,
+        number of encoder frames, output and N-best list (or None) of each
+        utterance as it's decoded. The decode
+        stats, in the order of decoding, are stored in self.decode_stats and
+        the phase times in self.beam_profiler."""
+        utt_stats_list = []
+
+        def on_utt_output(utt_info, num_frames, beam_output, utt_nbest, utt_stats):
+            utt_stats_list.append(utt_stats)
+            utt_id, gold_ids = utt_info
+            on_output(utt_id, gold_ids, num_frames, beam_output, utt_nbest)
+            if len(utt_stats_list) % 100 == 0:
+                print ("Counter: %d" %len(utt_stats_list))
+
+        pipeline(((hidden_states, (utt_id, gold_ids))
+                  for hidden_states, utt_id, gold_ids in utterances),
+                 beam_search_params, on_utt_output)
+
+        self.decode_stats = BeamSearch.init_decode_stats(len(utt_stats_list))
+        for key in self.decode_stats:
+            self.decode_stats[key][:] = [utt_stats[key] for utt_stats in utt_stats_list]
+        self.beam_profiler = pipeline.profiler
+
+    def dump_beam_profile(self, profile_file, beam_time, utt_id_list,
+                          utt_frames, output_lens, beam_search_params):
+        """Dump the beam search phase times and decode stats as a JSON summary
+        alongwith a record per utterance."""
+        decode_stats = self.decode_stats
+        total_steps = int(np.sum(decode_stats.steps))
+        total_expansions = int(np.sum(decode_stats.expansions))
+        summary = self.beam_profiler.summary()
+        summary.update({
+            "beam_seconds": beam_time,
+            "utterances": len(utt_id_list),
+            "utterances_per_second": len(utt_id_list) / max(beam_time, 1e-6),
+            "utterance_steps": total_steps,
+            "hypotheses_expanded": total_expansions,
+            "hypotheses_per_second": total_expansions / max(beam_time, 1e-6),
+            "early_stopped": int(np.sum(decode_stats.early_stop_steps >= 0)),
+            "at_max_len": int(np.sum(decode_stats.hit_max_len))})
+
+        utt_records = []
+        for utt_idx, utt_id in enumerate(utt_id_list):
+            utt_records.append({
+                "utt_id": utt_id,
+                "frames": int(utt_frames[utt_idx]),
+                "output_len": int(output_lens[utt_idx]),
+                "steps": int(decode_stats.steps[utt_idx]),
+                "expansions": int(decode_stats.expansions[utt_idx]),
+                "dropped": int(decode_stats.dropped[utt_idx]),
+                "early_stop_step": int(decode_stats.early_stop_steps[utt_idx]),
+                "at_max_len": bool(decode_stats.hit_max_len[utt_idx])})
+
+        with open(profile_file, "w") as profile_f:
+            json.dump({"search_params": dict(beam_search_params), "summary": summary,
+                       "utterances": utt_records}, profile_f, indent=1, sort_keys=True)
+        print ("Beam profile at: %s" %profile_file)
+        print ("  ".join("%s: %.2fs" %(phase, summary["phases"][phase]["seconds"])
+                         for phase in self.beam_profiler.PHASES))
+
+    def close_parallel_beam_search(self):
+        """Shut down the beam search worker pool, if any."""
+        if self.parallel_beam_search is not None:
+            self.parallel_beam_search.close()
+            self.parallel_beam_search = None
+            self.parallel_pool_key = None
@@ -1,11 +1,22 @@
+from __future__ import division
 from __future__ import print_function
 
 from os import path
 
 import argparse
+import copy
+import json
+import math
+import shlex
 import subprocess
 import sys
+import time
 import numpy as np
+from bunch import Bunch
+
+import encoder_cache
+import main
+from nbest import load_nbest, NBestRescorer
 
 
 def parse_options():
@@ -15,7 +26,42 @@ def parse_options():
                         help="Command file to run the model")
     parser.add_argument("-use_lm", default=False, action="store_true",
                         help="Use LM in decoding")
+    parser.add_argument("-rescore", default=False, action="store_true",
+                        help="Decode once per beam size and rescore the N-best lists "
+                        "for the coverage penalty and LM weight options")
+    parser.add_argument("-nbest_lm_weight", default=None, type=float,
+                        help="LM weight used for producing the N-best lists for rescoring; "
+                        "defaults to the middle LM weight option")
+    parser.add_argument("-results_file", default="", type=str,
+                        help="JSON lines file of the grid search results, by default "
+                        "grid_results.jsonl next to the command file")
+    parser.add_argument("-search", default="grid", type=str, choices=["grid", "halving"],
+                        help="Search over the configs: the full grid with an early break "
+                        "on the LM weight, or successive halving on dev subsets")
+    parser.add_argument("-beam_sizes", default="4,8,16", type=str,
+                        help="Comma separated beam size options")
+    parser.add_argument("-lm_weights", default="", type=str,
+                        help="Comma separated LM weight options, by default 0, 0.05 and "
+                        "0.1 with -use_lm and otherwise 0")
+    parser.add_argument("-cov_penalties", default="", type=str,
+                        help="Comma separated coverage penalty options, by default 5 "
+                        "values from 0.05 to 0.25")
+    parser.add_argument("-word_ins_penalties", default="0", type=str,
+                        help="Comma separated word insertion penalty options")
+    parser.add_argument("-initial_utts", default=200, type=int,
+                        help="Dev utterances of the first successive halving round")
+    parser.add_argument("-eta", default=2.0, type=float,
+                        help="Successive halving keeps the best 1/eta of the configs "
+                        "and grows the dev subset eta times each round")
+    parser.add_argument("-seed", default=0, type=int,
+                        help="Seed of the dev subsets and bootstrap samples")
+    parser.add_argument("-num_bootstrap", default=1000, type=int,
+                        help="Bootstrap samples of the WER difference intervals")
+    parser.add_argument("-confidence", default=0.95, type=float,
+                        help="Confidence level of the WER difference intervals")
     args = parser.parse_args()
+    if args.eta <= 1:
+        parser.error("-eta should be greater than 1")
     return args
 
 
@@ -25,95 +71,383 @@ def read_command(cmd_file):
         cmd = cmd_f.readline().strip()
         return cmd
 
-def parse_output(output_str):
-    out_file_pattern = "Output at:"
-    score_pattern = "Score: "
-    for out_line in output_str.splitlines():
-        if out_file_pattern in out_line:
-            out_file = out_line.split(out_file_pattern)[1]
-        elif score_pattern in out_line:
-            score = float(out_line.split(score_pattern)[1])
-    return score, out_file
+
+def get_main_argv(cmd):
+    """Arguments of main.py in the command."""
+    tokens = shlex.split(cmd)
+    for idx, token in enumerate(tokens):
+        if token.endswith("main.py"):
+            return tokens[idx + 1:]
+    return tokens
+
+
+def parse_floats(options_str):
+    """Floats of a comma separated string."""
+    return [float(option) for option in options_str.split(",") if option.strip()]
+
+
+def bootstrap_interval(error_diffs, ref_words, num_samples, confidence, rng):
+    """Paired bootstrap confidence interval of the WER difference of two
+    configs from their per utterance error differences on the same
+    utterances, with the utterances resampled with replacement."""
+    num_utts = error_diffs.shape[0]
+    samples = rng.randint(0, num_utts, size=(num_samples, num_utts))
+    wer_diffs = (np.sum(error_diffs[samples], axis=1) /
+                 np.maximum(np.sum(ref_words[samples], axis=1), 1))
+    tail = 100.0 * (1.0 - confidence) / 2
+    return np.percentile(wer_diffs, [tail, 100.0 - tail])
+
+
+# Version of the stored results, 2 since beam search applies the coverage
+# penalty like the N-best rescoring does
+RESULTS_VERSION = 2
+
+
+class GridResults(object):
+    """Resumable store of the WERs of beam search configs.
+
+    Each result is a JSON line appended as soon as it's known, keyed by the
+    split, checkpoint, beam size, coverage penalty, LM weight and word
+    insertion penalty, so an interrupted search resumes where it stopped and
+    results of another checkpoint are never reused. Results of an older
+    RESULTS_VERSION, whose scoring differs, are ignored."""
+
+    def __init__(self, results_file):
+        self.results_file = results_file
+        self.results = {}
+        # Whether the file ends with a partially written line
+        self.partial_line = False
+        if path.isfile(results_file):
+            with open(results_file) as results_f:
+                contents = results_f.read()
+            self.partial_line = not contents.endswith("\n")
+            num_stale = 0
+            for line in contents.splitlines():
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # Partially written line of an interrupted search
+                    continue
+                if result.get("version", 1) != RESULTS_VERSION:
+                    num_stale += 1
+                    continue
+                self.results[self.get_key(result)] = result
+            print ("Loaded %d entries from grid search, ignored %d of older versions"
+                   %(len(self.results), num_stale))
+            sys.stdout.flush()
+
+    @staticmethod
+    def get_key(result):
+        # Results stored without the word insertion penalty were decoded
+        # with its default of 0
+        return (result["split"], result["ckpt_path"], int(result["beam_size"]),
+                round(result["cov_penalty"], 4), round(result["lm_weight"], 4),
+                round(result.get("word_ins_penalty", 0.0), 4))
+
+    def get(self, split, ckpt_path, beam_size, cov_penalty, lm_weight, word_ins_penalty):
+        """Stored result of the config, or None."""
+        return self.results.get((split, ckpt_path, beam_size, round(cov_penalty, 4),
+                                 round(lm_weight, 4), round(word_ins_penalty, 4)))
+
+    def add(self, result):
+        result = dict(result, version=RESULTS_VERSION)
+        self.results[self.get_key(result)] = result
+        with open(self.results_file, "a") as results_f:
+            if self.partial_line:
+                results_f.write("\n")
+                self.partial_line = False
+            results_f.write(json.dumps(result, sort_keys=True) + "\n")
+
+
+class BeamGridSearch(object):
+    """Beam search decoding of the dev or test set for many configs in one
+    process. The model is restored, the encoder outputs cached and the beam
+    search decoder created once, and the results are kept in a GridResults
+    store, if any."""
+
+    def __init__(self, options, results=None):
+        self.options = options
+        self.results = results
+        self.split = ("dev" if options.dev else "test")
+        self.evaluation = main.create_eval(options)
+        # Encoder outputs and gold words for decoding utterance subsets
+        self.data = None
+
+    def get_search_params(self, beam_size, cov_penalty, lm_weight, word_ins_penalty=0.0,
+                          save_nbest=False):
+        search_params = copy.deepcopy(self.options.beam_search_params)
+        search_params.beam_size = beam_size
+        search_params.cov_penalty = cov_penalty
+        search_params.lm_weight = lm_weight
+        search_params.word_ins_penalty = word_ins_penalty
+        search_params.save_nbest = save_nbest
+        return search_params
+
+    def decode(self, search_params):
+        """Decode the data with the search params and return the WER, output
+        file and decoding seconds."""
+        evaluation = self.evaluation
+        start_time = time.time()
+        asr_perf, out_file = evaluation.eval_model.beam_search_decode(
+            evaluation.sess, evaluation.ckpt_path, beam_search_params=search_params,
+            dev=self.options.dev, get_out_file=True,
+            data_files=evaluation.data_set.data_files)
+        return asr_perf, out_file, time.time() - start_time
+
+    def make_result(self, beam_size, cov_penalty, lm_weight, word_ins_penalty, asr_perf,
+                    source, **kwargs):
+        result = dict(split=self.split, ckpt_path=self.evaluation.ckpt_path,
+                      beam_size=beam_size, cov_penalty=round(cov_penalty, 4),
+                      lm_weight=round(lm_weight, 4),
+                      word_ins_penalty=round(word_ins_penalty, 4),
+                      asr_perf=asr_perf, source=source)
+        result.update(kwargs)
+        return result
+
+    def get_result(self, beam_size, cov_penalty, lm_weight, word_ins_penalty):
+        """Stored result of the config, or None, also when there is no store."""
+        if self.results is None:
+            return None
+        return self.results.get(self.split, self.evaluation.ckpt_path, beam_size,
+                                cov_penalty, lm_weight, word_ins_penalty)
+
+    def add_result(self, result):
+        if self.results is not None:
+            self.results.add(result)
+
+    def evaluate(self, beam_size, cov_penalty, lm_weight, word_ins_penalty=0.0,
+                 redecode=False):
+        """Result of the config from the store, or else from decoding. With
+        redecode the config is always decoded, e.g. when its output file is
+        needed, as the files are overwritten by later decodes."""
+        result = (None if redecode else
+                  self.get_result(beam_size, cov_penalty, lm_weight, word_ins_penalty))
+        if result is None:
+            asr_perf, out_file, seconds = self.decode(
+                self.get_search_params(beam_size, cov_penalty, lm_weight, word_ins_penalty))
+            result = self.make_result(beam_size, cov_penalty, lm_weight, word_ins_penalty,
+                                      asr_perf, "decode", out_file=out_file, seconds=seconds)
+            self.add_result(result)
+        return result
+
+    def rescore(self, beam_size, nbest_lm_weight, cov_penalty_options, lm_weight_options,
+                word_ins_penalty_options):
+        """Decode once with the N-best lists saved and store the rescored WERs
+        of the (cov_penalty, lm_weight, word_ins_penalty) options missing from
+        the store."""
+        missing = [(cov_penalty, lm_weight, word_ins_penalty)
+                   for cov_penalty in cov_penalty_options
+                   for lm_weight in lm_weight_options
+                   for word_ins_penalty in word_ins_penalty_options
+                   if self.get_result(beam_size, cov_penalty, lm_weight,
+                                      word_ins_penalty) is None]
+        if not missing:
+            return
+        search_params = self.get_search_params(
+            beam_size, self.options.beam_search_params.cov_penalty, nbest_lm_weight,
+            self.options.beam_search_params.word_ins_penalty, save_nbest=True)
+        self.decode(search_params)
+        rescorer = NBestRescorer(load_nbest(
+            self.evaluation.eval_model.get_nbest_file(self.options.dev, beam_size)))
+        wers = rescorer.get_wers([lm_weight for _, lm_weight, _ in missing],
+                                 [word_ins_penalty for _, _, word_ins_penalty in missing],
+                                 [cov_penalty for cov_penalty, _, _ in missing])
+        for (cov_penalty, lm_weight, word_ins_penalty), asr_perf in zip(missing, wers):
+            self.add_result(self.make_result(beam_size, cov_penalty, lm_weight,
+                                             word_ins_penalty, float(asr_perf), "rescore",
+                                             nbest_lm_weight=nbest_lm_weight))
+
+    def load_data(self):
+        """Encoder outputs and gold words of all the utterances, computed once
+        and cached for the checkpoint as in beam search decoding."""
+        if self.data is None:
+            evaluation = self.evaluation
+            eval_model = evaluation.eval_model
+            cache_dir, cache_dtype = eval_model.get_cache_dir(
+                evaluation.ckpt_path, self.options.beam_search_params, self.options.dev,
+                evaluation.data_set.data_files)
+            cache_writer = (None if cache_dir is None or encoder_cache.is_cache_complete(cache_dir)
+                            else encoder_cache.EncoderCacheWriter(cache_dir, cache_dtype))
+            hidden_states_list, _, gold_id_list = eval_model.get_encoder_outputs(
+                evaluation.sess, cache_dir, cache_writer)
+            gold_word_lists = eval_model.get_gold_words(gold_id_list)
+            self.data = Bunch(cache_dir=cache_dir, hidden_states_list=hidden_states_list,
+                              gold_word_lists=gold_word_lists,
+                              ref_words=np.array([len(gold_words) for gold_words
+                                                  in gold_word_lists], dtype=np.int64))
+        return self.data
+
+    def decode_errors(self, config, utt_indices, data_key):
+        """Word errors of each of the utterances at utt_indices decoded with
+        the (beam_size, cov_penalty, lm_weight, word_ins_penalty) config.
+        data_key identifies the utterances for reusing the decode workers."""
+        data = self.load_data()
+        cache_utts = ((data.cache_dir, utt_indices)
+                      if encoder_cache.is_cache_complete(data.cache_dir) else None)
+        errors = self.evaluation.eval_model.decode_errors(
+            self.evaluation.ckpt_path,
+            [data.hidden_states_list[utt_idx] for utt_idx in utt_indices],
+            [data.gold_word_lists[utt_idx] for utt_idx in utt_indices],
+            self.get_search_params(*config), data_key, cache_utts)
+        return errors.errors
+
+    def close(self):
+        self.evaluation.eval_model.close_parallel_beam_search()
+        self.evaluation.sess.close()
+
+
+def config_str(config):
+    return ("Beam size: %d, cov penalty: %.2f, lm weight: %.2f, word ins penalty: %.2f"
+            %config)
+
+
+def successive_halving(dev_search, configs, args):
+    """Successive halving over the (beam_size, cov_penalty, lm_weight,
+    word_ins_penalty) configs, which decodes all configs on a random dev
+    subset of args.initial_utts utterances and keeps the best 1/args.eta of
+    them for a subset args.eta times larger, until the full dev set. The
+    subsets are nested so each round only decodes the new utterances. Each
+    round reports the WER of the configs and a paired bootstrap interval of
+    their WER difference to the best. Returns the best config."""
+    data = dev_search.load_data()
+    num_utts = len(data.hidden_states_list)
+    rng = np.random.RandomState(args.seed)
+    utt_order = rng.permutation(num_utts)
+
+    # Errors of each config on the utterances of utt_order decoded so far
+    utt_errors = dict((config, np.zeros(0, dtype=np.int64)) for config in configs)
+    num_decoded = 0
+    subset_size = max(min(args.initial_utts, num_utts), 1)
+    round_idx = 0
+    while True:
+        round_idx += 1
+        print ("\nRound %d: %d configs on %d utterances" %(round_idx, len(configs), subset_size))
+        sys.stdout.flush()
+        for config in configs:
+            start = utt_errors[config].shape[0]
+            if start < subset_size:
+                new_errors = dev_search.decode_errors(
+                    config, utt_order[start:subset_size], (data.cache_dir, start, subset_size))
+                utt_errors[config] = np.concatenate([utt_errors[config], new_errors])
+                num_decoded += subset_size - start
+
+        ref_words = data.ref_words[utt_order[:subset_size]]
+        total_words = max(np.sum(ref_words), 1)
+        wers = [np.sum(utt_errors[config]) / total_words for config in configs]
+        configs = [configs[idx] for idx in np.argsort(wers, kind="mergesort")]
+        best_errors = utt_errors[configs[0]]
+        for config in configs:
+            wer_diff = np.sum(utt_errors[config] - best_errors) / total_words
+            lower, upper = bootstrap_interval(utt_errors[config] - best_errors, ref_words,
+                                              args.num_bootstrap, args.confidence, rng)
+            print ("%s: ASR Error: %.4f, diff to best: %.4f (%d%% interval: %.4f to %.4f)" %
+                   (config_str(config), np.sum(utt_errors[config]) / total_words, wer_diff,
+                    int(round(100 * args.confidence)), lower, upper))
+        sys.stdout.flush()
+
+        if subset_size == num_utts:
+            break
+        configs = configs[:int(math.ceil(len(configs) / args.eta))]
+        subset_size = min(int(math.ceil(subset_size * args.eta)), num_utts)
+
+    # Only the results of the full dev set are stored
+    for config in configs:
+        if dev_search.get_result(*config) is None:
+            dev_search.add_result(dev_search.make_result(
+                *config, asr_perf=float(np.sum(utt_errors[config]) / total_words),
+                source="halving"))
+    print ("Utterances decoded: %d, %.1f%% of the full grid" %
+           (num_decoded, 100.0 * num_decoded / (len(utt_errors) * num_utts)))
+    sys.stdout.flush()
+    return configs[0]
 
 
 def grid_search(args):
     """Perform grid search on beam configurations and run the best config on test set."""
     base_cmd = read_command(args.cmd_file)
     cmd_dir = path.dirname(args.cmd_file)
+    main_argv = get_main_argv(base_cmd)
 
-    perf_file = path.join(cmd_dir, "perf.txt")
+    results = GridResults(args.results_file or path.join(cmd_dir, "grid_results.jsonl"))
+    dev_search = BeamGridSearch(main.parse_options(main_argv + ["-dev"]), results)
 
-    dev_cmd = base_cmd + " -eval_dev "
     # Store best performances
     best_asr_perf = 1.00
     best_beam_size = 1
     best_lm_weight = 0
+    best_cov_penalty = 0
+    best_word_ins_penalty = 0
 
-    if args.use_lm:
+    beam_size_options = [int(beam_size) for beam_size in parse_floats(args.beam_sizes)]
+    if args.lm_weights:
+        lm_weight_options = parse_floats(args.lm_weights)
+    elif args.use_lm:
         lm_weight_options = [0, 0.05, 0.1]
     else:
         lm_weight_options = [0]
 
-    cov_penalty_options = list(np.linspace(0.05, 0.25, num=5))#[0, 0.05, 0.1]
-
-    perf_dict = {}
-    if path.isfile(perf_file):
-        try:
-            with open(perf_file, "r") as perf_f:
-                for line in perf_f.readlines():
-                    beam_size, coverage_penalty, lm_weight, asr_perf = line.strip().split()
-                    # Prepare the keys
-                    beam_size = int(beam_size)
-                    coverage_penalty = round(float(coverage_penalty), 4)
-                    lm_weight = round(float(lm_weight), 4)
-                    perf_dict[(beam_size, coverage_penalty, lm_weight)] = float(asr_perf)
-            print ("Loaded %d entries from grid search" %(len(perf_dict)))
-            sys.stdout.flush()
-        except ValueError:
-            perf_dict = {}
+    if args.cov_penalties:
+        cov_penalty_options = parse_floats(args.cov_penalties)
+    else:
+        cov_penalty_options = list(np.linspace(0.05, 0.25, num=5))#[0, 0.05, 0.1]
+    word_ins_penalty_options = parse_floats(args.word_ins_penalties)
+
+    if args.nbest_lm_weight is None:
+        nbest_lm_weight = lm_weight_options[len(lm_weight_options)//2]
+    else:
+        nbest_lm_weight = args.nbest_lm_weight
 
-    with open(perf_file, "a", 0) as perf_f:
-        for beam_size in [4, 8, 16]:
+    if args.search == "halving":
+        configs = [(beam_size, cov_penalty, lm_weight, word_ins_penalty)
+                   for beam_size in beam_size_options
+                   for cov_penalty in cov_penalty_options
+                   for lm_weight in lm_weight_options
+                   for word_ins_penalty in word_ins_penalty_options]
+        best_beam_size, best_cov_penalty, best_lm_weight, best_word_ins_penalty =\
+            successive_halving(dev_search, configs, args)
+    else:
+        for beam_size in beam_size_options:
             print ("\nBeam size: %d" %beam_size)
             sys.stdout.flush()
 
-            for cov_penalty in cov_penalty_options:
-                for lm_weight in lm_weight_options:
-                    query_key = (beam_size, round(cov_penalty, 4), round(lm_weight, 4))
-                    if perf_dict.has_key(query_key):
-                        print ("From previous exec: ", end="")
-                        asr_perf = perf_dict[query_key]
-                    else:
-                        exec_cmd = (dev_cmd + " -beam_size " + str(beam_size)
-                                    + " -cov_penalty " + str(cov_penalty)
-                                    + " -lm_weight " + str(lm_weight))
-                        output = subprocess.check_output(exec_cmd, shell=True)
-                        asr_perf, _= parse_output(output)
-                        perf_f.write("%d %.4f %.4f %f\n" %(beam_size, cov_penalty, lm_weight, asr_perf))
-                        perf_f.flush()
-
-                    print ("ASR Error: %.4f, Beam size: %d, cov penalty: %.2f lm weight: %.2f" %
-                           (asr_perf, beam_size, cov_penalty, lm_weight))
-                    sys.stdout.flush()
-
-                    if asr_perf > (best_asr_perf + 0.05):
-                        # Don't think that lm_weight can
-                        # cause more this gain
-                        print ("Not exploring further increasing lm_weight")
-                        sys.stdout.flush()
-                        break
+            if args.rescore:
+                dev_search.rescore(beam_size, nbest_lm_weight, cov_penalty_options,
+                                   lm_weight_options, word_ins_penalty_options)
 
-                    if best_asr_perf > asr_perf:
-                        print ("Best config updated!!")
+            for word_ins_penalty in word_ins_penalty_options:
+                for cov_penalty in cov_penalty_options:
+                    for lm_weight in lm_weight_options:
+                        result = dev_search.evaluate(beam_size, cov_penalty, lm_weight,
+                                                     word_ins_penalty)
+                        asr_perf = result["asr_perf"]
+                        print ("From %s: ASR Error: %.4f, %s" %
+                               (result["source"], asr_perf,
+                                config_str((beam_size, cov_penalty, lm_weight, word_ins_penalty))))
                         sys.stdout.flush()
-                        best_asr_perf = asr_perf
-                        best_beam_size = beam_size
-                        best_lm_weight = lm_weight
-
-    test_cmd = (base_cmd + " -test " + " -beam_size " + str(best_beam_size) +
-                " -lm_weight " + str(best_lm_weight))
-    output = subprocess.check_output(test_cmd, shell=True)
-    _, out_file = parse_output(output)
+
+                        if asr_perf > (best_asr_perf + 0.05):
+                            # Don't think that lm_weight can
+                            # cause more this gain
+                            print ("Not exploring further increasing lm_weight")
+                            sys.stdout.flush()
+                            break
+
+                        if best_asr_perf > asr_perf:
+                            print ("Best config updated!!")
+                            sys.stdout.flush()
+                            best_asr_perf = asr_perf
+                            best_beam_size = beam_size
+                            best_lm_weight = lm_weight
+                            best_cov_penalty = cov_penalty
+                            best_word_ins_penalty = word_ins_penalty
+    dev_search.close()
+
+    test_search = BeamGridSearch(main.parse_options(main_argv + ["-test"]), results)
+    # The stored output file may since have been overwritten, e.g. by a dev
+    # decode with the same beam size, or be of an older checkpoint
+    out_file = test_search.evaluate(best_beam_size, best_cov_penalty, best_lm_weight,
+                                    best_word_ins_penalty, redecode=True)["out_file"]
+    test_search.close()
 
     # Run the score.sh command finally
     out_dir = path.join(cmd_dir, "final_eval")
@@ -0,0 +1,64 @@
+"""Bounded LRU cache of LM outputs keyed by the hash of the token prefix."""
+
+from collections import OrderedDict
+
+import numpy as np
+
+# FNV-1a constants used for hashing the token prefixes
+FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+FNV_PRIME = np.uint64(0x100000001b3)
+
+
+def extend_prefix_keys(prefix_keys, tokens):
+    """Hash keys of the prefixes extended by one token each. The empty prefix
+    has the key FNV_OFFSET."""
+    return (prefix_keys ^ tokens.astype(np.uint64)) * FNV_PRIME
+
+
+class LMStateCache(object):
+    """LRU cache mapping prefix keys to the LM state and log probs after
+    consuming the prefix. Keeps count of the hits and misses of lookups."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the entry of key, or None if it isn't cached."""
+        try:
+            entry = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # Reinsert to mark the entry as the most recently used
+        self.entries[key] = entry
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        """Add an entry, evicting the least recently used one if full."""
+        if self.capacity <= 0:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = entry
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def resize(self, capacity):
+        """Change the capacity, evicting the least recently used entries
+        beyond it."""
+        self.capacity = capacity
+        while len(self.entries) > max(capacity, 0):
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all the entries and reset the counters."""
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return (float(self.hits)/total if total else 0.0)
@@ -38,7 +38,8 @@ from train import Train
 from beam_search import BeamSearch
 
 
-def parse_options():
+def parse_options(argv=None):
+    """Parse the options of argv, by default the command line."""
     parser = argparse.ArgumentParser()
 
     Train.add_parse_options(parser)
@@ -52,7 +53,7 @@ def parse_options():
                         help="Get dev set results using the last saved model")
     parser.add_argument("-test", default=False, action="store_true",
                         help="Get test results using the last saved model")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     args = vars(args)
     return process_args(args)
 
@@ -116,6 +117,9 @@ def process_args(options):
     train_params = Train.get_updated_params(options)
     # Process beam search params
     beam_search_params = BeamSearch.get_updated_params(options)
+    beam_search_params.max_output_len = options['max_output']['char']
+    if not beam_search_params.lm_vocab_path:
+        beam_search_params.lm_vocab_path = os.path.join(options['vocab_dir'], "char.vocab")
     # Process model params
     encoder_params = Encoder.get_updated_params(options)
     decoder_params_base = AttnDecoder.get_updated_params(options)
@@ -170,8 +174,13 @@ def launch_train(options):
     trainer.train()
 
 
-def launch_eval(options):
-    with tf.Session() as sess:
+def create_eval(options):
+    """Create the eval model of the dev or test set and restore the best
+    model, or else the last checkpoint, in a new session. Returns a Bunch of
+    the session, Eval, checkpoint path and dataset."""
+    graph = tf.Graph()
+    with graph.as_default():
+        sess = tf.Session(graph=graph)
         trainer = Train(options.seq2seq_params, options.train_params)
         if options.dev:
             _, dev_set = trainer.get_data_sets()
@@ -213,14 +222,23 @@ def launch_eval(options):
             sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
 
         print ("Using the model from: %s" %ckpt_path)
+    return Bunch(sess=sess, eval_model=eval_model, ckpt_path=ckpt_path, data_set=dev_set)
+
+
+def launch_eval(options):
+    evaluation = create_eval(options)
+    with evaluation.sess:
+        eval_model = evaluation.eval_model
         start_time = time.time()
         if options.beam_search_params.beam_size == 1 and options.beam_search_params.lm_weight == 0.0:
             # Run the GPU version
-            asr_perf = eval_model.greedy_decode(sess)
+            asr_perf = eval_model.greedy_decode(evaluation.sess)
         else:
             asr_perf, out_file = eval_model.beam_search_decode(
-                sess, ckpt_path, beam_search_params=options.beam_search_params, dev=options.dev,
-                get_out_file=True)
+                evaluation.sess, evaluation.ckpt_path,
+                beam_search_params=options.beam_search_params, dev=options.dev,
+                get_out_file=True, data_files=evaluation.data_set.data_files)
+            eval_model.close_parallel_beam_search()
 
         decoding_time = time.time() - start_time
         print ("Total decoding time: %s" %timedelta(seconds=decoding_time))
@@ -0,0 +1,120 @@
+"""Storage and offline rescoring of the N-best lists of beam search.
+
+The N-best lists of all utterances are flattened into a few numpy arrays and
+saved as a single .npz file. Alongwith the score parts of each hypothesis, the
+number of word errors of each hypothesis and the number of gold words of each
+utterance are stored, so that the WER of any reweighting of the score parts
+can be computed without the vocabulary or the references.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from bunch import Bunch
+
+SCORE_PARTS = ["dec_scores", "lm_scores", "lengths", "coverages"]
+
+
+def save_nbest(nbest_file, utt_ids, nbest_lists, hyp_errors, gold_lengths,
+               search_params):
+    """Save the N-best lists of the utterances.
+
+    Args:
+        nbest_file: Output .npz file.
+        utt_ids: Utterance IDs.
+        nbest_lists: N-best list Bunch of each utterance as returned by
+            BeamSearch.decode_batch.
+        hyp_errors: Word errors of each hypothesis of each utterance.
+        gold_lengths: Number of gold words of each utterance.
+        search_params: Search params with which the N-best lists were produced.
+    """
+    num_hyps = [len(nbest.index_seqs) for nbest in nbest_lists]
+    index_seqs = [index_seq for nbest in nbest_lists for index_seq in nbest.index_seqs]
+    arrays = {}
+    arrays["utt_ids"] = np.array(utt_ids)
+    arrays["utt_offsets"] = np.concatenate([[0], np.cumsum(num_hyps)])
+    arrays["hyp_offsets"] = np.concatenate(
+        [[0], np.cumsum([len(index_seq) for index_seq in index_seqs])])
+    arrays["tokens"] = np.concatenate(index_seqs).astype(np.int32)
+    for part in SCORE_PARTS:
+        arrays[part] = np.concatenate([nbest[part] for nbest in nbest_lists])
+    arrays["hyp_errors"] = np.concatenate(hyp_errors).astype(np.int32)
+    arrays["gold_lengths"] = np.array(gold_lengths, dtype=np.int32)
+    for param in ["beam_size", "lm_weight", "word_ins_penalty", "cov_penalty"]:
+        arrays["search_" + param] = np.array(search_params[param])
+    np.savez_compressed(nbest_file, **arrays)
+
+
+def load_nbest(nbest_file):
+    """Load N-best lists saved by save_nbest as a Bunch of arrays."""
+    with np.load(nbest_file) as nbest_data:
+        return Bunch((key, nbest_data[key]) for key in nbest_data.files)
+
+
+class NBestRescorer(object):
+    """Pick the best hypothesis of each utterance under new search weights.
+
+    The hypothesis score is recomputed from the score parts as
+        dec_score + lm_weight * lm_score + word_ins_penalty * length_term
+        + cov_penalty * coverage
+    where length_term = L * (L + 1) / 2 - 1 for a hypothesis of L outputs,
+    which is the total of the per step penalty that BeamSearch applies, and
+    the coverage term is the one BeamSearch adds to finished hypotheses. At
+    the decode params it hence picks the decoded 1-best."""
+
+    def __init__(self, nbest):
+        self.nbest = nbest
+        lengths = nbest.lengths.astype(np.float64)
+        self.length_terms = lengths * (lengths + 1) / 2 - 1
+
+        utt_offsets = nbest.utt_offsets
+        self.utt_starts = utt_offsets[:-1]
+        self.hyp_utts = np.repeat(np.arange(self.utt_starts.shape[0]),
+                                  np.diff(utt_offsets))
+
+    def get_scores(self, lm_weights, word_ins_penalties, cov_penalties):
+        """G x num_hyps scores for G configs given as equal length arrays."""
+        nbest = self.nbest
+        lm_weights, word_ins_penalties, cov_penalties = [
+            np.asarray(weights, dtype=np.float64)[:, np.newaxis]
+            for weights in [lm_weights, word_ins_penalties, cov_penalties]]
+        return (nbest.dec_scores[np.newaxis, :] +
+                lm_weights * nbest.lm_scores[np.newaxis, :] +
+                word_ins_penalties * self.length_terms[np.newaxis, :] +
+                cov_penalties * nbest.coverages[np.newaxis, :])
+
+    def best_hyps(self, scores):
+        """Index of the best hypothesis of each utterance for each config.
+        Among equal scores the earlier hypothesis is picked."""
+        max_scores = np.maximum.reduceat(scores, self.utt_starts, axis=1)
+        is_max = (scores == max_scores[:, self.hyp_utts])
+        hyp_indices = np.where(is_max, np.arange(scores.shape[1])[np.newaxis, :],
+                               scores.shape[1])
+        return np.minimum.reduceat(hyp_indices, self.utt_starts, axis=1)
+
+    def rescore(self, lm_weight, word_ins_penalty, cov_penalty):
+        """Index of the best hypothesis of each utterance for one config."""
+        scores = self.get_scores([lm_weight], [word_ins_penalty], [cov_penalty])
+        return self.best_hyps(scores)[0]
+
+    def get_wers(self, lm_weights, word_ins_penalties, cov_penalties):
+        """WER of each of the G configs given as equal length arrays."""
+        scores = self.get_scores(lm_weights, word_ins_penalties, cov_penalties)
+        total_errors = np.sum(self.nbest.hyp_errors[self.best_hyps(scores)], axis=1)
+        total_words = max(np.sum(self.nbest.gold_lengths), 1)
+        return total_errors / float(total_words)
+
+    def wer_grid(self, lm_weights, word_ins_penalties, cov_penalties):
+        """WER for every combination of the given weights. Returns an array of
+        shape (len(lm_weights), len(word_ins_penalties), len(cov_penalties))."""
+        grid = np.meshgrid(lm_weights, word_ins_penalties, cov_penalties, indexing="ij")
+        grid_shape = grid[0].shape
+        wers = self.get_wers(*[weights.ravel() for weights in grid])
+        return np.reshape(wers, grid_shape)
+
+    def get_index_seq(self, hyp_idx):
+        """Output sequence of a hypothesis."""
+        nbest = self.nbest
+        return nbest.tokens[nbest.hyp_offsets[hyp_idx]:nbest.hyp_offsets[hyp_idx + 1]]
@@ -0,0 +1,69 @@
+"""Tests of the offline N-best rescoring against beam search decoding."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from beam_search_test import synthetic_beam_search
+from nbest import save_nbest, load_nbest, NBestRescorer
+
+
+class NBestRescorerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def check_reproduces_decoding(self, **search_args):
+        """Rescoring the N-best lists at the decode params picks the decoded
+        1-best of each utterance, with the scores beam search ranked them by."""
+        beam_search, hidden_states_list = synthetic_beam_search(use_lm=True, **search_args)
+        outputs, nbest_lists = beam_search.decode_batch(hidden_states_list, return_nbest=True)
+        num_hyps = [len(utt_nbest.index_seqs) for utt_nbest in nbest_lists]
+        nbest_file = os.path.join(self.tmp_dir, "nbest.npz")
+        save_nbest(nbest_file, ["utt%d" %idx for idx in xrange(len(outputs))], nbest_lists,
+                   [np.arange(utt_num_hyps) for utt_num_hyps in num_hyps],
+                   [1] * len(outputs), beam_search.search_params)
+
+        search_params = beam_search.search_params
+        rescorer = NBestRescorer(load_nbest(nbest_file))
+        scores = rescorer.get_scores([search_params.lm_weight],
+                                     [search_params.word_ins_penalty],
+                                     [search_params.cov_penalty])[0]
+        np.testing.assert_allclose(
+            scores, np.concatenate([utt_nbest.scores for utt_nbest in nbest_lists]),
+            rtol=1e-9, atol=1e-9)
+        best_hyps = rescorer.rescore(search_params.lm_weight, search_params.word_ins_penalty,
+                                     search_params.cov_penalty)
+        for output, hyp_idx in zip(outputs, best_hyps):
+            self.assertEqual(list(rescorer.get_index_seq(hyp_idx)), list(output))
+
+    def test_reproduces_decoding(self):
+        self.check_reproduces_decoding(word_ins_penalty=0.1, cov_penalty=0.2)
+
+    def test_reproduces_decoding_with_attn_window(self):
+        self.check_reproduces_decoding(word_ins_penalty=-0.05, cov_penalty=0.5,
+                                       attn_window=4, beam_size=6)
+
+    def test_cov_penalty_changes_decoding(self):
+        """The coverage penalty is applied by beam search itself."""
+        outputs = []
+        for cov_penalty in [0.0, 5.0]:
+            beam_search, hidden_states_list = synthetic_beam_search(
+                use_lm=True, cov_penalty=cov_penalty)
+            outputs.append([list(output) for output in
+                            beam_search.decode_batch(hidden_states_list)])
+        self.assertNotEqual(outputs[0], outputs[1])
+
+
+if __name__=="__main__":
+    unittest.main()
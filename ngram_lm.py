@@ -0,0 +1,391 @@
+"""Array-backed n-gram LM over the output vocabulary for shallow fusion.
+
+The n-grams of each order are stored as sorted arrays of keys, where the key
+of an n-gram is parent * V + token with parent the index of its (n-1)-gram
+prefix, alongwith their natural log probs, backoff weights and the index of
+their (n-1)-gram suffix. Finding the next LM state or the log probs of a
+context are a few vectorized searchsorted lookups over these arrays.
+
+An LM is loaded either from an ARPA file, whose tokens are mapped to ids via
+the vocab file, or from the .npz arrays it was compiled to. The script
+estimates an interpolated Kneser-Ney LM from the LM TFRecords read by
+LMDataset and writes it in the ARPA format.
+
+Usage:
+    python ngram_lm.py -data_files "<lm tfrecords glob>" -vocab_file char.vocab
+        -order 4 -arpa_file lm.arpa [-compile]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import glob
+from collections import Counter, defaultdict
+
+import numpy as np
+
+import data_utils
+
+LN_10 = np.log(10.0)
+# Log10 prob of the tokens missing from the ARPA unigrams when it has no <unk>
+MISSING_LOG10_PROB = -99.0
+# ARPA names of the GO and EOS tokens
+ARPA_SPECIAL_TOKENS = {"<s>": data_utils.GO_ID, "</s>": data_utils.EOS_ID}
+
+
+def read_vocab(vocab_path):
+    """Tokens of the vocab file, one per line, in the order of their ids."""
+    with open(vocab_path) as vocab_f:
+        return [line.strip() for line in vocab_f]
+
+
+def get_log10_prob(ngrams, ngram):
+    """Log10 prob of the last token of ngram given the rest via backoff."""
+    order = len(ngram)
+    if order == 1:
+        return ngrams[1].get(ngram, (MISSING_LOG10_PROB,))[0]
+    if ngram in ngrams[order]:
+        return ngrams[order][ngram][0]
+    backoff = ngrams[order - 1].get(ngram[:-1], (0.0, 0.0))[1]
+    return backoff + get_log10_prob(ngrams, ngram[1:])
+
+
+def add_missing_ngrams(ngrams):
+    """Add the prefixes and suffixes of the n-grams missing from a pruned
+    LM, with their backed-off log prob and no backoff, which leaves the
+    distributions unchanged."""
+    for order in xrange(len(ngrams) - 1, 1, -1):
+        for ngram in list(ngrams[order]):
+            for sub_ngram in [ngram[:-1], ngram[1:]]:
+                if sub_ngram not in ngrams[order - 1]:
+                    ngrams[order - 1][sub_ngram] = (get_log10_prob(ngrams, sub_ngram), 0.0)
+
+
+class NgramLM(object):
+    """Backoff n-gram LM whose state is the (order, index) of the longest
+    suffix of the history present in the LM, with order 0 the empty context."""
+
+    def __init__(self, vocab_size, keys, log_probs, backoffs, suffixes):
+        """keys, log_probs, backoffs and suffixes are lists of the arrays of
+        each order, starting with order 1 whose n-grams are all the tokens."""
+        self.vocab_size = vocab_size
+        self.max_order = len(keys)
+        # Index 0 stands for the order 0 root so that order k is at index k
+        self.keys = [np.zeros(1, dtype=np.int64)] + list(keys)
+        self.log_probs = [np.zeros(1, dtype=np.float32)] + list(log_probs)
+        self.backoffs = [np.zeros(1, dtype=np.float32)] + list(backoffs)
+        self.suffixes = [np.zeros(1, dtype=np.int64)] + list(suffixes)
+        self.max_nodes = max(order_keys.shape[0] for order_keys in self.keys)
+
+        self.tokens = [order_keys % vocab_size for order_keys in self.keys]
+        # Children of node i of order k are the n-grams
+        # child_offsets[k][i]:child_offsets[k][i + 1] of order k + 1
+        self.child_offsets = [
+            np.searchsorted(self.keys[order + 1] // vocab_size,
+                            np.arange(self.keys[order].shape[0] + 1))
+            for order in xrange(self.max_order)]
+
+    @classmethod
+    def from_ngrams(cls, ngrams, vocab_size):
+        """Create the LM from a list, indexed by order, of dicts mapping token
+        id tuples to their log10 prob and backoff."""
+        ngrams = [dict(order_ngrams) for order_ngrams in ngrams]
+        add_missing_ngrams(ngrams)
+
+        keys, log_probs, backoffs, suffixes = [], [], [], []
+        # Index of each n-gram of the previous order
+        prev_index = {(): 0}
+        for order in xrange(1, len(ngrams)):
+            if order == 1:
+                order_ngrams = [(token,) for token in xrange(vocab_size)]
+            else:
+                order_ngrams = sorted(
+                    ngrams[order], key=lambda ngram: (prev_index[ngram[:-1]], ngram[-1]))
+            entries = [ngrams[order].get(ngram, (MISSING_LOG10_PROB, 0.0))
+                       for ngram in order_ngrams]
+            keys.append(np.array([prev_index[ngram[:-1]] * vocab_size + ngram[-1]
+                                  for ngram in order_ngrams], dtype=np.int64))
+            log_probs.append((LN_10 * np.array([entry[0] for entry in entries])).astype(np.float32))
+            backoffs.append((LN_10 * np.array([entry[1] for entry in entries])).astype(np.float32))
+            suffixes.append(np.array([prev_index[ngram[1:]] for ngram in order_ngrams],
+                                     dtype=np.int64))
+            prev_index = dict((ngram, idx) for idx, ngram in enumerate(order_ngrams))
+        return cls(vocab_size, keys, log_probs, backoffs, suffixes)
+
+    @classmethod
+    def from_arpa(cls, arpa_path, vocab_path):
+        """Load the LM from an ARPA file. N-grams with tokens missing from
+        the vocab are skipped."""
+        rev_vocab = read_vocab(vocab_path)
+        vocab = dict((token, idx) for idx, token in enumerate(rev_vocab))
+        vocab.update(ARPA_SPECIAL_TOKENS)
+
+        ngrams = [{}]
+        order = 0
+        with open(arpa_path) as arpa_f:
+            for line in arpa_f:
+                line = line.strip()
+                if not line or line.startswith("ngram ") or line == "\\data\\":
+                    continue
+                if line == "\\end\\":
+                    break
+                if line.startswith("\\") and line.endswith("-grams:"):
+                    order = int(line[1:-len("-grams:")])
+                    ngrams.append({})
+                    continue
+                fields = line.split()
+                try:
+                    ngram = tuple(vocab[token] for token in fields[1:order + 1])
+                except KeyError:
+                    continue
+                backoff = (float(fields[order + 1]) if len(fields) > order + 1 else 0.0)
+                ngrams[order][ngram] = (float(fields[0]), backoff)
+
+        if "<unk>" in vocab:
+            unk_entry = ngrams[1].get((vocab["<unk>"],))
+            if unk_entry is not None:
+                # Tokens missing from the unigrams get the prob of <unk>
+                for token in xrange(len(rev_vocab)):
+                    ngrams[1].setdefault((token,), (unk_entry[0], 0.0))
+        print ("Loaded %d-gram LM from %s" %(len(ngrams) - 1, arpa_path))
+        return cls.from_ngrams(ngrams, len(rev_vocab))
+
+    @classmethod
+    def load(cls, lm_path, vocab_path):
+        """Load the LM from its compiled .npz arrays or an ARPA file."""
+        if lm_path.endswith(".npz"):
+            lm_arrays = np.load(lm_path)
+            max_order = int(lm_arrays["max_order"])
+            return cls(int(lm_arrays["vocab_size"]),
+                       *[[lm_arrays["%s_%d" %(name, order)]
+                          for order in xrange(1, max_order + 1)]
+                         for name in ["keys", "log_probs", "backoffs", "suffixes"]])
+        return cls.from_arpa(lm_path, vocab_path)
+
+    def save(self, npz_path):
+        """Save the compiled arrays of the LM."""
+        lm_arrays = {"vocab_size": self.vocab_size, "max_order": self.max_order}
+        for order in xrange(1, self.max_order + 1):
+            lm_arrays["keys_%d" %order] = self.keys[order]
+            lm_arrays["log_probs_%d" %order] = self.log_probs[order]
+            lm_arrays["backoffs_%d" %order] = self.backoffs[order]
+            lm_arrays["suffixes_%d" %order] = self.suffixes[order]
+        np.savez(npz_path, **lm_arrays)
+        print ("Compiled LM at: %s" %npz_path)
+
+    def zero_state(self, batch_size):
+        """State of the empty history."""
+        return (np.zeros(batch_size, dtype=np.int64), np.zeros(batch_size, dtype=np.int64))
+
+    def find_children(self, order, nodes, tokens):
+        """Index of the n-grams of order + 1 extending the nodes of order by
+        tokens, and whether they exist."""
+        order_keys = self.keys[order + 1]
+        query_keys = nodes * self.vocab_size + tokens
+        child_idx = np.minimum(np.searchsorted(order_keys, query_keys),
+                               order_keys.shape[0] - 1)
+        return child_idx, (order_keys[child_idx] == query_keys)
+
+    def step(self, tokens, state):
+        """Extend the N histories of state by tokens. Returns the next state
+        and the N x V log probs of the next token."""
+        orders, nodes = state
+        next_orders = np.zeros_like(orders)
+        next_nodes = np.zeros_like(nodes)
+        orders = orders.copy()
+        nodes = nodes.copy()
+        # Back off one order at a time until the extended history is found,
+        # which always happens at the unigrams
+        for order in xrange(self.max_order - 1, -1, -1):
+            rows = np.nonzero(orders == order)[0]
+            if rows.shape[0] == 0:
+                continue
+            child_idx, found = self.find_children(order, nodes[rows], tokens[rows])
+            found_rows = rows[found]
+            if order + 1 == self.max_order:
+                # The history is limited to max_order - 1 tokens
+                next_orders[found_rows] = order
+                next_nodes[found_rows] = self.suffixes[order + 1][child_idx[found]]
+            else:
+                next_orders[found_rows] = order + 1
+                next_nodes[found_rows] = child_idx[found]
+            missing_rows = rows[~found]
+            orders[missing_rows] = order - 1
+            nodes[missing_rows] = self.suffixes[order][nodes[missing_rows]]
+
+        next_state = (next_orders, next_nodes)
+        return next_state, self.get_log_probs(next_state)
+
+    def get_log_probs(self, state):
+        """N x V log probs of the next token given the histories of state."""
+        orders, nodes = state
+        context_keys, unique_idx, inverse_idx = np.unique(
+            orders * self.max_nodes + nodes, return_index=True, return_inverse=True)
+        orders = orders[unique_idx]
+        nodes = nodes[unique_idx]
+
+        # Nodes of the suffixes of each context at each order
+        chain_nodes = np.zeros((orders.shape[0], self.max_order), dtype=np.int64)
+        cur_nodes = nodes.copy()
+        for order in xrange(self.max_order - 1, 0, -1):
+            rows = np.nonzero(orders >= order)[0]
+            chain_nodes[rows, order] = cur_nodes[rows]
+            cur_nodes[rows] = self.suffixes[order][cur_nodes[rows]]
+
+        # Starting with the unigrams, back off to the shorter context and
+        # overwrite the n-grams present for the longer one
+        log_probs = np.tile(self.log_probs[1], (orders.shape[0], 1))
+        for order in xrange(1, self.max_order):
+            rows = np.nonzero(orders >= order)[0]
+            if rows.shape[0] == 0:
+                break
+            order_nodes = chain_nodes[rows, order]
+            log_probs[rows] += self.backoffs[order][order_nodes][:, np.newaxis]
+            starts = self.child_offsets[order][order_nodes]
+            counts = self.child_offsets[order][order_nodes + 1] - starts
+            child_rows = np.repeat(rows, counts)
+            child_idx = (np.repeat(starts - (np.cumsum(counts) - counts), counts) +
+                         np.arange(np.sum(counts)))
+            log_probs[child_rows, self.tokens[order + 1][child_idx]] =\
+                self.log_probs[order + 1][child_idx]
+        return log_probs[inverse_idx]
+
+
+def read_lm_sequences(data_files):
+    """Token id sequences, starting with GO and ending with EOS, of the LM
+    TFRecords as read by LMDataset."""
+    # TF is only needed for reading the TFRecords
+    import tensorflow as tf
+    for data_file in data_files:
+        for record in tf.python_io.tf_record_iterator(data_file):
+            example = tf.train.SequenceExample.FromString(record)
+            seq = [feature.int64_list.value[0] for feature in
+                   example.feature_lists.feature_list["cint"].feature]
+            if not seq or seq[0] != data_utils.GO_ID:
+                seq = [data_utils.GO_ID] + seq
+            if seq[-1] != data_utils.EOS_ID:
+                seq = seq + [data_utils.EOS_ID]
+            yield seq
+
+
+def get_discount(counts):
+    """Kneser-Ney discount n1 / (n1 + 2 * n2) from the count of counts."""
+    count_of_counts = Counter(count for count in counts.values() if count <= 2)
+    n1, n2 = count_of_counts[1], count_of_counts[2]
+    if n1 == 0 or n2 == 0:
+        return 0.5
+    return n1 / float(n1 + 2 * n2)
+
+
+def estimate_kneser_ney(sequences, order, vocab_size):
+    """Estimate an interpolated Kneser-Ney LM of the given order from the
+    token id sequences. Returns the list, indexed by order, of dicts mapping
+    token id tuples to their log10 prob and backoff."""
+    counts = [None] + [Counter() for _ in xrange(order)]
+    for seq in sequences:
+        for ngram_order in xrange(1, order + 1):
+            for start in xrange(len(seq) - ngram_order + 1):
+                counts[ngram_order][tuple(seq[start:start + ngram_order])] += 1
+
+    # Lower orders use the number of distinct left extensions, except for the
+    # n-grams starting with GO which have none
+    for ngram_order in xrange(order - 1, 0, -1):
+        left_extensions = Counter(ngram[1:] for ngram in counts[ngram_order + 1])
+        for ngram in counts[ngram_order]:
+            if ngram[0] != data_utils.GO_ID:
+                counts[ngram_order][ngram] = left_extensions[ngram]
+
+    # Unigrams are interpolated with the uniform distribution over the
+    # tokens other than PAD and GO, which are never predicted
+    num_predicted = vocab_size - 2
+    probs = [None] + [{} for _ in xrange(order)]
+    backoffs = [None] + [{} for _ in xrange(order)]
+    for ngram_order in xrange(1, order + 1):
+        discount = get_discount(counts[ngram_order])
+        context_totals = defaultdict(float)
+        context_types = Counter()
+        for ngram, count in counts[ngram_order].items():
+            if ngram[-1] == data_utils.GO_ID:
+                continue
+            context_totals[ngram[:-1]] += count
+            context_types[ngram[:-1]] += 1
+        for context, total in context_totals.items():
+            backoffs[ngram_order][context] = discount * context_types[context] / total
+
+        if ngram_order == 1:
+            ngram_list = [(token,) for token in xrange(vocab_size)
+                          if token not in [data_utils.PAD_ID, data_utils.GO_ID]]
+        else:
+            ngram_list = [ngram for ngram in counts[ngram_order]
+                          if ngram[-1] != data_utils.GO_ID]
+        for ngram in ngram_list:
+            context = ngram[:-1]
+            if ngram_order == 1:
+                lower_prob = 1.0 / num_predicted
+            else:
+                lower_prob = probs[ngram_order - 1][ngram[1:]]
+            probs[ngram_order][ngram] = (
+                max(counts[ngram_order][ngram] - discount, 0) / context_totals[context] +
+                backoffs[ngram_order][context] * lower_prob)
+
+    ngrams = [{}]
+    for ngram_order in xrange(1, order + 1):
+        order_ngrams = {}
+        for ngram, prob in probs[ngram_order].items():
+            # The backoff of a context is stored with the n-gram of one
+            # order lower
+            backoff = backoffs[ngram_order + 1].get(ngram) if ngram_order < order else None
+            order_ngrams[ngram] = (np.log10(prob),
+                                   (np.log10(backoff) if backoff else 0.0))
+        ngrams.append(order_ngrams)
+    # GO is a context but never predicted
+    go_backoff = (backoffs[2].get((data_utils.GO_ID,), 1.0) if order > 1 else 1.0)
+    ngrams[1][(data_utils.GO_ID,)] = (MISSING_LOG10_PROB, np.log10(go_backoff))
+    return ngrams
+
+
+def write_arpa(arpa_path, ngrams, rev_vocab):
+    """Write the n-grams, as returned by estimate_kneser_ney, in the ARPA format."""
+    rev_arpa_tokens = dict((token_id, token) for token, token_id in ARPA_SPECIAL_TOKENS.items())
+    token_strs = [rev_arpa_tokens.get(idx, token) for idx, token in enumerate(rev_vocab)]
+    with open(arpa_path, "w") as arpa_f:
+        arpa_f.write("\\data\\\n")
+        for order in xrange(1, len(ngrams)):
+            arpa_f.write("ngram %d=%d\n" %(order, len(ngrams[order])))
+        for order in xrange(1, len(ngrams)):
+            arpa_f.write("\n\\%d-grams:\n" %order)
+            for ngram in sorted(ngrams[order]):
+                log10_prob, log10_backoff = ngrams[order][ngram]
+                line = "%.6f\t%s" %(log10_prob, " ".join(token_strs[token] for token in ngram))
+                if log10_backoff != 0.0:
+                    line += "\t%.6f" %log10_backoff
+                arpa_f.write(line + "\n")
+        arpa_f.write("\n\\end\\\n")
+    print ("ARPA LM at: %s" %arpa_path)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-data_files", default="", type=str,
+                        help="Glob of the LM TFRecords to estimate the LM from")
+    parser.add_argument("-vocab_file", type=str, help="Vocab file of the LM tokens")
+    parser.add_argument("-order", default=4, type=int, help="N-gram order")
+    parser.add_argument("-arpa_file", type=str, help="ARPA file of the LM")
+    parser.add_argument("-compile", default=False, action="store_true",
+                        help="Also save the LM arrays at <arpa_file>.npz for fast loading")
+    args = parser.parse_args()
+    return args
+
+
+if __name__=="__main__":
+    args = parse_options()
+    rev_vocab = read_vocab(args.vocab_file)
+    if args.data_files:
+        ngrams = estimate_kneser_ney(read_lm_sequences(sorted(glob.glob(args.data_files))),
+                                     args.order, len(rev_vocab))
+        write_arpa(args.arpa_file, ngrams, rev_vocab)
+    if args.compile:
+        NgramLM.from_arpa(args.arpa_file, args.vocab_file).save(args.arpa_file + ".npz")
@@ -0,0 +1,69 @@
+"""Tests of the array-backed n-gram LM against the backoff definition."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+
+import data_utils
+import ngram_lm
+from ngram_lm import NgramLM
+
+
+class NgramLMTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.vocab_size = 10
+        self.order = 3
+        # Sequences over the tokens other than PAD, GO and EOS, with some
+        # frequent bigrams
+        sequences = []
+        for _ in xrange(300):
+            tokens = rng.randint(3, self.vocab_size, size=rng.randint(1, 8)).tolist()
+            tokens = [(3 if prev_token == 4 else token)
+                      for prev_token, token in zip([0] + tokens, tokens)]
+            sequences.append([data_utils.GO_ID] + tokens + [data_utils.EOS_ID])
+        self.ngrams = ngram_lm.estimate_kneser_ney(sequences, self.order, self.vocab_size)
+        self.lm = NgramLM.from_ngrams(self.ngrams, self.vocab_size)
+        self.histories = [
+            [data_utils.GO_ID] + rng.randint(3, self.vocab_size, size=length).tolist()
+            for length in xrange(6)]
+
+    def get_step_log_probs(self):
+        """Log probs of the LM after each history, stepped in a batch."""
+        state = self.lm.zero_state(len(self.histories))
+        max_len = max(len(history) for history in self.histories)
+        log_probs = [None] * len(self.histories)
+        for step in xrange(max_len):
+            tokens = np.array([history[min(step, len(history) - 1)]
+                               for history in self.histories])
+            state, step_log_probs = self.lm.step(tokens, state)
+            for idx, history in enumerate(self.histories):
+                if len(history) == step + 1:
+                    log_probs[idx] = step_log_probs[idx]
+        return log_probs
+
+    def test_normalized(self):
+        """The next token distributions sum to 1."""
+        for log_probs in self.get_step_log_probs():
+            self.assertAlmostEqual(np.sum(np.exp(log_probs.astype(np.float64))), 1.0,
+                                   places=4)
+
+    def test_backoff(self):
+        """The log probs are those of the backoff definition over the n-grams."""
+        for history, log_probs in zip(self.histories, self.get_step_log_probs()):
+            context = tuple(history[-(self.order - 1):])
+            for token in xrange(self.vocab_size):
+                if token in [data_utils.PAD_ID, data_utils.GO_ID]:
+                    continue
+                expected = ngram_lm.LN_10 * ngram_lm.get_log10_prob(
+                    self.ngrams, context + (token,))
+                self.assertAlmostEqual(log_probs[token], expected, places=4)
+
+
+if __name__=="__main__":
+    unittest.main()
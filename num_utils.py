@@ -9,6 +9,18 @@ def sigmoid(x):
 
 
 def softmax(x):
-    """Compute softmax values for each sets of scores in x."""
-    e_x = np.exp(x - np.max(x))
-    return e_x / e_x.sum(axis=0) # only difference
+    """Compute softmax values along the last axis of x."""
+    e_x = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return e_x / e_x.sum(axis=-1, keepdims=True)
+
+
+def log_softmax(x):
+    """Compute log of softmax values along the last axis of x."""
+    shifted_x = x - np.max(x, axis=-1, keepdims=True)
+    return shifted_x - np.log(np.exp(shifted_x).sum(axis=-1, keepdims=True))
+
+
+def logsumexp(x):
+    """Compute log of the sum of exp of x along the last axis."""
+    max_x = np.max(x, axis=-1)
+    return max_x + np.log(np.exp(x - max_x[..., np.newaxis]).sum(axis=-1))
@@ -0,0 +1,224 @@
+"""Parallel beam search decoding over a pool of worker processes.
+
+The decoder/LM weights and the encoder outputs are copied once into shared
+memory before the workers are started, so they are never pickled to the
+workers. Encoder outputs read from the encoder cache aren't copied, instead
+each worker maps the cache and reads only the utterances it decodes. Only
+utterance indices, search params and the decoded outputs are passed between
+the processes.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import ctypes
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+from bunch import Bunch
+
+import encoder_cache
+from beam_search import BeamSearch
+from beam_profiler import PhaseProfiler
+
+# Per worker process state set up by init_worker
+_worker_beam_search = None
+_worker_hidden_states = None
+
+
+def to_shared_array(array):
+    """Copy a numpy array to shared memory. Returns the shared buffer alongwith
+    the dtype and shape required to view it as a numpy array."""
+    array = np.ascontiguousarray(array)
+    shared_buf = RawArray(ctypes.c_byte, max(array.nbytes, 1))
+    shared_view = np.frombuffer(shared_buf, dtype=array.dtype,
+                                count=array.size).reshape(array.shape)
+    shared_view[...] = array
+    return (shared_buf, array.dtype, array.shape)
+
+
+def from_shared_array(shared_array):
+    """View a shared array created by to_shared_array as a numpy array."""
+    shared_buf, dtype, shape = shared_array
+    count = int(np.prod(shape))
+    return np.frombuffer(shared_buf, dtype=dtype, count=count).reshape(shape)
+
+
+def share_params(params):
+    """Copy a Bunch of params to shared memory, leaving the None entries as is.
+    Params which aren't loaded (None) stay None."""
+    if params is None:
+        return None
+    return dict((name, (None if value is None else to_shared_array(value)))
+                for name, value in params.items())
+
+
+def unshare_params(shared_params):
+    """Inverse of share_params."""
+    if shared_params is None:
+        return None
+    params = Bunch()
+    for name, shared_array in shared_params.items():
+        params[name] = (None if shared_array is None else from_shared_array(shared_array))
+    return params
+
+
+def get_pool_context():
+    """Multiprocessing context for starting the worker pools. The pools are
+    created next to a TF session, and a child forked while one of its
+    threads holds a lock can deadlock, so the workers are forked from a fork
+    server started as a fresh process instead. Python 2 can only fork."""
+    if not hasattr(multiprocessing, "get_context"):
+        return multiprocessing
+    context = multiprocessing.get_context("forkserver")
+    # Imported once by the server rather than by each worker
+    context.set_forkserver_preload(["__main__", __name__])
+    return context
+
+
+def create_pool(num_workers, shared_dec_params, shared_lm_params, shared_hidden_states,
+                utt_offsets, search_params, cache_dir=None, cache_indices=None):
+    """Pool of num_workers processes set up by init_worker with the given
+    args. It's returned once all the workers are set up, so that their setup
+    isn't timed as part of the first tasks."""
+    context = get_pool_context()
+    ready_queue = context.Queue()
+    pool = context.Pool(
+        num_workers, initializer=init_worker,
+        initargs=(shared_dec_params, shared_lm_params, shared_hidden_states, utt_offsets,
+                  search_params, cache_dir, cache_indices, ready_queue))
+    for _ in xrange(num_workers):
+        ready_queue.get()
+    return pool
+
+
+def init_worker(shared_dec_params, shared_lm_params, shared_hidden_states,
+                utt_offsets, search_params, cache_dir=None, cache_indices=None,
+                ready_queue=None):
+    """Create the beam search object of the worker over the shared memory.
+    Without shared LM params the worker loads the LM itself if required.
+    The encoder outputs are views of the shared ones, or else of the
+    utterances at cache_indices of the encoder cache at cache_dir, if any.
+    Otherwise they are passed with the tasks. Once done, the worker signals
+    on the ready queue, if any."""
+    global _worker_beam_search, _worker_hidden_states
+    _worker_beam_search = BeamSearch(search_params=search_params,
+                                     dec_params=unshare_params(shared_dec_params),
+                                     lm_params=unshare_params(shared_lm_params))
+    if shared_hidden_states is not None:
+        all_hidden_states = from_shared_array(shared_hidden_states)
+        _worker_hidden_states = [all_hidden_states[start:end]
+                                 for start, end in zip(utt_offsets[:-1], utt_offsets[1:])]
+    elif cache_dir is not None:
+        cache = encoder_cache.EncoderCache(cache_dir)
+        _worker_hidden_states = [cache[utt_idx] for utt_idx in cache_indices]
+    if ready_queue is not None:
+        ready_queue.put(True)
+
+
+def decode_task(task):
+    """Decode the utterances of a task, given by their indices in the
+    encoder outputs of the worker, in a worker process."""
+    utt_indices, search_params = task
+    hidden_states_list = [_worker_hidden_states[idx] for idx in utt_indices]
+    return (utt_indices,) + decode_utterances(hidden_states_list, search_params)
+
+
+def decode_hidden_states_task(task):
+    """Decode the utterances of a task, which carries their encoder outputs,
+    in a worker process."""
+    utt_indices, hidden_states_list, search_params = task
+    return (utt_indices,) + decode_utterances(hidden_states_list, search_params)
+
+
+def decode_utterances(hidden_states_list, search_params):
+    """Decode utterances with the beam search object of the worker. Returns
+    the outputs, N-best lists, decode stats and phase times."""
+    beam_search = _worker_beam_search
+    if search_params != beam_search.search_params:
+        beam_search.set_search_params(search_params)
+
+    beam_search.profiler.reset()
+    if search_params.save_nbest:
+        beam_outputs, nbest_lists = beam_search.decode_batch(hidden_states_list,
+                                                             return_nbest=True)
+    else:
+        beam_outputs = beam_search.decode_batch(hidden_states_list)
+        nbest_lists = None
+    profile = (beam_search.profiler.times, beam_search.profiler.counts)
+    return beam_outputs, nbest_lists, beam_search.decode_stats, profile
+
+
+class ParallelBeamSearch(object):
+    """Beam search over a fixed set of utterances with a pool of workers.
+
+    The pool is created once and can be reused for decoding with different
+    search params, e.g. across the configurations of a grid search.
+
+    If the utterances were read from an encoder cache, cache_utts is the
+    (cache_dir, cache_indices) pair locating them in the cache, and the
+    workers read them from there rather than from a shared copy, which would
+    read the whole memory-mapped cache into memory."""
+
+    def __init__(self, beam_search, hidden_states_list, num_workers, cache_utts=None):
+        self.num_workers = num_workers
+        # Whether the LSTM LM params are shared with the workers, which
+        # otherwise load the LM themselves once it's used
+        self.shares_lm = beam_search.lm_params is not None
+        self.num_utts = len(hidden_states_list)
+        self.utt_lens = [hidden_states.shape[0] for hidden_states in hidden_states_list]
+
+        if cache_utts is None:
+            # All the utterances are stored in one T_total x H buffer
+            utt_offsets = np.concatenate([[0], np.cumsum(self.utt_lens)]).tolist()
+            shared_hidden_states = to_shared_array(np.concatenate(
+                hidden_states_list, axis=0).astype(beam_search.storage_dtype, copy=False))
+            cache_dir, cache_indices = None, None
+        else:
+            utt_offsets, shared_hidden_states = None, None
+            cache_dir, cache_indices = cache_utts
+            cache_indices = [int(utt_idx) for utt_idx in cache_indices]
+
+        self.pool = create_pool(num_workers, share_params(beam_search.dec_params),
+                                share_params(beam_search.lm_params),
+                                shared_hidden_states, utt_offsets,
+                                beam_search.search_params, cache_dir, cache_indices)
+
+    def __call__(self, search_params):
+        """Decode all the utterances and return the outputs, and the N-best
+        lists if the save_nbest search param is set, in the original order.
+        The per utterance decode stats are stored in decode_stats and the
+        phase times summed over the workers in profiler."""
+        # Longest utterances are scheduled first for load balancing
+        sorted_indices = sorted(range(self.num_utts),
+                                key=lambda idx: self.utt_lens[idx], reverse=True)
+        decode_batch_size = max(search_params.decode_batch_size, 1)
+        tasks = [(sorted_indices[batch_start:batch_start + decode_batch_size], search_params)
+                 for batch_start in xrange(0, self.num_utts, decode_batch_size)]
+
+        beam_output_list = [None] * self.num_utts
+        nbest_lists = ([None] * self.num_utts if search_params.save_nbest else None)
+        self.decode_stats = BeamSearch.init_decode_stats(self.num_utts)
+        self.profiler = PhaseProfiler(enabled=search_params.profile)
+        counter = 0
+        for utt_indices, beam_outputs, task_nbest_lists, task_stats, task_profile in \
+                self.pool.imap_unordered(decode_task, tasks):
+            self.profiler.merge(*task_profile)
+            for key, values in task_stats.items():
+                self.decode_stats[key][utt_indices] = values
+            for idx, beam_output in zip(utt_indices, beam_outputs):
+                beam_output_list[idx] = beam_output
+            if task_nbest_lists is not None:
+                for idx, utt_nbest in zip(utt_indices, task_nbest_lists):
+                    nbest_lists[idx] = utt_nbest
+            counter += len(utt_indices)
+            if counter // 100 != (counter - len(utt_indices)) // 100:
+                print ("Counter: %d" %counter)
+        return beam_output_list, nbest_lists
+
+    def close(self):
+        """Shut down the worker processes."""
+        self.pool.close()
+        self.pool.join()
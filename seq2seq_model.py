@@ -33,6 +33,9 @@ class Seq2SeqModel(BaseParams):
         params['tasks'] = ['char']
         params['num_layers'] = {'char': 4}
         params['max_output'] = {'char': 120}
+        # If > 0, the output length in eval is further limited to
+        # max_len_ratio outputs per encoder frame of the utterance
+        params['max_len_ratio'] = 0.0
 
         # Optimization params
         params['learning_rate'] = 1e-3
@@ -47,12 +50,15 @@ class Seq2SeqModel(BaseParams):
 
         return params
 
-    def __init__(self, data_iter, isTraining=True, params=None):
+    def __init__(self, data_iter, isTraining=True, params=None, teacher_forcing=False):
         """Initializer of class that defines the computational graph.
 
         Args:
             encoder: Encoder object executed via encoder(args)
             decoder: Decoder object executed via decoder(args)
+            teacher_forcing: For an eval model, feed the decoder the ground
+                truth up to the target lengths and compute the losses
+                instead of decoding.
         """
         if params is None:
             self.params = self.class_params()
@@ -66,21 +72,26 @@ class Seq2SeqModel(BaseParams):
         for task in params.tasks:
             self.decoder[task] = AttnDecoder(isTraining=isTraining,
                                              params=params.decoder_params[task],
-                                             scope=task)
+                                             scope=task, teacher_forcing=teacher_forcing)
         self.data_iter = data_iter
 
         self.isTraining = isTraining
+        self.teacher_forcing = teacher_forcing
 
-        self.learning_rate = tf.Variable(float(params.learning_rate),
-                                         trainable=False)
-        self.learning_rate_decay_op = self.learning_rate.assign(
-            self.learning_rate * params.learning_rate_decay_factor)
+        # The teacher forced model is added alongside the other models of a
+        # graph, so it creates no counters which would change the variables
+        # saved in the checkpoints
+        if not teacher_forcing:
+            self.learning_rate = tf.Variable(float(params.learning_rate),
+                                             trainable=False)
+            self.learning_rate_decay_op = self.learning_rate.assign(
+                self.learning_rate * params.learning_rate_decay_factor)
 
-        # Number of gradient updates performed
-        self.global_step = tf.Variable(0, trainable=False)
-        # Number of epochs done
-        self.epoch = tf.Variable(0, trainable=False)
-        self.epoch_incr = self.epoch.assign(self.epoch + 1)
+            # Number of gradient updates performed
+            self.global_step = tf.Variable(0, trainable=False)
+            # Number of epochs done
+            self.epoch = tf.Variable(0, trainable=False)
+            self.epoch_incr = self.epoch.assign(self.epoch + 1)
 
 
         self.create_computational_graph()
@@ -104,6 +115,11 @@ class Seq2SeqModel(BaseParams):
         self.encoder_hidden_states, self.time_major_states, self.seq_len_encs =\
             self.encoder(self.encoder_inputs, self.seq_len, params.num_layers)
 
+        if not (self.isTraining or self.teacher_forcing) and params.max_len_ratio > 0:
+            for task in params.tasks:
+                self.seq_len_target[task] = self.get_max_decode_len(
+                    self.seq_len_target[task], self.seq_len_encs[params.num_layers[task]])
+
         self.outputs = {}
         for task in params.tasks:
             task_depth = params.num_layers[task]
@@ -112,7 +128,7 @@ class Seq2SeqModel(BaseParams):
                 self.decoder_inputs[task], self.seq_len_target[task],
                 self.encoder_hidden_states[task_depth], self.seq_len_encs[task_depth])
 
-        if self.isTraining:
+        if self.isTraining or self.teacher_forcing:
             self.losses = {}
             for task in params.tasks:
                 task_depth = params.num_layers[task]
@@ -120,6 +136,7 @@ class Seq2SeqModel(BaseParams):
                 self.losses[task] = LossUtils.cross_entropy_loss(
                     self.outputs[task], self.targets[task], self.seq_len_target[task])
 
+        if self.isTraining:
             tf.summary.scalar('Negative log likelihood ' + task, self.losses[task])
             # Gradients and parameter updation for training the model.
             trainable_vars = tf.trainable_variables()
@@ -188,7 +205,7 @@ class Seq2SeqModel(BaseParams):
         for task in self.params.tasks:
             decoder_inputs[task] = tf.transpose(batch[task], [1, 0])
             decoder_len[task] = batch[task + "_len"]
-            if not self.isTraining:
+            if not (self.isTraining or self.teacher_forcing):
                 decoder_len[task] = tf.ones_like(decoder_len[task]) *\
                     self.params.max_output[task]
 
@@ -196,6 +213,13 @@ class Seq2SeqModel(BaseParams):
             decoder_inputs["utt_id"] = batch["utt_id"]
         return [encoder_inputs, decoder_inputs, encoder_len, decoder_len]
 
+    def get_max_decode_len(self, decoder_len, seq_len_enc):
+        """Limit the eval decoding length to max_len_ratio outputs per encoder
+        frame, with at least one output."""
+        ratio_len = tf.ceil(self.params.max_len_ratio * tf.cast(seq_len_enc, tf.float32))
+        ratio_len = tf.maximum(tf.cast(ratio_len, decoder_len.dtype), 1)
+        return tf.minimum(decoder_len, ratio_len)
+
     @classmethod
     def add_parse_options(cls, parser):
         # Seq2Seq params
@@ -209,6 +233,9 @@ class Seq2SeqModel(BaseParams):
                             type=int, help="Maximum length of char/word-piece sequence")
         parser.add_argument("-max_out_phone", "--max_output_phone", default=250,
                             type=int, help="Maximum length of phone sequence")
+        parser.add_argument("-max_len_ratio", default=0.0, type=float,
+                            help="Maximum outputs per encoder frame in greedy and beam "
+                            "search decoding; 0 disables")
         # Optimization params
         parser.add_argument("-lr_decay", "--learning_rate_decay_factor", default=0.5,
                             type=float, help="Learning rate decay factor")
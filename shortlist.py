@@ -0,0 +1,51 @@
+"""Output softmax over a shortlist of the vocabulary."""
+
+import numpy as np
+
+from num_utils import log_softmax, logsumexp
+
+
+class OutputShortlist(object):
+    """Log softmax of an output projection computed for a shortlist of tokens.
+
+    The shortlist consists of fixed prior tokens and the tokens added by
+    set_context_tokens, e.g. the top tokens of the last full pass. The full
+    normalizer Z is recovered from the shortlist normalizer Z_s using
+    log(Z / Z_s) measured at the last full pass of each hypothesis, which
+    callers carry alongside the hypothesis. Tokens outside the shortlist get a
+    log prob of -inf."""
+
+    def __init__(self, out_w, out_b, prior_tokens):
+        self.out_w = out_w
+        self.out_b = out_b
+        self.prior_tokens = np.unique(prior_tokens)
+        self.set_context_tokens([])
+
+        # Number of rows computed over the shortlist and in full
+        self.short_rows = 0
+        self.full_rows = 0
+
+    def set_context_tokens(self, context_tokens):
+        """Set the shortlist to the prior tokens and context_tokens."""
+        self.tokens = np.union1d(self.prior_tokens, context_tokens).astype(np.int64)
+        self.short_w = np.ascontiguousarray(self.out_w[:, self.tokens])
+        self.short_b = self.out_b[self.tokens]
+
+    def full_log_softmax(self, hidden):
+        self.full_rows += hidden.shape[0]
+        return log_softmax(np.matmul(hidden, self.out_w) + self.out_b)
+
+    def get_log_norm_ratios(self, log_probs):
+        """log(Z / Z_s) of the current shortlist given full log probs."""
+        return -logsumexp(log_probs[:, self.tokens])
+
+    def log_softmax(self, hidden, log_norm_ratios):
+        """Log probs for the N x H hidden vectors over the shortlist, given
+        the N sized log(Z / Z_s) of the rows."""
+        self.short_rows += hidden.shape[0]
+        short_logits = np.matmul(hidden, self.short_w) + self.short_b
+        log_norms = logsumexp(short_logits) + log_norm_ratios
+        log_probs = np.full((hidden.shape[0], self.out_w.shape[1]), -np.inf,
+                            dtype=short_logits.dtype)
+        log_probs[:, self.tokens] = short_logits - log_norms[:, np.newaxis]
+        return log_probs
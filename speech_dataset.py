@@ -8,6 +8,7 @@ class SpeechDataset(object):
     def __init__(self, params, data_files, isTraining):
         self.params = params  # batch_size, feat_length
         self.is_training = isTraining
+        self.data_files = data_files
         self.data_set, self.data_iter = self.create_iterator(data_files)
 
     def get_instance(self, proto):
@@ -1,5 +1,4 @@
 import re
-import tensorflow as tf
 
 import data_utils
 
@@ -8,13 +7,11 @@ def reverse_swbd_normalizer():
     swbd_dict = {"!": "[laughter]",
                  "@": "[noise]",
                  "#": "[vocalized-noise]"}
+    # Create a regex for match
+    regex = re.compile("(%s)" % "|".join(map(re.escape, swbd_dict.keys())))
 
     def normalizer(text):
-        # Create a regex for match
-        regex = re.compile("(%s)" % "|".join(map(re.escape, swbd_dict.keys())))
         # For each match, look-up corresponding value in dictionary
-        return regex.sub(lambda match: swbd_dict[match.string[match.start() : match.end()]], text)
+        return regex.sub(lambda match: swbd_dict[match.group(0)], text)
 
     return normalizer
-
-
@@ -32,6 +32,7 @@ from speech_dataset import SpeechDataset
 from lm_dataset import LMDataset
 from base_params import BaseParams
 from eval_model import Eval
+from async_eval import AsyncEvaluator, copy_checkpoint
 
 
 class Train(BaseParams):
@@ -62,6 +63,11 @@ class Train(BaseParams):
 
         params['run_id'] = 1
         params['steps_per_checkpoint'] = 500
+        params['async_eval'] = False
+        # Teacher forced dev loss at every checkpoint, with the greedy
+        # decoding WER only every wer_every checkpoints or when the loss improves
+        params['dev_loss'] = False
+        params['wer_every'] = 1
 
         # Pretrained models path
         params["pretrain_lm_path"] = ""
@@ -120,13 +126,21 @@ class Train(BaseParams):
         if logging:
             print ("Total train files: %d" %total_train_files)
 
-        # Dev set
+        dev_set = self.get_dev_set(logging=logging)
+        return buck_train_sets, dev_set
+
+    def get_dev_set(self, logging=True):
+        params = self.params
+        dataset_params = Bunch()
+        dataset_params.batch_size = params.batch_size
+        dataset_params.feat_length = params.feat_length
+
         dev_files = glob.glob(path.join(params.data_dir, "dev*"))
         if logging:
             print ("Total dev files: %d" %len(dev_files))
-        dev_set = SpeechDataset(dataset_params_def, dev_files,
+        dev_set = SpeechDataset(dataset_params, dev_files,
                                 isTraining=False)
-        return buck_train_sets, dev_set
+        return dev_set
 
 
     def get_lm_files(self):
@@ -143,12 +157,18 @@ class Train(BaseParams):
             dev_seq2seq_params.num_layers = {'char': dev_seq2seq_params.num_layers['char']}
             model_dev = Seq2SeqModel(dev_set.data_iter, isTraining=False,
                                      params=dev_seq2seq_params)
+            loss_model_dev = None
+            if self.params.dev_loss:
+                with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                    loss_model_dev = Seq2SeqModel(dev_set.data_iter, isTraining=False,
+                                                  params=dev_seq2seq_params,
+                                                  teacher_forcing=True)
 
             params = Bunch()
             params.best_model_dir = self.params.best_model_dir
             params.vocab_dir = self.params.vocab_dir
 
-            self.eval_model = Eval(model_dev, params=params)
+            self.eval_model = Eval(model_dev, params=params, loss_model=loss_model_dev)
 
     @staticmethod
     def check_progess(previous_errs, num=10):
@@ -157,11 +177,83 @@ class Train(BaseParams):
                 return False
         return True
 
+    def run_dev_eval(self, sess, global_step, dev_state):
+        """Evaluate the model of the session on dev and return a Bunch of
+        the global_step, dev_loss, asr_err and decode_time. With dev_loss set,
+        the teacher forced loss is computed first and the greedy decoding
+        WER, otherwise None, only every wer_every evaluations or when the loss
+        improves on the best loss of dev_state."""
+        params = self.params
+        dev_result = Bunch(global_step=global_step, dev_loss=None, asr_err=None)
+        decode_start_time = time.time()
+        run_decode = True
+        if params.dev_loss:
+            dev_result.dev_loss = self.eval_model.teacher_forced_loss(sess)
+            dev_state.num_evals += 1
+            run_decode = (dev_result.dev_loss < dev_state.best_loss or
+                          dev_state.num_evals % max(params.wer_every, 1) == 0)
+            dev_state.best_loss = min(dev_state.best_loss, dev_result.dev_loss)
+        if run_decode:
+            dev_result.asr_err = self.eval_model.greedy_decode(sess)
+        dev_result.decode_time = time.time() - decode_start_time
+        return dev_result
+
+    def process_dev_error(self, sess, model, asr_err_cur, global_step, previous_errs,
+                          asr_err_best, train_writer, save_best_model):
+        """Log the dev error of the checkpoint at global_step and apply it to
+        the learning rate decay and early stopping. If it's the best error so
+        far, save_best_model is called. Returns the best error."""
+        params = self.params
+        with open(path.join(params.train_dir, "asr_err.txt"), "a") as err_f:
+            err_f.write(str(asr_err_cur) + "\n")
+
+        err_summary = tf_utils.get_summary(asr_err_cur, "ASR Error")
+        train_writer.add_summary(err_summary, global_step)
+
+        if global_step >= params.min_steps:
+            if len(previous_errs) > 3 and asr_err_cur >= max(previous_errs[-3:]):
+                # Training has already happened for min epochs and the dev
+                # error is getting worse w.r.t. the worst value in previous 3 checkpoints
+                # If the code is not reaching this point then it's guaranteed that the
+                # worst performance keeps improving
+                if model.learning_rate.eval() > 1e-4:
+                    sess.run(model.learning_rate_decay_op)
+                    print ("Learning rate decreased !!")
+                    sys.stdout.flush()
+
+        previous_errs.append(asr_err_cur)
+        if not (model.learning_rate.eval() > 1e-4):
+            if not self.check_progess(previous_errs):
+                print ("No improvement in 10 checkpoints")
+                sys.exit()
+
+
+        # Early stopping
+        if asr_err_best > asr_err_cur:
+            asr_err_best = asr_err_cur
+            # Save model
+            print("Best ASR Error rate: %.4f" % asr_err_best)
+            print("Saving the best model !!")
+            sys.stdout.flush()
+
+            # Save the best score
+            f = open(os.path.join(params.train_dir, "best.txt"), "w")
+            f.write(str(asr_err_best))
+            f.close()
+
+            save_best_model()
+        return asr_err_best
+
     def train(self):
         """Train a sequence to sequence speech recognizer!"""
         params = self.params
         model_params = self.seq2seq_params
 
+        evaluator = None
+        if params.async_eval:
+            # Fork the evaluator before any TF session exists
+            evaluator = AsyncEvaluator(self)
+
         with tf.Graph().as_default():
             # Set the random seeds
             if not params.chaos:
@@ -175,7 +267,11 @@ class Train(BaseParams):
 
             # Bucket train sets
             buck_train_sets, dev_set = self.get_data_sets()
-            with tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=1)) as sess:
+            sess_config = tf.ConfigProto(intra_op_parallelism_threads=1)
+            if evaluator is not None:
+                # Leave GPU memory for the evaluator
+                sess_config.gpu_options.allow_growth = True
+            with tf.Session(config=sess_config) as sess:
                 handle = tf.placeholder(tf.string, shape=[])
                 iterator = tf.data.Iterator.from_string_handle(
                     handle, buck_train_sets[0].data_set.output_types,
@@ -185,7 +281,8 @@ class Train(BaseParams):
                     model = Seq2SeqModel(iterator, True, model_params)
                     # Create eval model
 
-                self.create_eval_model(dev_set)
+                if evaluator is None:
+                    self.create_eval_model(dev_set)
 
                 if params.lm_prob > 0:
                     # Create LM dataset
@@ -232,6 +329,40 @@ class Train(BaseParams):
                 print ("\nBest ASR error rate - %f" %asr_err_best)
                 sys.stdout.flush()
 
+                def save_best_model():
+                    # Save the model in best model directory
+                    checkpoint_path = os.path.join(params.best_model_dir, "asr.ckpt")
+                    best_model_saver.save(sess, checkpoint_path, global_step=model.global_step,
+                                          write_meta_graph=False)
+
+                def process_dev_results(dev_results, save_best_model=None):
+                    """Apply the dev results and return the best error. The
+                    results of the evaluator save the evaluated checkpoint as
+                    the best model."""
+                    best_err = asr_err_best
+                    for dev_result in dev_results:
+                        if dev_result.dev_loss is not None:
+                            dev_perplexity = (math.exp(dev_result.dev_loss)
+                                              if dev_result.dev_loss < 300 else float('inf'))
+                            print ("Step %d Dev perplexity: %.2f"
+                                   %(dev_result.global_step, dev_perplexity))
+                            dev_summary = tf_utils.get_summary(dev_perplexity, "Dev Perplexity")
+                            train_writer.add_summary(dev_summary, dev_result.global_step)
+                        if dev_result.asr_err is not None:
+                            print ("Step %d ASR error: %.4f, Decoding time: %s"
+                                   %(dev_result.global_step, dev_result.asr_err,
+                                     timedelta(seconds=dev_result.decode_time)))
+                        sys.stdout.flush()
+                        if dev_result.asr_err is None:
+                            continue
+                        best_err = self.process_dev_error(
+                            sess, model, dev_result.asr_err, dev_result.global_step,
+                            previous_errs, best_err, train_writer,
+                            (save_best_model if save_best_model is not None else
+                             lambda: copy_checkpoint(dev_result.ckpt_path,
+                                                     params.best_model_dir)))
+                    return best_err
+
                 # This is the training loop.
                 epc_time, loss = 0.0, 0.0
                 ckpt_start_time = time.time()
@@ -240,6 +371,8 @@ class Train(BaseParams):
                     lm_steps, lm_loss = 0, 0.0
                     sess.run(lm_model.data_iter.initializer)
                 previous_errs = []
+                # Best teacher forced dev loss and number of dev evaluations
+                dev_state = Bunch(best_loss=float('inf'), num_evals=0)
                 try:
                     with open(path.join(params.train_dir, "asr_err.txt"), "r") as err_f:
                         for line in err_f:
@@ -318,57 +451,23 @@ class Train(BaseParams):
                                     lr_summary = tf_utils.get_summary(model.learning_rate.eval(), "Learning rate")
                                     train_writer.add_summary(lr_summary, model.global_step.eval())
 
-                                    decode_start_time = time.time()
-                                    asr_err_cur = self.eval_model.greedy_decode(sess)
-                                    decode_end_time = time.time() - decode_start_time
-
-                                    print ("ASR error: %.4f, Decoding time: %s"
-                                           %(asr_err_cur, timedelta(seconds=decode_end_time)))
-                                    sys.stdout.flush()
-                                    with open(path.join(params.train_dir, "asr_err.txt"), "a") as err_f:
-                                        err_f.write(str(asr_err_cur) + "\n")
-
-                                    err_summary = tf_utils.get_summary(asr_err_cur, "ASR Error")
-                                    train_writer.add_summary(err_summary, model.global_step.eval())
-
-                                    if model.global_step.eval() >= params.min_steps:
-                                        if len(previous_errs) > 3 and asr_err_cur >= max(previous_errs[-3:]):
-                                            # Training has already happened for min epochs and the dev
-                                            # error is getting worse w.r.t. the worst value in previous 3 checkpoints
-                                            # If the code is not reaching this point then it's guaranteed that the
-                                            # worst performance keeps improving
-                                            if model.learning_rate.eval() > 1e-4:
-                                                sess.run(model.learning_rate_decay_op)
-                                                print ("Learning rate decreased !!")
-                                                sys.stdout.flush()
-
-                                    previous_errs.append(asr_err_cur)
-                                    if not (model.learning_rate.eval() > 1e-4):
-                                        if not self.check_progess(previous_errs):
-                                            print ("No improvement in 10 checkpoints")
-                                            sys.exit()
-
-
-                                    # Early stopping
-                                    if asr_err_best > asr_err_cur:
-                                        asr_err_best = asr_err_cur
-                                        # Save model
-                                        print("Best ASR Error rate: %.4f" % asr_err_best)
-                                        print("Saving the best model !!")
-                                        sys.stdout.flush()
-
-                                        # Save the best score
-                                        f = open(os.path.join(params.train_dir, "best.txt"), "w")
-                                        f.write(str(asr_err_best))
-                                        f.close()
-
-                                        # Save the model in best model directory
-                                        checkpoint_path = os.path.join(params.best_model_dir, "asr.ckpt")
-                                        best_model_saver.save(sess, checkpoint_path, global_step=model.global_step, write_meta_graph=False)
-
-                                    # Also save the model for plotting
-                                    checkpoint_path = os.path.join(params.train_dir, "asr.ckpt")
-                                    model_saver.save(sess, checkpoint_path, global_step=model.global_step, write_meta_graph=False)
+                                    if evaluator is not None:
+                                        # Save the model for the evaluator and go on
+                                        checkpoint_path = os.path.join(params.train_dir, "asr.ckpt")
+                                        ckpt_path = model_saver.save(
+                                            sess, checkpoint_path, global_step=model.global_step,
+                                            write_meta_graph=False)
+                                        evaluator.submit(model.global_step.eval(), ckpt_path)
+                                        asr_err_best = process_dev_results(evaluator.get_results())
+                                    else:
+                                        dev_result = self.run_dev_eval(
+                                            sess, model.global_step.eval(), dev_state)
+                                        asr_err_best = process_dev_results([dev_result],
+                                                                           save_best_model)
+
+                                        # Also save the model for plotting
+                                        checkpoint_path = os.path.join(params.train_dir, "asr.ckpt")
+                                        model_saver.save(sess, checkpoint_path, global_step=model.global_step, write_meta_graph=False)
 
                                     print ("\n")
                                     sys.stdout.flush()
@@ -393,6 +492,10 @@ class Train(BaseParams):
                     print ("Reshuffling ASR training data!")
                     buck_train_sets, dev_set = self.get_data_sets(logging=False)
 
+                if evaluator is not None:
+                    # Apply the evaluations of the last checkpoints
+                    asr_err_best = process_dev_results(evaluator.close())
+
 
     @classmethod
     def add_parse_options(cls, parser):
@@ -415,6 +518,15 @@ class Train(BaseParams):
                             help="Number of features per frame")
         parser.add_argument("-steps_per_checkpoint", default=500,
                             type=int, help="Gradient steps per checkpoint")
+        parser.add_argument("-async_eval", default=False, action="store_true",
+                            help="Evaluate the checkpoints on dev in a background process "
+                            "while training goes on")
+        parser.add_argument("-dev_loss", default=False, action="store_true",
+                            help="Compute the teacher forced dev loss at every checkpoint "
+                            "and the dev WER only every wer_every checkpoints or when "
+                            "the loss improves")
+        parser.add_argument("-wer_every", default=1, type=int,
+                            help="Checkpoints between dev WER evaluations with -dev_loss")
         parser.add_argument("-min_steps", "--min_steps", default=25000, type=int,
                             help="Min steps BEFORE DECREASING LEARNING RATE")
 
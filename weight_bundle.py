@@ -0,0 +1,126 @@
+"""Memory-mapped numpy bundles of the decoder and LM weights used by beam search.
+
+A bundle is a directory next to the TF checkpoint, <ckpt_path>.npbundle, with
+one .npy file per param and a manifest.json recording the bundle version and
+the checkpoint it was exported from. Loading a bundle maps the arrays lazily
+and doesn't require TensorFlow, which is only needed to export it.
+
+The arrays are stored in the float32 of the checkpoint. BeamSearch keeps
+them memory-mapped only with -precision float32; with the default float64
+and with float16 they are cast into memory at load, so the bundle then
+only saves the checkpoint reading and not memory.
+
+Usage:
+    python weight_bundle.py -ckpt_path <asr ckpt> [-lm_path <lm ckpt>]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+from os import path
+
+import numpy as np
+from bunch import Bunch
+
+BUNDLE_VERSION = 1
+BUNDLE_SUFFIX = ".npbundle"
+MANIFEST_FILE = "manifest.json"
+
+
+def get_bundle_dir(ckpt_path):
+    return ckpt_path + BUNDLE_SUFFIX
+
+
+def get_ckpt_mtime(ckpt_path):
+    """Modification time of the checkpoint, or None if it doesn't exist."""
+    for ckpt_file in [ckpt_path + ".index", ckpt_path]:
+        if path.exists(ckpt_file):
+            return path.getmtime(ckpt_file)
+    return None
+
+
+def read_manifest(bundle_dir):
+    manifest_file = path.join(bundle_dir, MANIFEST_FILE)
+    if not path.isfile(manifest_file):
+        return None
+    with open(manifest_file) as manifest_f:
+        return json.load(manifest_f)
+
+
+def is_bundle_current(ckpt_path):
+    """Whether the bundle of the checkpoint exists, is of the current version
+    and was exported from the current checkpoint."""
+    manifest = read_manifest(get_bundle_dir(ckpt_path))
+    if manifest is None or manifest["version"] != BUNDLE_VERSION:
+        return False
+    ckpt_mtime = get_ckpt_mtime(ckpt_path)
+    return (ckpt_mtime is None or manifest["ckpt_mtime"] == ckpt_mtime)
+
+
+def save_bundle(ckpt_path, params):
+    """Write the params, a Bunch of arrays or None, as the bundle of the
+    checkpoint. The manifest is written last so that a partially written
+    bundle is never loaded."""
+    bundle_dir = get_bundle_dir(ckpt_path)
+    if not path.exists(bundle_dir):
+        os.makedirs(bundle_dir)
+
+    arrays = {}
+    for name, value in params.items():
+        if value is None:
+            arrays[name] = None
+            continue
+        value = np.ascontiguousarray(value)
+        np.save(path.join(bundle_dir, name + ".npy"), value)
+        arrays[name] = {"dtype": value.dtype.str, "shape": list(value.shape)}
+
+    manifest = {"version": BUNDLE_VERSION, "ckpt_path": ckpt_path,
+                "ckpt_mtime": get_ckpt_mtime(ckpt_path), "arrays": arrays}
+    tmp_manifest_file = path.join(bundle_dir, MANIFEST_FILE + ".tmp")
+    with open(tmp_manifest_file, "w") as manifest_f:
+        json.dump(manifest, manifest_f, indent=2, sort_keys=True)
+    os.rename(tmp_manifest_file, path.join(bundle_dir, MANIFEST_FILE))
+    print ("Exported weight bundle at: %s" %bundle_dir)
+
+
+def load_bundle(ckpt_path):
+    """Load the bundle of the checkpoint as a Bunch of memory-mapped arrays."""
+    bundle_dir = get_bundle_dir(ckpt_path)
+    manifest = read_manifest(bundle_dir)
+    if manifest is None:
+        raise IOError("No weight bundle at %s" %bundle_dir)
+    if manifest["version"] != BUNDLE_VERSION:
+        raise ValueError("Weight bundle version %d at %s, expected %d"
+                         %(manifest["version"], bundle_dir, BUNDLE_VERSION))
+
+    params = Bunch()
+    for name, array_info in manifest["arrays"].items():
+        if array_info is None:
+            params[name] = None
+        else:
+            params[name] = np.load(path.join(bundle_dir, name + ".npy"), mmap_mode="r")
+    return params
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-ckpt_path", type=str, help="ASR model ckpt path")
+    parser.add_argument("-lm_path", default="", type=str, help="LM ckpt path")
+    args = parser.parse_args()
+    return args
+
+
+if __name__=="__main__":
+    from beam_search import BeamSearch
+
+    args = parse_options()
+    save_bundle(args.ckpt_path, BeamSearch.map_dec_variables(
+        BeamSearch.get_model_params(args.ckpt_path)))
+    if args.lm_path:
+        save_bundle(args.lm_path, BeamSearch.map_lm_variables(
+            BeamSearch.get_model_params(args.lm_path)))
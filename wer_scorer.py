@@ -0,0 +1,222 @@
+"""Batched word error counting of decoded outputs against references.
+
+Words are interned to integer IDs and the hypotheses and references of a
+batch of utterances are padded into ID arrays. The Levenshtein distance
+table is filled one hypothesis position at a time for all utterances and
+reference positions at once: with T[j] the cost of reaching (i, j) by a
+match, substitution or insertion, the chain of deletions within the row is
+resolved as D[i, j] = j + min_{k <= j} (T[k] - k) by a running minimum.
+A backtrace run over all utterances in lockstep then splits the errors into
+insertions (extra hypothesis words), deletions (missed reference words) and
+substitutions, and optionally records the alignments.
+
+Utterances are sorted by length and scored in batches of at most
+max_batch_cells table entries to bound memory and padding.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from bunch import Bunch
+
+# Default maximum size of the distance table of a batch
+MAX_BATCH_CELLS = 2 ** 24
+
+# Alignment operations
+EQUAL, SUB, INS, DEL = 0, 1, 2, 3
+OP_NAMES = ["equal", "sub", "ins", "del"]
+
+
+class WordInterner(object):
+    """Maps words to integer IDs assigned in the order of first occurrence."""
+
+    def __init__(self):
+        self.word_ids = {}
+
+    def __len__(self):
+        return len(self.word_ids)
+
+    def __call__(self, words):
+        word_ids = self.word_ids
+        return np.array([word_ids.setdefault(word, len(word_ids)) for word in words],
+                        dtype=np.int32)
+
+
+def pad_ids(id_seqs):
+    """B x L array of the ID sequences padded with -1, with L at least 1,
+    and the sequence lengths."""
+    lengths = np.array([len(id_seq) for id_seq in id_seqs], dtype=np.int64)
+    max_len = (int(np.max(lengths)) if len(id_seqs) else 0)
+    padded = np.full((len(id_seqs), max(max_len, 1)), -1, dtype=np.int32)
+    for idx, id_seq in enumerate(id_seqs):
+        padded[idx, :len(id_seq)] = id_seq
+    return padded, lengths
+
+
+def next_row(prev_row, hyp_ids, ref_ids, row_idx, ref_range):
+    """Row row_idx of the distance tables given the previous row, the
+    hypothesis IDs at row_idx - 1 and the padded reference IDs."""
+    row = np.empty_like(prev_row)
+    row[:, 0] = row_idx
+    # Match or substitution, and insertion of the hypothesis word
+    np.minimum(prev_row[:, :-1] + (hyp_ids[:, np.newaxis] != ref_ids),
+               prev_row[:, 1:] + 1, out=row[:, 1:])
+    # Deletions of reference words
+    row -= ref_range
+    np.minimum.accumulate(row, axis=1, out=row)
+    row += ref_range
+    return row
+
+
+def distance_tables(hyp_ids, ref_ids):
+    """B x (H + 1) x (R + 1) edit distances between the prefixes of the
+    B x H hypothesis and B x R reference ID arrays."""
+    batch_size, hyp_len = hyp_ids.shape
+    ref_range = np.arange(ref_ids.shape[1] + 1, dtype=np.int32)
+    tables = np.empty((batch_size, hyp_len + 1, ref_range.shape[0]), dtype=np.int32)
+    tables[:, 0, :] = ref_range
+    for row_idx in xrange(1, hyp_len + 1):
+        tables[:, row_idx, :] = next_row(tables[:, row_idx - 1, :], hyp_ids[:, row_idx - 1],
+                                         ref_ids, row_idx, ref_range)
+    return tables
+
+
+def edit_distances(hyp_ids, ref_ids, hyp_lens, ref_lens):
+    """Edit distances of the padded hypotheses and references, keeping only
+    one row of the tables at a time."""
+    batch_size, hyp_len = hyp_ids.shape
+    batch_range = np.arange(batch_size)
+    ref_range = np.arange(ref_ids.shape[1] + 1, dtype=np.int32)
+    row = np.tile(ref_range, (batch_size, 1))
+    distances = np.zeros(batch_size, dtype=np.int64)
+    for row_idx in xrange(hyp_len + 1):
+        if row_idx > 0:
+            row = next_row(row, hyp_ids[:, row_idx - 1], ref_ids, row_idx, ref_range)
+        ending = (hyp_lens == row_idx)
+        distances[ending] = row[batch_range[ending], ref_lens[ending]]
+    return distances
+
+
+def backtrace(tables, hyp_ids, ref_ids, hyp_lens, ref_lens, return_alignments=False):
+    """4 x B counts of the EQUAL, SUB, INS and DEL operations along a best
+    alignment of each utterance, and the alignments as lists of (op,
+    hypothesis position, reference position) triples, with None for the
+    position missing from insertions and deletions, if requested."""
+    batch_range = np.arange(tables.shape[0])
+    hyp_pos, ref_pos = hyp_lens.copy(), ref_lens.copy()
+    op_counts = np.zeros((len(OP_NAMES), tables.shape[0]), dtype=np.int64)
+    # Operations of each step, from the end of the alignments
+    step_ops = []
+    while True:
+        active = (hyp_pos > 0) | (ref_pos > 0)
+        if not np.any(active):
+            break
+        prev_hyp, prev_ref = np.maximum(hyp_pos - 1, 0), np.maximum(ref_pos - 1, 0)
+        cur_dist = tables[batch_range, hyp_pos, ref_pos]
+        mismatch = (hyp_ids[batch_range, prev_hyp] != ref_ids[batch_range, prev_ref])
+        # Prefer matches and substitutions, then insertions
+        diag = ((hyp_pos > 0) & (ref_pos > 0) &
+                (tables[batch_range, prev_hyp, prev_ref] + mismatch == cur_dist))
+        ins = (~diag & (hyp_pos > 0) &
+               (tables[batch_range, prev_hyp, ref_pos] + 1 == cur_dist))
+        dels = active & ~diag & ~ins
+
+        ops = np.where(diag, np.where(mismatch, SUB, EQUAL), np.where(ins, INS, DEL))
+        ops[~active] = -1
+        for op in xrange(len(OP_NAMES)):
+            op_counts[op] += (ops == op)
+        if return_alignments:
+            step_ops.append(ops)
+        hyp_pos -= (diag | ins)
+        ref_pos -= (diag | dels)
+
+    if not return_alignments:
+        return op_counts, None
+    alignments = []
+    for utt_idx in xrange(tables.shape[0]):
+        alignment = []
+        hyp_idx, ref_idx = 0, 0
+        for ops in reversed(step_ops):
+            op = ops[utt_idx]
+            if op < 0:
+                continue
+            alignment.append((OP_NAMES[op], (None if op == DEL else hyp_idx),
+                              (None if op == INS else ref_idx)))
+            hyp_idx += (op != DEL)
+            ref_idx += (op != INS)
+        alignments.append(alignment)
+    return op_counts, alignments
+
+
+class WordErrorScorer(object):
+    """Scores word lists of hypotheses against those of references. The word
+    IDs are kept across calls, e.g. for the N-best hypotheses of a dev set."""
+
+    def __init__(self, max_batch_cells=MAX_BATCH_CELLS):
+        self.interner = WordInterner()
+        self.max_batch_cells = max_batch_cells
+
+    def get_batches(self, hyp_lens, ref_lens):
+        """Lists of utterance indices, sorted by length, whose distance
+        tables have at most max_batch_cells entries."""
+        sorted_indices = np.lexsort((hyp_lens, ref_lens))
+        batches, batch = [], []
+        max_hyp_len, max_ref_len = 0, 0
+        for idx in sorted_indices:
+            new_hyp_len = max(max_hyp_len, hyp_lens[idx])
+            new_ref_len = max(max_ref_len, ref_lens[idx])
+            if batch and ((len(batch) + 1) * (new_hyp_len + 1) * (new_ref_len + 1)
+                          > self.max_batch_cells):
+                batches.append(batch)
+                batch = []
+                new_hyp_len, new_ref_len = hyp_lens[idx], ref_lens[idx]
+            batch.append(idx)
+            max_hyp_len, max_ref_len = new_hyp_len, new_ref_len
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def score(self, hyp_word_lists, ref_word_lists, breakdown=True, return_alignments=False):
+        """Word errors of each hypothesis against its reference.
+
+        Returns a Bunch of per utterance arrays errors and ref_words, and
+        with breakdown also ins, dels and subs. With return_alignments, the
+        Bunch also has the alignment of each utterance as a list of (op,
+        hypothesis position, reference position) triples with op one of
+        OP_NAMES and None for the position missing from insertions and
+        deletions."""
+        assert len(hyp_word_lists) == len(ref_word_lists)
+        breakdown = breakdown or return_alignments
+        hyp_id_seqs = [self.interner(words) for words in hyp_word_lists]
+        ref_id_seqs = [self.interner(words) for words in ref_word_lists]
+        hyp_lens = np.array([len(ids) for ids in hyp_id_seqs], dtype=np.int64)
+        ref_lens = np.array([len(ids) for ids in ref_id_seqs], dtype=np.int64)
+
+        num_utts = len(hyp_id_seqs)
+        result = Bunch(errors=np.zeros(num_utts, dtype=np.int64), ref_words=ref_lens)
+        if breakdown:
+            for key in ["ins", "dels", "subs"]:
+                result[key] = np.zeros(num_utts, dtype=np.int64)
+        if return_alignments:
+            result.alignments = [None] * num_utts
+
+        for batch in self.get_batches(hyp_lens, ref_lens):
+            hyp_ids, batch_hyp_lens = pad_ids([hyp_id_seqs[idx] for idx in batch])
+            ref_ids, batch_ref_lens = pad_ids([ref_id_seqs[idx] for idx in batch])
+            if not breakdown:
+                result.errors[batch] = edit_distances(hyp_ids, ref_ids,
+                                                      batch_hyp_lens, batch_ref_lens)
+                continue
+            tables = distance_tables(hyp_ids, ref_ids)
+            op_counts, alignments = backtrace(tables, hyp_ids, ref_ids, batch_hyp_lens,
+                                              batch_ref_lens, return_alignments)
+            result.subs[batch] = op_counts[SUB]
+            result.ins[batch] = op_counts[INS]
+            result.dels[batch] = op_counts[DEL]
+            result.errors[batch] = op_counts[SUB] + op_counts[INS] + op_counts[DEL]
+            if return_alignments:
+                for idx, alignment in zip(batch, alignments):
+                    result.alignments[idx] = alignment
+        return result
@@ -0,0 +1,92 @@
+"""Tests of the batched word error scorer against a plain edit distance."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+
+from wer_scorer import WordErrorScorer
+
+
+def edit_distance(hyp_words, ref_words):
+    """Levenshtein distance by the textbook dynamic program."""
+    prev_row = list(range(len(ref_words) + 1))
+    for hyp_idx, hyp_word in enumerate(hyp_words):
+        row = [hyp_idx + 1]
+        for ref_idx, ref_word in enumerate(ref_words):
+            row.append(min(prev_row[ref_idx] + (hyp_word != ref_word),
+                           prev_row[ref_idx + 1] + 1, row[ref_idx] + 1))
+        prev_row = row
+    return prev_row[-1]
+
+
+def random_word_lists(num_utts, max_len, vocab_size, rng):
+    return [["w%d" %word for word in rng.randint(vocab_size, size=rng.randint(max_len + 1))]
+            for _ in xrange(num_utts)]
+
+
+class WordErrorScorerTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.ref_word_lists = random_word_lists(200, 12, 6, rng)
+        # Hypotheses are edits of the references, and some unrelated ones
+        self.hyp_word_lists = []
+        for ref_words in self.ref_word_lists:
+            hyp_words = list(ref_words)
+            for _ in xrange(rng.randint(4)):
+                pos = rng.randint(len(hyp_words) + 1)
+                edit = rng.randint(3)
+                if edit == 0 or not hyp_words:
+                    hyp_words.insert(pos, "w%d" %rng.randint(6))
+                elif edit == 1:
+                    del hyp_words[min(pos, len(hyp_words) - 1)]
+                else:
+                    hyp_words[min(pos, len(hyp_words) - 1)] = "w%d" %rng.randint(6)
+            self.hyp_word_lists.append(hyp_words)
+        self.hyp_word_lists[::7] = random_word_lists(len(self.hyp_word_lists[::7]), 12, 6, rng)
+        self.distances = [edit_distance(hyp_words, ref_words) for hyp_words, ref_words
+                          in zip(self.hyp_word_lists, self.ref_word_lists)]
+
+    def test_errors(self):
+        """Errors with and without the breakdown are the edit distances, for
+        any batching of the utterances."""
+        for max_batch_cells in [1, 100, 2 ** 24]:
+            scorer = WordErrorScorer(max_batch_cells=max_batch_cells)
+            for breakdown in [False, True]:
+                result = scorer.score(self.hyp_word_lists, self.ref_word_lists,
+                                      breakdown=breakdown)
+                self.assertEqual(result.errors.tolist(), self.distances)
+                self.assertEqual(result.ref_words.tolist(),
+                                 [len(ref_words) for ref_words in self.ref_word_lists])
+
+    def test_breakdown(self):
+        """The alignments have the counted operations and cover the words in
+        order, with insertions the extra hypothesis words."""
+        result = WordErrorScorer().score(self.hyp_word_lists, self.ref_word_lists,
+                                         return_alignments=True)
+        np.testing.assert_array_equal(result.ins + result.dels + result.subs, result.errors)
+        for utt_idx, alignment in enumerate(result.alignments):
+            hyp_words = self.hyp_word_lists[utt_idx]
+            ref_words = self.ref_word_lists[utt_idx]
+            ops = [op for op, _, _ in alignment]
+            self.assertEqual(ops.count("ins"), result.ins[utt_idx])
+            self.assertEqual(ops.count("del"), result.dels[utt_idx])
+            self.assertEqual(ops.count("sub"), result.subs[utt_idx])
+            self.assertEqual([hyp_pos for _, hyp_pos, _ in alignment if hyp_pos is not None],
+                             list(range(len(hyp_words))))
+            self.assertEqual([ref_pos for _, _, ref_pos in alignment if ref_pos is not None],
+                             list(range(len(ref_words))))
+            for op, hyp_pos, ref_pos in alignment:
+                if op == "equal":
+                    self.assertEqual(hyp_words[hyp_pos], ref_words[ref_pos])
+                elif op == "sub":
+                    self.assertNotEqual(hyp_words[hyp_pos], ref_words[ref_pos])
+        self.assertEqual(WordErrorScorer().score([["a", "b"]], [["b"]]).ins.tolist(), [1])
+
+
+if __name__=="__main__":
+    unittest.main()